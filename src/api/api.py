@@ -39,12 +39,21 @@ class ApiKeyAuthorization(Authorization):
 
 class VirtualDomainResource(ModelResource):
     """Api resource for virtual domains.
+
+    The DKIM private key and the state of the background deletion are voluntarily excluded.
     """
 
     class Meta:
         queryset = VirtualDomain.objects.all()
         authentication = ApiKeyAuthentication()
         authorization = DjangoAuthorization()
+        excludes = [
+            "dkim_private_key",
+            "dkim_next_private_key",
+            "deleting",
+            "deletion_total",
+            "deletion_done",
+        ]
 
 
 class VirtualUserResource(ModelResource):
@@ -56,7 +65,7 @@ class VirtualUserResource(ModelResource):
     domain = ForeignKey(VirtualDomainResource, "domain")
 
     class Meta:
-        queryset = VirtualUser.objects.all()
+        queryset = VirtualUser.objects.select_related("domain")
         authentication = ApiKeyAuthentication()
         authorization = DjangoAuthorization()
         fields = ("email", "quota", "id")
@@ -69,7 +78,7 @@ class VirtualAliasResource(ModelResource):
     domain = ForeignKey(VirtualDomainResource, "domain")
 
     class Meta:
-        queryset = VirtualAlias.objects.all()
+        queryset = VirtualAlias.objects.select_related("domain")
         authentication = ApiKeyAuthentication()
         authorization = DjangoAuthorization()
 
@@ -19,6 +19,7 @@ URL patters for api
 from django.urls import include, path
 from tastypie.api import Api
 
+from . import views
 from .api import (
     ApiKeyResource,
     ChangeUserPasswordResource,
@@ -34,4 +35,7 @@ api.register(VirtualAliasResource())
 api.register(ChangeUserPasswordResource())
 api.register(ApiKeyResource())
 
-urlpatterns = [path("", include(api.urls))]
+urlpatterns = [
+    path("api/changes", views.changes, name="api-changes"),
+    path("", include(api.urls)),
+]
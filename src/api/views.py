@@ -0,0 +1,108 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Views of the api that are not tastypie resources.
+"""
+import asyncio
+import time
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponseNotAllowed, JsonResponse
+from tastypie.authentication import ApiKeyAuthentication
+
+from core.changes import FEED_MODELS, get_max_wait, get_poll_interval, read_changes
+
+
+def _authenticate(request):
+    """Authenticate a request with an api key and return the kinds of changes it can read."""
+    authenticated = ApiKeyAuthentication().is_authenticated(request)
+    if authenticated is not True:
+        return authenticated, None
+    return None, [
+        model._meta.model_name
+        for model in FEED_MODELS
+        if request.user.has_perm("core.view_{}".format(model._meta.model_name))
+    ]
+
+
+def _parse(request, name, cast, default):
+    value = cast(request.GET.get(name, default))
+    if not value >= 0:
+        raise ValueError(name)
+    return value
+
+
+async def changes(request):
+    """Return the changes of the change feed after a sequence number.
+
+    Parameters are since (last sequence number processed, 0 by default), limit (maximum number
+    of changes) and wait (seconds to wait for a change if there is none yet, 0 by default, at
+    most DINOMAIL_CHANGES_MAX_WAIT). Only the changes of the objects the user can view are
+    returned. Consumers behind the horizon of the feed get a 410 response and must download
+    everything again.
+
+    Args:
+        request (HttpRequest): django request object.
+
+    Returns:
+        HttpResponse: django response object (json).
+    """
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+    unauthorized, kinds = await sync_to_async(_authenticate)(request)
+    if unauthorized is not None:
+        return unauthorized
+    try:
+        since = _parse(request, "since", int, 0)
+        limit = _parse(request, "limit", int, 0) or None
+        wait = min(_parse(request, "wait", float, 0), get_max_wait())
+    except ValueError:
+        return JsonResponse({"error": "invalid since, limit or wait"}, status=400)
+    deadline = time.monotonic() + wait
+    while True:
+        page = await sync_to_async(read_changes)(since, kinds, limit)
+        if since < page["horizon"]:
+            return JsonResponse(
+                {
+                    "error": "changes after {} were compacted".format(since),
+                    "horizon": page["horizon"],
+                    "latest": page["latest"],
+                },
+                status=410,
+            )
+        remaining = deadline - time.monotonic()
+        if page["next"] > since or remaining <= 0:
+            break
+        await asyncio.sleep(min(get_poll_interval(), remaining))
+    return JsonResponse(
+        {
+            "since": since,
+            "next": page["next"],
+            "latest": page["latest"],
+            "more": page["more"],
+            "changes": [
+                {
+                    "sequence": change.sequence,
+                    "kind": change.kind,
+                    "id": change.object_id,
+                    "action": change.action,
+                    "data": change.data,
+                    "created": change.created,
+                }
+                for change in page["changes"]
+            ],
+        }
+    )
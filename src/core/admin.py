@@ -18,7 +18,15 @@ Admin for core app.
 """
 from django.contrib import admin
 
-from .models import VirtualAlias, VirtualDomain, VirtualUser
+from .models import (
+    Change,
+    DmarcAggregate,
+    Job,
+    QuotaUsage,
+    VirtualAlias,
+    VirtualDomain,
+    VirtualUser,
+)
 
 
 class VirtualDomainAdmin(admin.ModelAdmin):
@@ -32,12 +40,16 @@ class VirtualDomainAdmin(admin.ModelAdmin):
     fields = (
         "name",
         "dkim_key_name",
+        "dkim_key_type",
         "dkim_key",
         "display_name",
         "short_display_name",
         "imap_address",
         "pop_address",
         "smtp_address",
+        "max_users",
+        "max_aliases",
+        "max_quota",
     )
 
 
@@ -63,6 +75,47 @@ class VirtualAliasAdmin(admin.ModelAdmin):
     fields = ("domain", "source", "destination")
 
 
+class DmarcAggregateAdmin(admin.ModelAdmin):
+    """Admin class for DMARC aggregates.
+    """
+
+    list_display = ("domain", "date", "source_ip", "messages", "dmarc_pass")
+    ordering = ("-date", "-messages")
+    search_fields = ("source_ip", "domain__name")
+    list_filter = ("domain", "date")
+
+
+class QuotaUsageAdmin(admin.ModelAdmin):
+    """Admin class for quota usages.
+    """
+
+    list_display = ("user", "storage", "messages", "last_update")
+    ordering = ("-storage",)
+    search_fields = ("user__email",)
+
+
+class JobAdmin(admin.ModelAdmin):
+    """Admin class for background jobs.
+    """
+
+    list_display = ("__str__", "state", "progress", "user", "created", "finished")
+    ordering = ("-created",)
+    list_filter = ("state", "kind")
+
+
+class ChangeAdmin(admin.ModelAdmin):
+    """Admin class for the change feed.
+    """
+
+    list_display = ("sequence", "action", "kind", "object_id", "created")
+    ordering = ("-sequence",)
+    list_filter = ("action", "kind")
+
+
+admin.site.register(Change, ChangeAdmin)
+admin.site.register(DmarcAggregate, DmarcAggregateAdmin)
+admin.site.register(Job, JobAdmin)
+admin.site.register(QuotaUsage, QuotaUsageAdmin)
 admin.site.register(VirtualAlias, VirtualAliasAdmin)
 admin.site.register(VirtualUser, VirtualUserAdmin)
 admin.site.register(VirtualDomain, VirtualDomainAdmin)
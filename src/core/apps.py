@@ -21,3 +21,7 @@ from django.apps import AppConfig
 
 class CoreConfig(AppConfig):
     name = "core"
+
+    def ready(self):
+        # Connect the signal receivers and register the job handlers
+        from . import deletion, signals  # noqa: F401
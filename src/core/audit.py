@@ -0,0 +1,217 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Consistency audit of the directory.
+
+Every check is a single set-based query (joins and EXISTS subqueries on indexed columns), so the
+audit does not load or clean the objects one by one.
+"""
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Value
+from django.db.models.functions import StrIndex, Substr
+
+from .changes import record_many
+from .counters import paused, reconcile
+from .models import Change, VirtualAlias, VirtualDomain, VirtualUser
+
+# Checks indexed by name, see register
+CHECKS = {}
+
+
+def register(name, description, fix=None):
+    """Register a check.
+
+    The decorated function returns the queryset of the inconsistent rows, as dictionaries.
+
+    Args:
+        name (string): name of the check.
+        description (string): description of the inconsistency.
+        fix (function): function fixing the rows of the queryset, returning the number of rows
+            fixed. None if the check can't be fixed automatically.
+
+    Returns:
+        function: the decorator.
+    """
+
+    def decorator(function):
+        CHECKS[name] = (description, function, fix)
+        return function
+
+    return decorator
+
+
+def domain_part(field):
+    """Build the expression of the domain of an email field.
+
+    As in the clean methods of the models, the domain is what follows the first @.
+
+    Args:
+        field (string): name of the field.
+
+    Returns:
+        Expression: the domain.
+    """
+    return Substr(field, StrIndex(field, Value("@")) + 1)
+
+
+def _move_to_domain(model, field):
+    def fix(queryset, batch_size=1000):
+        rows = list(queryset.values_list("pk", "{}_domain".format(field)))
+        domains = {}
+        names = list({name for _, name in rows})
+        for i in range(0, len(names), batch_size):
+            domains.update(
+                VirtualDomain.objects.filter(
+                    name__in=names[i : i + batch_size]
+                ).values_list("name", "pk")
+            )
+        objects = [
+            model(pk=pk, domain_id=domains[name])
+            for pk, name in rows
+            if name in domains
+        ]
+        model.objects.bulk_update(objects, ["domain"], batch_size=batch_size)
+        # bulk_update doesn't send the signals recording the changes
+        for i in range(0, len(objects), batch_size):
+            record_many(
+                model.objects.filter(
+                    pk__in=[obj.pk for obj in objects[i : i + batch_size]]
+                ).order_by("pk"),
+                Change.UPDATE,
+                batch_size,
+            )
+        return len(objects)
+
+    return fix
+
+
+def _delete(model):
+    def fix(queryset, batch_size=1000):
+        pks = list(queryset.values_list("pk", flat=True))
+        for i in range(0, len(pks), batch_size):
+            model.objects.filter(pk__in=pks[i : i + batch_size]).delete()
+        return len(pks)
+
+    return fix
+
+
+@register(
+    "user_domain",
+    "users whose email domain is not their domain",
+    _move_to_domain(VirtualUser, "email"),
+)
+def user_domain():
+    return (
+        VirtualUser.objects.annotate(email_domain=domain_part("email"))
+        .exclude(email_domain=F("domain__name"))
+        .values("pk", "email", "domain__name", "email_domain")
+    )
+
+
+@register(
+    "alias_domain",
+    "aliases whose source domain is not their domain",
+    _move_to_domain(VirtualAlias, "source"),
+)
+def alias_domain():
+    return (
+        VirtualAlias.objects.annotate(source_domain=domain_part("source"))
+        .exclude(source_domain=F("domain__name"))
+        .values("pk", "source", "destination", "domain__name", "source_domain")
+    )
+
+
+@register(
+    "duplicate_alias",
+    "aliases with the same source and destination as an older alias",
+    _delete(VirtualAlias),
+)
+def duplicate_alias():
+    older = VirtualAlias.objects.filter(
+        source=OuterRef("source"),
+        destination=OuterRef("destination"),
+        pk__lt=OuterRef("pk"),
+    )
+    return VirtualAlias.objects.filter(Exists(older)).values(
+        "pk", "source", "destination", "domain__name"
+    )
+
+
+@register(
+    "dangling_alias",
+    "aliases whose destination is in a managed domain but is neither a user nor an alias",
+    _delete(VirtualAlias),
+)
+def dangling_alias():
+    return (
+        VirtualAlias.objects.annotate(destination_domain=domain_part("destination"))
+        .filter(
+            Exists(VirtualDomain.objects.filter(name=OuterRef("destination_domain"))),
+            ~Exists(VirtualUser.objects.filter(email=OuterRef("destination"))),
+            ~Exists(VirtualAlias.objects.filter(source=OuterRef("destination"))),
+        )
+        .values("pk", "source", "destination", "domain__name")
+    )
+
+
+@register("shadowing_alias", "aliases whose source is the email of a user")
+def shadowing_alias():
+    return VirtualAlias.objects.filter(
+        Exists(VirtualUser.objects.filter(email=OuterRef("source")))
+    ).values("pk", "source", "destination", "domain__name")
+
+
+def audit(checks=None, fix=(), limit=100):
+    """Run checks and optionally fix the inconsistencies found.
+
+    Fixes are made in a transaction. The counters are not updated row by row but reconciled
+    once at the end.
+
+    Args:
+        checks (list): names of the checks to run, all of them by default.
+        fix (iterable): names of the checks to fix.
+        limit (int): maximum number of rows reported per check.
+
+    Raises:
+        ValueError: if a check is unknown or can't be fixed.
+
+    Returns:
+        dict: for every check, its description, the number of rows found, a sample of them and
+            the number of rows fixed.
+    """
+    checks = list(checks or CHECKS)
+    for name in set(checks) | set(fix):
+        if name not in CHECKS:
+            raise ValueError("Unknown check {}".format(name))
+    for name in fix:
+        if CHECKS[name][2] is None:
+            raise ValueError("The check {} can't be fixed".format(name))
+    report = {}
+    with transaction.atomic(), paused():
+        for name in checks:
+            description, function, fixer = CHECKS[name]
+            queryset = function()
+            report[name] = {
+                "description": description,
+                "count": queryset.count(),
+                "sample": list(queryset.order_by("pk")[:limit]),
+                "fixed": 0,
+            }
+            if name in fix and report[name]["count"]:
+                report[name]["fixed"] = fixer(queryset)
+        if any(report[name]["fixed"] for name in report):
+            reconcile()
+    return report
@@ -0,0 +1,347 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Benchmark helpers for DinoMail.
+"""
+import importlib
+import itertools
+import math
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .counters import reconcile
+from .models import VirtualAlias, VirtualDomain, VirtualUser
+from .records import parse_dkim, parse_dmarc, parse_spf
+from .registry import changed
+from .resolver import FakeResolver, use_resolver
+
+# Micro-benchmarks indexed by name, see register
+BENCHMARKS = {}
+
+# Modules containing password schemes. Modules with missing dependencies are skipped.
+PASSWORD_MODULES = (
+    "core.utils",
+    "core.utils_argon",
+    "core.utils_bcrypt",
+    "core.utils_passlib",
+)
+
+SYNTHETIC_DKIM_KEY = (
+    "MIGfMA0GCSqGSIb3DQEBAQUAA4GNADCBiQKBgQCvpQbUZ8dCf3HDS/2QamqX670ip0Jbb/qxJCXwVzy7G"
+    "+NyvkAtDjkKSwBpcoWZMX1LvZpY+q78Fxl1f6PjZpEDs16Yy8lI6P0a18eD5Sk5LAnnSoggIWfKwOhYh"
+    "EXrwVIdqG0wm19QnvuiVkDkH3KEORmPRC74RYIz8NYb+A9wTwIDAQAB"
+)
+
+
+def percentile(samples, pct):
+    """Return a percentile of samples using the nearest-rank method.
+
+    Args:
+        samples (list): sorted list of values.
+        pct (float): percentile, between 0 and 100.
+
+    Returns:
+        float: the percentile, or 0 if there is no sample.
+    """
+    if not samples:
+        return 0
+    rank = max(int(math.ceil(pct / 100 * len(samples))), 1)
+    return samples[rank - 1]
+
+
+def summarize(samples, elapsed):
+    """Summarize latency samples.
+
+    Args:
+        samples (list): latencies in seconds.
+        elapsed (float): wall clock time in seconds to collect the samples.
+
+    Returns:
+        dict: count, throughput (per second) and latency statistics in milliseconds.
+    """
+    samples = sorted(samples)
+    count = len(samples)
+    return {
+        "count": count,
+        "elapsed": elapsed,
+        "throughput": count / elapsed if elapsed else 0,
+        "mean": 1000 * sum(samples) / count if count else 0,
+        "p50": 1000 * percentile(samples, 50),
+        "p95": 1000 * percentile(samples, 95),
+        "p99": 1000 * percentile(samples, 99),
+        "max": 1000 * samples[-1] if count else 0,
+    }
+
+
+def synthetic_zone(count, resolver=None):
+    """Build synthetic domains and the fake zone serving their records.
+
+    Every domain has a DKIM, a DMARC and a SPF record. The domains are not saved.
+
+    Args:
+        count (int): number of domains.
+        resolver (FakeResolver): zone to populate. A new one is created if not given.
+
+    Returns:
+        tuple: the resolver and the list of virtual domains.
+    """
+    resolver = resolver or FakeResolver()
+    domains = []
+    for i in range(count):
+        name = "domain{}.bench.test".format(i)
+        resolver.add_txt(
+            "bench._domainkey.{}".format(name),
+            "v=DKIM1; k=rsa; p={}".format(SYNTHETIC_DKIM_KEY),
+        )
+        resolver.add_txt("_dmarc.{}".format(name), "v=DMARC1; p=none")
+        resolver.add_txt(name, "v=spf1 mx -all")
+        domains.append(
+            VirtualDomain(name=name, dkim_key_name="bench", dkim_key=SYNTHETIC_DKIM_KEY)
+        )
+    return resolver, domains
+
+
+def scan_domain(domain):
+    """Run the DKIM, DMARC and SPF checks of a domain without saving it.
+
+    Args:
+        domain (VirtualDomain): the domain to scan.
+
+    Returns:
+        float: time spent, in seconds.
+    """
+    start = time.perf_counter()
+    domain.verify_dkim()
+    domain.verify_dmarc()
+    domain.verify_spf()
+    return time.perf_counter() - start
+
+
+def benchmark_scan(resolver, domains, concurrency):
+    """Scan domains with a pool of threads and measure it.
+
+    Args:
+        resolver (object): resolver to use during the scan.
+        domains (list): virtual domains to scan.
+        concurrency (int): number of threads.
+
+    Returns:
+        dict: summary of the scan latencies (see summarize).
+    """
+    with use_resolver(resolver):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            samples = list(executor.map(scan_domain, domains))
+        elapsed = time.perf_counter() - start
+    return summarize(samples, elapsed)
+
+
+def register(name):
+    """Register a micro-benchmark.
+
+    The decorated function receives the seeded data (see seed_directory) and returns the
+    function to measure, which is called without arguments.
+
+    Args:
+        name (string): name of the benchmark, as group.case.
+
+    Returns:
+        function: the decorator.
+    """
+
+    def decorator(function):
+        BENCHMARKS[name] = function
+        return function
+
+    return decorator
+
+
+def seed_directory(domains=10, users=200, aliases=200, seed=0):
+    """Create a reproducible set of domains, users and aliases.
+
+    Alias destinations are a mix of users, other aliases, exterior addresses and addresses that
+    don't exist.
+
+    Args:
+        domains (int): number of domains.
+        users (int): number of users.
+        aliases (int): number of aliases.
+        seed (int): random seed.
+
+    Returns:
+        dict: lists of the created domains, users and aliases.
+    """
+    rng = random.Random(seed)
+    names = ["domain{}.bench.test".format(i) for i in range(domains)]
+    VirtualDomain.objects.bulk_create([VirtualDomain(name=name) for name in names])
+    changed()
+    # Primary keys are not set by bulk_create on every database backend
+    domain_list = list(VirtualDomain.objects.filter(name__in=names).order_by("pk"))
+    user_list = []
+    for i in range(users):
+        domain = rng.choice(domain_list)
+        user_list.append(
+            VirtualUser(
+                domain=domain,
+                email="user{}@{}".format(i, domain.name),
+                password="{PLAIN}bench",
+                quota=rng.randrange(10**10),
+            )
+        )
+    VirtualUser.objects.bulk_create(user_list)
+    alias_list = []
+    for i in range(aliases):
+        domain = rng.choice(domain_list)
+        kind = rng.random()
+        if kind < 0.5 and user_list:
+            destination = rng.choice(user_list).email
+        elif kind < 0.7 and alias_list:
+            destination = rng.choice(alias_list).source
+        elif kind < 0.9:
+            destination = "someone{}@exterior.test".format(i)
+        else:
+            destination = "missing{}@{}".format(i, rng.choice(domain_list).name)
+        alias_list.append(
+            VirtualAlias(
+                domain=domain,
+                source="alias{}@{}".format(i, domain.name),
+                destination=destination,
+            )
+        )
+    VirtualAlias.objects.bulk_create(alias_list)
+    reconcile()
+    return {"domains": domain_list, "users": user_list, "aliases": alias_list}
+
+
+def run_benchmark(function, max_rounds=1000, max_time=0.5, min_rounds=5):
+    """Measure a function.
+
+    The function is called once to warm up, then until max_rounds calls or max_time seconds are
+    reached (but at least min_rounds times), so that slow password schemes stay fast to measure.
+
+    Args:
+        function (function): function to measure, called without arguments.
+        max_rounds (int): maximum number of calls.
+        max_time (float): time budget in seconds.
+        min_rounds (int): minimum number of calls.
+
+    Returns:
+        dict: summary of the latencies (see summarize).
+    """
+    function()
+    samples = []
+    start = time.perf_counter()
+    while len(samples) < max_rounds:
+        call_start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - call_start)
+        if len(samples) >= min_rounds and call_start - start > max_time:
+            break
+    return summarize(samples, time.perf_counter() - start)
+
+
+def compare_results(old, new, threshold=10, metric="p50"):
+    """Compare two benchmark runs.
+
+    Args:
+        old (dict): results of the reference run, indexed by benchmark name.
+        new (dict): results of the new run, indexed by benchmark name.
+        threshold (float): slowdown, in percent, above which a benchmark is a regression.
+        metric (string): statistic compared (mean, p50, p95, ...).
+
+    Returns:
+        list: (name, old value, new value, change in percent, regression) tuples for the benchmarks of both runs.
+    """
+    rows = []
+    for name in sorted(set(old) & set(new)):
+        before = old[name][metric]
+        after = new[name][metric]
+        change = 100 * (after - before) / before if before else 0
+        rows.append((name, before, after, change, change > threshold))
+    return rows
+
+
+def _register_password_schemes():
+    for module_name in PASSWORD_MODULES:
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError:
+            continue
+        for function_name in sorted(dir(module)):
+            if not function_name.startswith("make_password_"):
+                continue
+            function = getattr(module, function_name)
+
+            def benchmark(data, function=function):
+                return lambda: function("correct horse battery staple")
+
+            register("password.{}".format(function_name[len("make_password_") :]))(
+                benchmark
+            )
+
+
+_register_password_schemes()
+
+
+@register("records.parse_dkim")
+def benchmark_parse_dkim(data):
+    record = "v=DKIM1; k=rsa; p={}".format(SYNTHETIC_DKIM_KEY)
+    return lambda: parse_dkim(record)
+
+
+@register("records.parse_dmarc")
+def benchmark_parse_dmarc(data):
+    record = "v=DMARC1; p=quarantine; rua=mailto:dmarc@example.com; pct=100; adkim=s"
+    return lambda: parse_dmarc(record)
+
+
+@register("records.parse_spf")
+def benchmark_parse_spf(data):
+    record = (
+        "v=spf1 mx a:mail.example.com ip4:192.0.2.0/24 include:_spf.example.net -all"
+    )
+    return lambda: parse_spf(record)
+
+
+@register("user.clean")
+def benchmark_user_clean(data):
+    users = itertools.cycle(data["users"])
+    return lambda: next(users).clean()
+
+
+@register("user.readable_quota")
+def benchmark_readable_quota(data):
+    users = itertools.cycle(data["users"])
+    return lambda: next(users).readable_quota()
+
+
+@register("alias.clean")
+def benchmark_alias_clean(data):
+    aliases = itertools.cycle(data["aliases"])
+    return lambda: next(aliases).clean()
+
+
+@register("alias.exterior")
+def benchmark_alias_exterior(data):
+    aliases = itertools.cycle(data["aliases"])
+    return lambda: next(aliases).exterior()
+
+
+@register("alias.verify")
+def benchmark_alias_verify(data):
+    aliases = itertools.cycle(data["aliases"])
+    return lambda: next(aliases).verify()
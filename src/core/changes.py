@@ -0,0 +1,276 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Append-only feed of the changes of domains, users and aliases.
+
+Every create, update and delete of a domain, a user or an alias appends a change with the
+fields of the object (see core.signals, bulk writes call record_many). Sequence numbers are
+taken from the single row of ChangeFeed, which stays locked until the transaction commits, so
+changes become visible in the order of their sequence numbers and a consumer never misses one
+by reading past it.
+
+Consumers read the changes after the last sequence number they processed (GET /api/changes).
+Compaction removes the changes superseded by a later change of the same object, and the
+deletions older than a retention time. Consumers behind the last removed deletion must
+download everything again.
+"""
+import datetime
+import itertools
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, F, Max, OuterRef
+from django.utils import timezone
+
+from .models import Change, ChangeFeed, VirtualAlias, VirtualDomain, VirtualUser
+
+# Fields published for each kind of object. Passwords and private keys are never published.
+FEED_FIELDS = {
+    "virtualdomain": (
+        "name",
+        "display_name",
+        "short_display_name",
+        "imap_address",
+        "pop_address",
+        "smtp_address",
+        "dkim_key_name",
+        "dkim_key",
+        "dkim_key_type",
+        "dkim_next_key_name",
+        "dkim_next_key",
+        "dkim_next_key_type",
+        "max_users",
+        "max_aliases",
+        "max_quota",
+        "deleting",
+    ),
+    "virtualuser": ("email", "domain", "quota"),
+    "virtualalias": ("source", "destination", "domain"),
+}
+
+FEED_MODELS = (VirtualDomain, VirtualUser, VirtualAlias)
+
+
+def get_page_size():
+    """Return the maximum number of changes returned at once.
+
+    Returns:
+        int: DINOMAIL_CHANGES_PAGE_SIZE, 1000 by default.
+    """
+    return getattr(settings, "DINOMAIL_CHANGES_PAGE_SIZE", 1000)
+
+
+def get_max_wait():
+    """Return the maximum time a consumer waits for new changes.
+
+    Returns:
+        float: DINOMAIL_CHANGES_MAX_WAIT in seconds, 30 by default.
+    """
+    return getattr(settings, "DINOMAIL_CHANGES_MAX_WAIT", 30)
+
+
+def get_poll_interval():
+    """Return the time between two checks for new changes of a waiting consumer.
+
+    Returns:
+        float: DINOMAIL_CHANGES_POLL_INTERVAL in seconds, 1 by default.
+    """
+    return getattr(settings, "DINOMAIL_CHANGES_POLL_INTERVAL", 1)
+
+
+def get_retention():
+    """Return the number of days deletions are kept by compaction.
+
+    Returns:
+        int: DINOMAIL_CHANGES_RETENTION, 7 by default.
+    """
+    return getattr(settings, "DINOMAIL_CHANGES_RETENTION", 7)
+
+
+def get_feed():
+    """Return the state of the feed, created if missing.
+
+    Returns:
+        ChangeFeed: the feed.
+    """
+    feed = ChangeFeed.objects.filter(pk=1).first()
+    if feed is None:
+        feed, _ = ChangeFeed.objects.get_or_create(pk=1)
+    return feed
+
+
+def snapshot(instance):
+    """Return the published fields of a domain, a user or an alias.
+
+    Args:
+        instance (Model): the object.
+
+    Returns:
+        dict: the values indexed by field name, related objects as primary keys.
+    """
+    return {
+        name: instance._meta.get_field(name).value_from_object(instance)
+        for name in FEED_FIELDS[instance._meta.model_name]
+    }
+
+
+def _reserve(count):
+    """Reserve sequence numbers, the row of the feed stays locked until the commit.
+
+    Args:
+        count (int): number of sequence numbers.
+
+    Returns:
+        int: the last reserved sequence number.
+    """
+    # The row lock orders the sequence numbers as the commits
+    if not ChangeFeed.objects.filter(pk=1).update(sequence=F("sequence") + count):
+        get_feed()
+        ChangeFeed.objects.filter(pk=1).update(sequence=F("sequence") + count)
+    return ChangeFeed.objects.values_list("sequence", flat=True).get(pk=1)
+
+
+def record(instance, action, update_fields=None):
+    """Append a change of a domain, a user or an alias to the feed.
+
+    Args:
+        instance (Model): the object.
+        action (string): Change.CREATE, Change.UPDATE or Change.DELETE.
+        update_fields (iterable): fields saved, to ignore the saves of unpublished fields.
+
+    Returns:
+        Change: the change, None if nothing published changed.
+    """
+    kind = instance._meta.model_name
+    if update_fields and not set(update_fields) & set(FEED_FIELDS[kind]):
+        return None
+    with transaction.atomic():
+        return Change.objects.create(
+            sequence=_reserve(1),
+            kind=kind,
+            object_id=instance.pk,
+            action=action,
+            data=snapshot(instance),
+        )
+
+
+def record_many(instances, action, batch_size=1000):
+    """Append the changes of several objects to the feed.
+
+    Bulk writes (bulk_create, bulk_update, QuerySet.update) don't send signals, so their callers
+    record the changes with this function. Sequence numbers are reserved by batch.
+
+    Args:
+        instances (iterable): the objects, with their primary keys.
+        action (string): Change.CREATE, Change.UPDATE or Change.DELETE.
+        batch_size (int): number of changes per insert.
+
+    Returns:
+        int: number of changes recorded.
+    """
+    count = 0
+    iterator = iter(instances)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return count
+        with transaction.atomic():
+            first = _reserve(len(batch)) - len(batch) + 1
+            Change.objects.bulk_create(
+                Change(
+                    sequence=first + i,
+                    kind=instance._meta.model_name,
+                    object_id=instance.pk,
+                    action=action,
+                    data=snapshot(instance),
+                )
+                for i, instance in enumerate(batch)
+            )
+        count += len(batch)
+
+
+def read_changes(since, kinds=None, limit=None):
+    """Return the changes after a sequence number.
+
+    Args:
+        since (int): last sequence number processed by the consumer.
+        kinds (iterable): kinds of objects returned, all by default.
+        limit (int): maximum number of changes, default is get_page_size().
+
+    Returns:
+        dict: the changes (list of Change), the sequence number to give next time (next), the
+            last sequence number (latest), the horizon and whether more changes are waiting (more).
+    """
+    limit = min(limit or get_page_size(), get_page_size())
+    feed = get_feed()
+    queryset = Change.objects.filter(sequence__gt=since, sequence__lte=feed.sequence)
+    if kinds is not None:
+        queryset = queryset.filter(kind__in=kinds)
+    changes = list(queryset.order_by("sequence")[: limit + 1])
+    more = len(changes) > limit
+    changes = changes[:limit]
+    return {
+        "changes": changes,
+        "next": changes[-1].sequence if more else max(since, feed.sequence),
+        "latest": feed.sequence,
+        "horizon": feed.horizon,
+        "more": more,
+    }
+
+
+def compact(retention=None, chunk_size=10000):
+    """Remove the superseded changes and the old deletions.
+
+    A change is superseded by a later change of the same object: consumers replaying the feed
+    only need the last state of each object. Deletions older than the retention are removed
+    too, and the horizon moves to the last of them.
+
+    The changes are removed by ranges of sequence numbers, each in its own short transaction.
+
+    Args:
+        retention (int): number of days deletions are kept, default is get_retention().
+        chunk_size (int): number of sequence numbers per transaction.
+
+    Returns:
+        dict: number of superseded changes and deletions removed, and the horizon.
+    """
+    retention = get_retention() if retention is None else retention
+    result = {"superseded": 0, "deletions": 0}
+    last = Change.objects.aggregate(last=Max("sequence"))["last"] or 0
+    later = Change.objects.filter(
+        kind=OuterRef("kind"),
+        object_id=OuterRef("object_id"),
+        sequence__gt=OuterRef("sequence"),
+    )
+    for start in range(0, last, chunk_size):
+        with transaction.atomic():
+            deleted, _ = (
+                Change.objects.filter(
+                    sequence__gt=start, sequence__lte=start + chunk_size
+                )
+                .filter(Exists(later))
+                .delete()
+            )
+        result["superseded"] += deleted
+    limit = timezone.now() - datetime.timedelta(days=retention)
+    with transaction.atomic():
+        deletions = Change.objects.filter(action=Change.DELETE, created__lt=limit)
+        horizon = deletions.aggregate(last=Max("sequence"))["last"]
+        if horizon is not None:
+            result["deletions"], _ = deletions.filter(sequence__lte=horizon).delete()
+            ChangeFeed.objects.filter(pk=1, horizon__lt=horizon).update(horizon=horizon)
+    result["horizon"] = get_feed().horizon
+    return result
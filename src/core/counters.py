@@ -0,0 +1,193 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Counters of domains, users, aliases and allocated quota.
+
+Counters are updated in the transaction changing the users and aliases (see core.signals), so
+reading them costs a single query whatever the size of the directory. Bulk operations
+(bulk_create, QuerySet.update, raw SQL) bypass them: call reconcile afterwards.
+"""
+import contextlib
+import contextvars
+
+from django.db.models import Count, F, Sum
+
+from .models import (
+    DomainCounter,
+    GlobalCounter,
+    VirtualAlias,
+    VirtualDomain,
+    VirtualUser,
+)
+
+FIELDS = ("users", "aliases", "quota")
+
+GLOBAL_FIELDS = ("domains",) + FIELDS
+
+_paused = contextvars.ContextVar("counters_paused", default=False)
+
+
+@contextlib.contextmanager
+def paused():
+    """Context manager disabling the updates of the counters by the signals.
+
+    It avoids two queries per row in bulk operations. Call reconcile at the end of the operation.
+    """
+    token = _paused.set(True)
+    try:
+        yield
+    finally:
+        _paused.reset(token)
+
+
+def is_paused():
+    """Test if the updates of the counters are paused.
+
+    Returns:
+        bool: True inside paused.
+    """
+    return _paused.get()
+
+
+def count_domain(domain_id):
+    """Count the users, aliases and allocated quota of a domain.
+
+    Args:
+        domain_id (int): primary key of the domain.
+
+    Returns:
+        dict: users, aliases and quota.
+    """
+    users = VirtualUser.objects.filter(domain_id=domain_id).aggregate(
+        users=Count("pk"), quota=Sum("quota")
+    )
+    return {
+        "users": users["users"],
+        "aliases": VirtualAlias.objects.filter(domain_id=domain_id).count(),
+        "quota": users["quota"] or 0,
+    }
+
+
+def count_global():
+    """Count the domains, users, aliases and allocated quota.
+
+    Returns:
+        dict: domains, users, aliases and quota.
+    """
+    users = VirtualUser.objects.aggregate(users=Count("pk"), quota=Sum("quota"))
+    return {
+        "domains": VirtualDomain.objects.count(),
+        "users": users["users"],
+        "aliases": VirtualAlias.objects.count(),
+        "quota": users["quota"] or 0,
+    }
+
+
+def get_global_counter():
+    """Return the global counters, created if missing.
+
+    Returns:
+        GlobalCounter: the counters.
+    """
+    counter = GlobalCounter.objects.order_by("pk").first()
+    if counter is None:
+        counter = GlobalCounter.objects.create(**count_global())
+    return counter
+
+
+def update_counters(domain_id=None, domains=0, users=0, aliases=0, quota=0):
+    """Add deltas to the counters of a domain and to the global counters.
+
+    The counters are updated with F expressions, so concurrent updates don't overwrite each
+    other. Missing global counters are created from the current content of the database, missing
+    domain counters are left to reconcile (the domain may be being deleted).
+
+    Args:
+        domain_id (int): primary key of the domain, None to only update the global counters.
+        domains (int): change of the number of domains.
+        users (int): change of the number of users.
+        aliases (int): change of the number of aliases.
+        quota (int): change of the allocated quota.
+    """
+    deltas = {"users": users, "aliases": aliases, "quota": quota}
+    changes = {name: F(name) + value for name, value in deltas.items() if value}
+    if domain_id is not None and changes:
+        DomainCounter.objects.filter(domain_id=domain_id).update(**changes)
+    if domains:
+        changes["domains"] = F("domains") + domains
+    if changes and not GlobalCounter.objects.update(**changes):
+        get_global_counter()
+
+
+def reconcile(fix=True):
+    """Recompute the counters and fix the ones that drifted.
+
+    Args:
+        fix (bool): if False, counters are only compared.
+
+    Returns:
+        list: (domain name or None for the global counters, field, stored value, actual value)
+            tuples of the drifted counters. The stored value is None for missing counters.
+    """
+    names = dict(VirtualDomain.objects.values_list("pk", "name").iterator())
+    actual = {pk: dict.fromkeys(FIELDS, 0) for pk in names}
+    for row in VirtualUser.objects.values("domain_id").annotate(
+        users=Count("pk"), quota=Sum("quota")
+    ):
+        if row["domain_id"] in actual:
+            actual[row["domain_id"]].update(users=row["users"], quota=row["quota"] or 0)
+    for row in VirtualAlias.objects.values("domain_id").annotate(aliases=Count("pk")):
+        if row["domain_id"] in actual:
+            actual[row["domain_id"]]["aliases"] = row["aliases"]
+
+    drifts = []
+    changed = []
+    for counter in DomainCounter.objects.iterator():
+        values = actual.pop(counter.domain_id, None)
+        if values is None:
+            continue
+        fields = [name for name in FIELDS if getattr(counter, name) != values[name]]
+        for name in fields:
+            drifts.append(
+                (names[counter.domain_id], name, getattr(counter, name), values[name])
+            )
+            setattr(counter, name, values[name])
+        if fields:
+            changed.append(counter)
+    for domain_id, values in actual.items():
+        drifts += [(names[domain_id], name, None, values[name]) for name in FIELDS]
+
+    counter = GlobalCounter.objects.order_by("pk").first()
+    totals = count_global()
+    for name in GLOBAL_FIELDS:
+        stored = getattr(counter, name) if counter else None
+        if stored != totals[name]:
+            drifts.append((None, name, stored, totals[name]))
+
+    if fix:
+        DomainCounter.objects.bulk_update(changed, FIELDS, batch_size=1000)
+        DomainCounter.objects.bulk_create(
+            [
+                DomainCounter(domain_id=domain_id, **values)
+                for domain_id, values in actual.items()
+            ],
+            batch_size=1000,
+        )
+        if counter is None:
+            GlobalCounter.objects.create(**totals)
+        else:
+            GlobalCounter.objects.filter(pk=counter.pk).update(**totals)
+    return drifts
@@ -0,0 +1,55 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+View decorators for the async views of DinoMail.
+
+The decorators of django.contrib.auth only wrap sync views in Django 3.2. The user and its
+permissions are loaded from the database, so they are checked in a thread.
+"""
+import functools
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.views import redirect_to_login
+
+
+def _has_perms(request, perms):
+    user = request.user
+    return user.is_authenticated and user.has_perms(perms)
+
+
+def async_permission_required(*perms):
+    """Decorator for async views checking that the user is logged in and has permissions.
+
+    Like login_required and permission_required, anonymous users and users without the
+    permissions are redirected to the login page.
+
+    Args:
+        *perms (string): permissions, as app_label.codename.
+
+    Returns:
+        function: the decorator.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if not await sync_to_async(_has_perms)(request, perms):
+                return redirect_to_login(request.get_full_path())
+            return await view(request, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,181 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Deletion of domains in background.
+
+Deleting a domain with django deletes its users, aliases and DMARC reports in a single
+transaction, after loading all of them in memory. Large domains are instead marked as deleting,
+and their rows are deleted by bounded chunks by a background job (see core.jobs) or the
+process_domain_deletions command, each chunk in its own short transaction.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Sum
+
+from .counters import paused, update_counters
+from .jobs import enqueue, handler
+from .models import (
+    DmarcAggregate,
+    DmarcReport,
+    DomainCounter,
+    VirtualAlias,
+    VirtualDomain,
+    VirtualUser,
+)
+
+# Models deleted with their domain, in order
+DEPENDENTS = (VirtualAlias, VirtualUser, DmarcAggregate, DmarcReport)
+
+
+def get_chunk_size():
+    """Return the number of rows deleted per chunk.
+
+    Returns:
+        int: DINOMAIL_DELETION_CHUNK_SIZE, 1000 by default.
+    """
+    return getattr(settings, "DINOMAIL_DELETION_CHUNK_SIZE", 1000)
+
+
+def request_deletion(domain, user=None):
+    """Delete a domain, or mark it as deleting if it is too large to be deleted at once.
+
+    The rows of a domain marked as deleting are deleted by a delete_domain job.
+
+    Args:
+        domain (VirtualDomain): the domain.
+        user (User): user requesting the deletion, recorded in the job.
+
+    Returns:
+        bool: True if the domain was deleted, False if it will be deleted in background.
+    """
+    counter = DomainCounter.objects.filter(domain=domain).first()
+    total = counter.users + counter.aliases if counter else None
+    if total is not None and total <= get_chunk_size():
+        domain.delete()
+        return True
+    if total is None:
+        total = sum(
+            model.objects.filter(domain=domain).count() for model in DEPENDENTS[:2]
+        )
+    domain.deleting = True
+    domain.deletion_total = total
+    domain.deletion_done = 0
+    domain.save()
+    enqueue("delete_domain", user=user, domain=domain.pk)
+    return False
+
+
+def delete_chunk(domain_id, chunk_size=None):
+    """Delete a chunk of the rows of a domain being deleted, or the domain once empty.
+
+    The domain row is locked during the chunk, so several workers can process deletions.
+
+    Args:
+        domain_id (int): primary key of the domain.
+        chunk_size (int): maximum number of rows deleted.
+
+    Returns:
+        int: number of rows deleted, 0 if the domain was deleted, None if the domain is not
+            being deleted.
+    """
+    chunk_size = chunk_size or get_chunk_size()
+    with transaction.atomic():
+        domain = (
+            VirtualDomain.objects.select_for_update()
+            .filter(pk=domain_id, deleting=True)
+            .first()
+        )
+        if domain is None:
+            return None
+        for model in DEPENDENTS:
+            pks = list(
+                model.objects.filter(domain=domain)
+                .order_by("pk")
+                .values_list("pk", flat=True)[:chunk_size]
+            )
+            if not pks:
+                continue
+            queryset = model.objects.filter(pk__in=pks)
+            if model is VirtualUser:
+                totals = queryset.aggregate(users=Count("pk"), quota=Sum("quota"))
+                changes = {"users": -totals["users"], "quota": -(totals["quota"] or 0)}
+            elif model is VirtualAlias:
+                changes = {"aliases": -len(pks)}
+            else:
+                changes = {}
+            with paused():
+                queryset.delete()
+            update_counters(domain.pk, **changes)
+            if model in (VirtualUser, VirtualAlias):
+                VirtualDomain.objects.filter(pk=domain.pk).update(
+                    deletion_done=F("deletion_done") + len(pks)
+                )
+            return len(pks)
+        domain.delete()
+    return 0
+
+
+def process_deletions(chunk_size=None, max_chunks=None):
+    """Delete the domains marked as deleting, chunk by chunk.
+
+    Args:
+        chunk_size (int): maximum number of rows deleted per chunk.
+        max_chunks (int): maximum number of chunks processed, unlimited by default.
+
+    Returns:
+        dict: number of chunks processed, rows deleted and domains deleted.
+    """
+    result = {"chunks": 0, "rows": 0, "domains": 0}
+    for domain_id in VirtualDomain.objects.filter(deleting=True).values_list(
+        "pk", flat=True
+    ):
+        while max_chunks is None or result["chunks"] < max_chunks:
+            deleted = delete_chunk(domain_id, chunk_size)
+            if deleted is None:
+                break
+            result["chunks"] += 1
+            if not deleted:
+                result["domains"] += 1
+                break
+            result["rows"] += deleted
+    return result
+
+
+@handler("delete_domain")
+def delete_domain(job, domain, chunk_size=None):
+    """Delete a domain marked as deleting, chunk by chunk.
+
+    Args:
+        job (Job): the job.
+        domain (int): primary key of the domain.
+        chunk_size (int): maximum number of rows deleted per chunk.
+
+    Returns:
+        dict: number of chunks processed and rows deleted, and whether the domain was deleted.
+    """
+    result = {"chunks": 0, "rows": 0, "deleted": False}
+    while True:
+        deleted = delete_chunk(domain, chunk_size)
+        if deleted is None:
+            return result
+        result["chunks"] += 1
+        if not deleted:
+            result["deleted"] = True
+            return result
+        result["rows"] += deleted
+        current = VirtualDomain.objects.filter(pk=domain).first()
+        if current is not None:
+            job.set_progress(current.deletion_progress(), current.name)
@@ -0,0 +1,185 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+DKIM key utils for DinoMail. Key generation requires cryptography, which is imported on first use.
+"""
+import base64
+import hashlib
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+
+KEY_TYPES = ("rsa", "ed25519")
+
+STATE_FILE = ".dinomail-state.json"
+
+
+def generate_key_pair(key_type="rsa", bits=2048):
+    """Generate a DKIM key pair.
+
+    Args:
+        key_type (string): rsa or ed25519.
+        bits (int): size of RSA keys.
+
+    Raises:
+        ValueError: if the key type is not supported.
+
+    Returns:
+        tuple: private key (PEM, PKCS8) and public key as published in the p tag of the DKIM record.
+    """
+    # pylint: disable=import-outside-toplevel
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+
+    if key_type == "rsa":
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=bits)
+        public_key = private_key.public_key().public_bytes(
+            serialization.Encoding.DER,
+            serialization.PublicFormat.SubjectPublicKeyInfo,
+        )
+    elif key_type == "ed25519":
+        private_key = ed25519.Ed25519PrivateKey.generate()
+        public_key = private_key.public_key().public_bytes(
+            serialization.Encoding.Raw, serialization.PublicFormat.Raw
+        )
+    else:
+        raise ValueError("Unsupported DKIM key type {}".format(key_type))
+    private_pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+    return private_pem.decode("ascii"), base64.b64encode(public_key).decode("ascii")
+
+
+def _generate(spec):
+    return generate_key_pair(*spec)
+
+
+def generate_key_pairs(count, key_type="rsa", bits=2048, processes=None):
+    """Generate several DKIM key pairs with a pool of processes.
+
+    RSA key generation is CPU bound, so it is spread over processes.
+
+    Args:
+        count (int): number of key pairs.
+        key_type (string): rsa or ed25519.
+        bits (int): size of RSA keys.
+        processes (int): number of processes (default is the number of CPUs, 1 to generate in this process).
+
+    Returns:
+        list: (private key, public key) tuples.
+    """
+    specs = [(key_type, bits)] * count
+    if processes == 1 or count < 2:
+        return [_generate(spec) for spec in specs]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(_generate, specs, chunksize=8))
+
+
+def selector_name(date, used=()):
+    """Build a selector name from a date, as YYYYMMDDNN.
+
+    Args:
+        date (date): date of the key.
+        used (iterable): selectors that must not be returned.
+
+    Returns:
+        string: the first free selector of the day.
+    """
+    for index in range(1, 100):
+        name = "{:%Y%m%d}{:02d}".format(date, index)
+        if name not in used:
+            return name
+    raise ValueError("No free selector for {}".format(date))
+
+
+def _write_atomic(path, content, mode=0o644):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def export_opendkim(directory, keys):
+    """Export keys as OpenDKIM KeyTable, SigningTable and private key files.
+
+    Only the key files of domains whose key changed since the last export are written. A state
+    file keeps the hash of the exported keys. Tables are rewritten (atomically) only if their
+    content changes.
+
+    Args:
+        directory (string): OpenDKIM configuration directory.
+        keys (iterable): (domain, selector, private key) tuples.
+
+    Returns:
+        dict: number of key files written and removed and list of tables rewritten.
+    """
+    state_path = os.path.join(directory, STATE_FILE)
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+    new_state = {}
+    key_table = []
+    signing_table = []
+    written = 0
+    for domain, selector, private_key in sorted(keys):
+        path = os.path.join(directory, "keys", domain, "{}.private".format(selector))
+        digest = hashlib.sha256(private_key.encode("utf-8")).hexdigest()
+        new_state[domain] = {"selector": selector, "hash": digest}
+        if state.get(domain) != new_state[domain] or not os.path.exists(path):
+            _write_atomic(path, private_key, 0o600)
+            written += 1
+        key_name = "{}._domainkey.{}".format(selector, domain)
+        key_table.append("{} {}:{}:{}\n".format(key_name, domain, selector, path))
+        signing_table.append("{} {}\n".format(domain, key_name))
+
+    removed = 0
+    for domain, old in state.items():
+        if new_state.get(domain, {}).get("selector") != old["selector"]:
+            path = os.path.join(
+                directory, "keys", domain, "{}.private".format(old["selector"])
+            )
+            if os.path.exists(path):
+                os.unlink(path)
+                removed += 1
+
+    tables = []
+    for name, lines in (("KeyTable", key_table), ("SigningTable", signing_table)):
+        path = os.path.join(directory, name)
+        content = "".join(lines)
+        try:
+            with open(path) as f:
+                unchanged = f.read() == content
+        except OSError:
+            unchanged = False
+        if not unchanged:
+            _write_atomic(path, content)
+            tables.append(name)
+    if new_state != state:
+        _write_atomic(state_path, json.dumps(new_state, sort_keys=True), 0o600)
+    return {"written": written, "removed": removed, "tables": tables}
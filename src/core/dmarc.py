@@ -0,0 +1,232 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Parsing of DMARC aggregate (RUA) reports.
+
+The functions of this module don't use the database, so they can run in worker processes.
+"""
+import datetime
+import email
+import email.policy
+import gzip
+import io
+import ipaddress
+import os
+import xml.etree.ElementTree as ElementTree
+import zipfile
+import zlib
+
+# Maximum size of a decompressed report, reports are untrusted and may be compression bombs
+MAX_PAYLOAD_SIZE = 64 * 1024 * 1024
+
+# Order of the counters of an aggregate
+COUNTERS = (
+    "messages",
+    "dkim_pass",
+    "spf_pass",
+    "dmarc_pass",
+    "quarantined",
+    "rejected",
+)
+
+
+class ParsedReport:
+    """Aggregated content of a DMARC report.
+
+    Attributes:
+        org_name (string): name of the organization sending the report.
+        report_id (string): identifier of the report.
+        domain (string): domain the report is about.
+        date (date): day the report starts.
+        rows (dict): list of counters (see COUNTERS) indexed by source IP.
+        warnings (list): problems of the rows that were skipped.
+    """
+
+    def __init__(self):
+        self.org_name = ""
+        self.report_id = ""
+        self.domain = ""
+        self.date = None
+        self.rows = {}
+        self.warnings = []
+
+
+def _text(element, path):
+    child = element.find(path)
+    if child is None or child.text is None:
+        return ""
+    return child.text.strip()
+
+
+def parse_report(fileobj):
+    """Parse a DMARC aggregate report.
+
+    The XML is parsed as a stream and records are dropped once counted, so memory does not
+    grow with the size of the report. Records without a valid source IP are skipped, with a
+    warning.
+
+    Args:
+        fileobj (file): binary file containing the XML report.
+
+    Raises:
+        xml.etree.ElementTree.ParseError: if the XML is malformed.
+
+    Returns:
+        ParsedReport: the aggregated report.
+    """
+    report = ParsedReport()
+    for _, element in ElementTree.iterparse(fileobj, events=("end",)):
+        tag = element.tag.rsplit("}", 1)[-1]
+        if tag == "report_metadata":
+            report.org_name = _text(element, "org_name")
+            report.report_id = _text(element, "report_id")
+            begin = _text(element, "date_range/begin")
+            if begin.isdigit():
+                report.date = datetime.datetime.fromtimestamp(
+                    int(begin), datetime.timezone.utc
+                ).date()
+            element.clear()
+        elif tag == "policy_published":
+            report.domain = _text(element, "domain").lower().rstrip(".")
+            element.clear()
+        elif tag == "record":
+            source_ip = _text(element, "row/source_ip")
+            try:
+                source_ip = str(ipaddress.ip_address(source_ip))
+            except ValueError:
+                report.warnings.append(
+                    "record with invalid source IP {!r} skipped".format(source_ip)
+                )
+                element.clear()
+                continue
+            count = _text(element, "row/count")
+            count = int(count) if count.isdigit() else 0
+            disposition = _text(element, "row/policy_evaluated/disposition")
+            dkim = _text(element, "row/policy_evaluated/dkim") == "pass"
+            spf = _text(element, "row/policy_evaluated/spf") == "pass"
+            row = report.rows.setdefault(source_ip, [0] * len(COUNTERS))
+            row[0] += count
+            row[1] += count if dkim else 0
+            row[2] += count if spf else 0
+            row[3] += count if dkim or spf else 0
+            row[4] += count if disposition == "quarantine" else 0
+            row[5] += count if disposition == "reject" else 0
+            element.clear()
+    return report
+
+
+def _read(fileobj, max_size):
+    data = fileobj.read(max_size + 1)
+    if len(data) > max_size:
+        raise ValueError("report larger than {} bytes".format(max_size))
+    return data
+
+
+def extract_payloads(name, data, max_size=MAX_PAYLOAD_SIZE):
+    """Extract the XML reports from a file content.
+
+    Reports are sent as XML, gzip or zip files, usually attached to an email.
+
+    Args:
+        name (string): name of the file (used to guess its type).
+        data (bytes): content of the file.
+        max_size (int): maximum size of a decompressed report.
+
+    Raises:
+        ValueError: if a decompressed report is larger than max_size.
+
+    Returns:
+        list: XML contents (bytes).
+    """
+    if data[:2] == b"\x1f\x8b":
+        with gzip.GzipFile(fileobj=io.BytesIO(data)) as f:
+            return [_read(f, max_size)]
+    if data[:4] == b"PK\x03\x04":
+        payloads = []
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            for info in archive.infolist():
+                if info.filename.lower().endswith(".xml"):
+                    with archive.open(info) as f:
+                        payloads.append(_read(f, max_size))
+        return payloads
+    if data.lstrip()[:1] == b"<":
+        return [data]
+    if name.lower().endswith(".eml") or b"content-type:" in data[:8192].lower():
+        message = email.message_from_bytes(data, policy=email.policy.default)
+        payloads = []
+        for part in message.walk():
+            if part.is_multipart():
+                continue
+            content = part.get_payload(decode=True)
+            if content and content != data:
+                payloads += extract_payloads(
+                    part.get_filename() or "", content, max_size
+                )
+        return payloads
+    return []
+
+
+def parse_file(path, max_size=MAX_PAYLOAD_SIZE):
+    """Parse all the reports contained in a file.
+
+    Args:
+        path (string): path of an XML, gzip or zip report, or of an email (maildir message) with reports attached.
+        max_size (int): maximum size of a decompressed report.
+
+    Returns:
+        tuple: list of ParsedReport and list of error messages.
+    """
+    reports = []
+    errors = []
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        for payload in extract_payloads(os.path.basename(path), data, max_size):
+            report = parse_report(io.BytesIO(payload))
+            reports.append(report)
+            errors += ["{}: {}".format(path, warning) for warning in report.warnings]
+    except (
+        OSError,
+        EOFError,
+        ValueError,
+        zlib.error,
+        zipfile.BadZipFile,
+        ElementTree.ParseError,
+    ) as e:
+        errors.append("{}: {}".format(path, e))
+    return reports, errors
+
+
+def find_report_files(paths):
+    """List the files that may contain reports.
+
+    Directories (including maildirs) are walked recursively.
+
+    Args:
+        paths (list): files and directories.
+
+    Returns:
+        list: paths of the files.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs[:] = [d for d in sorted(dirs) if d != "tmp"]
+                files += [os.path.join(root, name) for name in sorted(names)]
+        else:
+            files.append(path)
+    return files
@@ -31,12 +31,16 @@ class VirtualDomainForm(forms.ModelForm):
         fields = (
             "name",
             "dkim_key_name",
+            "dkim_key_type",
             "dkim_key",
             "display_name",
             "short_display_name",
             "imap_address",
             "pop_address",
             "smtp_address",
+            "max_users",
+            "max_aliases",
+            "max_quota",
         )
 
 
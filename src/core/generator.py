@@ -0,0 +1,182 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Generation of synthetic directories (domains, users and aliases) for performance tests.
+"""
+import array
+import itertools
+import random
+
+from django.db import transaction
+
+from .changes import record_many
+from .counters import reconcile
+from .models import Change, VirtualAlias, VirtualDomain, VirtualUser
+from .registry import changed
+from .utils import make_password
+
+QUOTAS = (0, 100000000, 1000000000, 5000000000, 10000000000)
+
+
+def skewed_counts(total, buckets, skew, rng):
+    """Split a total over buckets following a Zipf-like distribution.
+
+    Args:
+        total (int): number to split.
+        buckets (int): number of buckets.
+        skew (float): exponent of the distribution (0 for a uniform split).
+        rng (random.Random): random generator used to shuffle the buckets.
+
+    Returns:
+        list: count of every bucket, summing to total.
+    """
+    if not buckets:
+        return []
+    weights = [1 / (rank + 1) ** skew for rank in range(buckets)]
+    scale = total / sum(weights)
+    counts = [int(weight * scale) for weight in weights]
+    for i in range(total - sum(counts)):
+        counts[i % buckets] += 1
+    rng.shuffle(counts)
+    return counts
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def generate_directory(
+    domains,
+    users,
+    aliases,
+    seed=0,
+    skew=1.0,
+    chain_rate=0.2,
+    exterior_rate=0.2,
+    dangling_rate=0.05,
+    suffix="generated.test",
+    password="password",
+    batch_size=5000,
+):
+    """Create a synthetic directory.
+
+    Users and aliases are spread over the domains with a skewed distribution. Alias destinations
+    are users, earlier aliases (making chains), exterior addresses or addresses that don't exist.
+    All the users share a single password hash computed once, and rows are inserted with
+    bulk_create by batches, so the memory does not grow with the size of the directory. The same
+    seed always generates the same directory.
+
+    Args:
+        domains (int): number of domains.
+        users (int): average number of users per domain.
+        aliases (int): total number of aliases.
+        seed (int): random seed.
+        skew (float): exponent of the distribution of users and aliases over domains.
+        chain_rate (float): share of aliases pointing to another alias.
+        exterior_rate (float): share of aliases pointing to an exterior address.
+        dangling_rate (float): share of aliases pointing to a missing address of a managed domain.
+        suffix (string): parent domain of the generated domains (domain0.generated.test, ...).
+        password (string): password of all the users.
+        batch_size (int): number of rows per insert.
+
+    Returns:
+        dict: number of created domains, users and aliases.
+    """
+    rng = random.Random(seed)
+    names = ["domain{}.{}".format(i, suffix) for i in range(domains)]
+    user_counts = skewed_counts(domains * users, domains, skew, rng)
+    alias_counts = skewed_counts(aliases, domains, skew, rng)
+    password_hash = make_password(password)
+    populated = [i for i, count in enumerate(user_counts) if count]
+
+    with transaction.atomic():
+        VirtualDomain.objects.bulk_create(
+            (VirtualDomain(name=name) for name in names), batch_size=batch_size
+        )
+        ids = dict(
+            VirtualDomain.objects.filter(name__in=names).values_list("name", "pk")
+        )
+        domain_ids = [ids[name] for name in names]
+
+        def user_rows():
+            for i, count in enumerate(user_counts):
+                for j in range(count):
+                    yield VirtualUser(
+                        domain_id=domain_ids[i],
+                        email="user{}@{}".format(j, names[i]),
+                        password=password_hash,
+                        quota=rng.choice(QUOTAS),
+                    )
+
+        for batch in _batches(user_rows(), batch_size):
+            VirtualUser.objects.bulk_create(batch)
+
+        # Domain of every alias, to build chains on previous aliases
+        alias_domains = array.array("l")
+
+        def alias_rows():
+            for i, count in enumerate(alias_counts):
+                for _ in range(count):
+                    index = len(alias_domains)
+                    kind = rng.random()
+                    if kind < chain_rate and index:
+                        target = rng.randrange(index)
+                        destination = "alias{}@{}".format(
+                            target, names[alias_domains[target]]
+                        )
+                    elif kind < chain_rate + exterior_rate or not populated:
+                        destination = "user{}@exterior{}.test".format(
+                            rng.randrange(1000), rng.randrange(100)
+                        )
+                    elif kind < chain_rate + exterior_rate + dangling_rate:
+                        destination = "missing{}@{}".format(
+                            index, names[rng.randrange(domains)]
+                        )
+                    else:
+                        target = rng.choice(populated)
+                        destination = "user{}@{}".format(
+                            rng.randrange(user_counts[target]), names[target]
+                        )
+                    alias_domains.append(i)
+                    yield VirtualAlias(
+                        domain_id=domain_ids[i],
+                        source="alias{}@{}".format(index, names[i]),
+                        destination=destination,
+                    )
+
+        for batch in _batches(alias_rows(), batch_size):
+            VirtualAlias.objects.bulk_create(batch)
+
+        # bulk_create bypasses the counters and the signals invalidating the domain registry
+        # and recording the changes
+        reconcile()
+        changed()
+        for model in (VirtualDomain, VirtualUser, VirtualAlias):
+            field = "pk" if model is VirtualDomain else "domain_id"
+            record_many(
+                model.objects.filter(**{field + "__in": domain_ids})
+                .order_by("pk")
+                .iterator(chunk_size=batch_size),
+                Change.CREATE,
+                batch_size,
+            )
+
+    return {"domains": domains, "users": sum(user_counts), "aliases": aliases}
@@ -0,0 +1,305 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Background jobs for DinoMail.
+
+Long operations (DNS scans of all the domains, deletion of large domains, ...) are stored as
+jobs in the database and run by the run_workers command, without any broker. Workers claim
+pending jobs with SELECT ... FOR UPDATE SKIP LOCKED, so several workers never wait for each
+other, and record the progress and result of the jobs in their row. A thread refreshes the
+heartbeat of the running job, so long jobs are not taken for lost.
+"""
+import os
+import socket
+import threading
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import (
+    OperationalError,
+    close_old_connections,
+    connections,
+    transaction,
+)
+from django.db.models import F
+from django.utils import timezone
+
+from .counters import reconcile
+from .models import Job, VirtualDomain
+
+# Job handlers indexed by kind, see handler
+HANDLERS = {}
+
+
+def handler(kind):
+    """Register a job handler.
+
+    The decorated function receives the job and its arguments as keyword arguments. It reports
+    its progress with job.set_progress and returns a JSON serializable result.
+
+    Args:
+        kind (string): kind of the jobs run by the handler.
+
+    Returns:
+        function: the decorator.
+    """
+
+    def decorator(function):
+        HANDLERS[kind] = function
+        return function
+
+    return decorator
+
+
+def get_stale_timeout():
+    """Return the time after which a running job without heartbeat is considered lost.
+
+    Returns:
+        int: DINOMAIL_JOBS_STALE_TIMEOUT in seconds, 600 by default.
+    """
+    return getattr(settings, "DINOMAIL_JOBS_STALE_TIMEOUT", 600)
+
+
+def get_max_attempts():
+    """Return the number of times a job is claimed before failing for good.
+
+    Returns:
+        int: DINOMAIL_JOBS_MAX_ATTEMPTS, 3 by default.
+    """
+    return getattr(settings, "DINOMAIL_JOBS_MAX_ATTEMPTS", 3)
+
+
+def enqueue(kind, user=None, **arguments):
+    """Enqueue a job.
+
+    Args:
+        kind (string): kind of the job (see handler).
+        user (User): user enqueuing the job.
+        **arguments: JSON serializable arguments of the handler.
+
+    Raises:
+        ValueError: if no handler is registered for the kind.
+
+    Returns:
+        Job: the pending job.
+    """
+    if kind not in HANDLERS:
+        raise ValueError("Unknown job kind {}".format(kind))
+    return Job.objects.create(kind=kind, arguments=arguments, user=user)
+
+
+def claim(worker):
+    """Claim the oldest pending job.
+
+    Rows locked by other workers are skipped. The state is changed with a conditional update,
+    so a job is never claimed twice on databases without row locks (SQLite).
+
+    Args:
+        worker (string): name of the worker.
+
+    Returns:
+        Job: the claimed job, None if no job is pending.
+    """
+    while True:
+        with transaction.atomic():
+            pk = (
+                Job.objects.select_for_update(skip_locked=True)
+                .filter(state=Job.PENDING)
+                .order_by("created", "pk")
+                .values_list("pk", flat=True)
+                .first()
+            )
+            if pk is None:
+                return None
+            now = timezone.now()
+            claimed = Job.objects.filter(pk=pk, state=Job.PENDING).update(
+                state=Job.RUNNING,
+                worker=worker[:255],
+                started=now,
+                heartbeat=now,
+                attempts=F("attempts") + 1,
+            )
+        if claimed:
+            return Job.objects.get(pk=pk)
+
+
+def keep_alive(job, stop, interval):
+    """Refresh the heartbeat of a running job until stopped.
+
+    Args:
+        job (Job): the job.
+        stop (threading.Event): event set when the job ends.
+        interval (float): seconds between two heartbeats.
+    """
+    while not stop.wait(interval):
+        try:
+            beaten = (
+                job.owned()
+                .filter(state=Job.RUNNING)
+                .update(heartbeat=timezone.now())
+            )
+        except OperationalError:
+            # Lock timeouts and lost connections, retried on next heartbeat
+            continue
+        if not beaten:
+            # requeued, and maybe claimed by another worker
+            return
+
+
+def _heartbeat(job, stop):
+    try:
+        keep_alive(job, stop, get_stale_timeout() / 3)
+    finally:
+        connections.close_all()
+
+
+def run_job(job):
+    """Run a claimed job and record its result or its error.
+
+    The result is only recorded if the job still belongs to this worker, it may have been
+    requeued and claimed by another one if the heartbeats stopped.
+
+    Args:
+        job (Job): the job, in the running state.
+
+    Returns:
+        bool: True if the job succeeded.
+    """
+    function = HANDLERS.get(job.kind)
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(job, stop), daemon=True)
+    heartbeat.start()
+    try:
+        if function is None:
+            raise ValueError("Unknown job kind {}".format(job.kind))
+        result = function(job, **job.arguments)
+    except Exception:
+        job.owned().filter(state=Job.RUNNING).update(
+            state=Job.FAILED, error=traceback.format_exc(), finished=timezone.now()
+        )
+        return False
+    finally:
+        stop.set()
+        heartbeat.join()
+    return bool(
+        job.owned()
+        .filter(state=Job.RUNNING)
+        .update(state=Job.DONE, progress=100, result=result, finished=timezone.now())
+    )
+
+
+def requeue_stale(timeout=None):
+    """Requeue the running jobs whose worker stopped sending heartbeats.
+
+    Jobs claimed too many times (see get_max_attempts) are marked as failed instead.
+
+    Args:
+        timeout (int): seconds without heartbeat, default is get_stale_timeout().
+
+    Returns:
+        int: number of jobs requeued or failed.
+    """
+    timeout = get_stale_timeout() if timeout is None else timeout
+    stale = Job.objects.filter(
+        state=Job.RUNNING, heartbeat__lt=timezone.now() - timedelta(seconds=timeout)
+    )
+    failed = stale.filter(attempts__gte=get_max_attempts()).update(
+        state=Job.FAILED, error="Worker lost", finished=timezone.now()
+    )
+    return failed + stale.update(state=Job.PENDING, worker="")
+
+
+def worker_name():
+    """Return the name of the current worker process.
+
+    Returns:
+        string: host name and process id.
+    """
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+def run_worker(name=None, poll_interval=1, burst=False, stop=None):
+    """Claim and run jobs until stopped.
+
+    Args:
+        name (string): name of the worker, default is worker_name().
+        poll_interval (float): seconds waited when no job is pending.
+        burst (bool): if True, return as soon as no job is pending.
+        stop (threading.Event): event stopping the worker after the current job.
+
+    Returns:
+        int: number of jobs run.
+    """
+    name = name or worker_name()
+    stop = stop or threading.Event()
+    count = 0
+    while not stop.is_set():
+        close_old_connections()
+        try:
+            requeue_stale()
+            job = claim(name)
+        except OperationalError:
+            # Lock timeouts and lost connections, retried on next poll
+            stop.wait(poll_interval)
+            continue
+        if job is None:
+            if burst:
+                break
+            stop.wait(poll_interval)
+            continue
+        run_job(job)
+        count += 1
+    return count
+
+
+@handler("rescan_domains")
+def rescan_domains(job, domains=None):
+    """Update the DKIM, DMARC and SPF status of domains.
+
+    Args:
+        job (Job): the job.
+        domains (list): primary keys of the domains, all the domains if None.
+
+    Returns:
+        dict: number of domains scanned.
+    """
+    queryset = VirtualDomain.objects.filter(deleting=False).order_by("pk")
+    if domains is not None:
+        queryset = queryset.filter(pk__in=domains)
+    pks = list(queryset.values_list("pk", flat=True))
+    scanned = 0
+    for index, pk in enumerate(pks):
+        domain = VirtualDomain.objects.filter(pk=pk).first()
+        if domain is not None:
+            job.set_progress(100 * index / len(pks), domain.name)
+            domain.update_status()
+            scanned += 1
+    return {"domains": scanned}
+
+
+@handler("reconcile_counters")
+def reconcile_counters(job, fix=True):
+    """Recompute the counters of the domains.
+
+    Args:
+        job (Job): the job.
+        fix (bool): if False, only report the drifts.
+
+    Returns:
+        dict: list of drifts (domain, field, stored value, actual value).
+    """
+    return {"drifts": [list(drift) for drift in reconcile(fix=fix)]}
@@ -0,0 +1,403 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+HTTP load generator for the UI and the API of DinoMail.
+
+Requests are sent either to the application running in this process (through the WSGI or the
+ASGI handler, with the test clients of django) or to a running instance given by its URL.
+"""
+import base64
+import http.cookiejar
+import itertools
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import AsyncClient, Client
+from tastypie.models import ApiKey
+
+from .benchmark import summarize
+from .models import VirtualAlias, VirtualDomain, VirtualUser
+
+# Scenarios changing data (the passwords of users), disabled by default
+WRITE_SCENARIOS = ("api_password_change", "password_change")
+
+# Default weight of the scenarios
+DEFAULT_WEIGHTS = {
+    "home": 5,
+    "domains_index": 5,
+    "users_index": 5,
+    "aliases_index": 5,
+    "search": 10,
+    "api_domain_list": 10,
+    "api_user_list": 10,
+    "api_alias_list": 10,
+    "api_domain_detail": 10,
+    "api_user_detail": 20,
+    "api_password_change": 0,
+    "password_change": 0,
+    "dkim_scan": 2,
+    "dmarc_scan": 2,
+    "spf_scan": 2,
+}
+
+# Number of objects whose primary key is sampled to build detail requests
+SAMPLE_SIZE = 1000
+
+
+class Request:
+    """Request sent by a scenario.
+
+    Args:
+        method (string): get, post or patch.
+        path (string): path of the request.
+        data (dict): body of the request (form data, or JSON for the API).
+        api (bool): True if the request is sent to the API (with the api key).
+    """
+
+    def __init__(self, method, path, data=None, api=False):
+        self.method = method
+        self.path = path
+        self.data = data
+        self.api = api
+
+
+def _pick(rng, ids):
+    return rng.choice(ids) if ids else 0
+
+
+SCENARIOS = {
+    "home": lambda rng, ids: Request("get", "/"),
+    "domains_index": lambda rng, ids: Request("get", "/virtual-domains/"),
+    "users_index": lambda rng, ids: Request("get", "/virtual-users/"),
+    "aliases_index": lambda rng, ids: Request("get", "/virtual-aliases/"),
+    "search": lambda rng, ids: Request(
+        "get", "/search?q={}".format(rng.choice(ids["words"]) if ids["words"] else "a")
+    ),
+    "api_domain_list": lambda rng, ids: Request("get", "/api/virtualdomain/", api=True),
+    "api_user_list": lambda rng, ids: Request("get", "/api/virtualuser/", api=True),
+    "api_alias_list": lambda rng, ids: Request("get", "/api/virtualalias/", api=True),
+    "api_domain_detail": lambda rng, ids: Request(
+        "get", "/api/virtualdomain/{}/".format(_pick(rng, ids["domains"])), api=True
+    ),
+    "api_user_detail": lambda rng, ids: Request(
+        "get", "/api/virtualuser/{}/".format(_pick(rng, ids["users"])), api=True
+    ),
+    "api_password_change": lambda rng, ids: Request(
+        "patch",
+        "/api/changeuserpassword/{}/".format(_pick(rng, ids["users"])),
+        {"password": "loadtest"},
+        api=True,
+    ),
+    "password_change": lambda rng, ids: Request(
+        "post",
+        "/virtual-users/{}/edit-password".format(_pick(rng, ids["users"])),
+        {"password": "loadtest"},
+    ),
+    "dkim_scan": lambda rng, ids: Request(
+        "get", "/virtual-domains/{}/dkim-scan".format(_pick(rng, ids["domains"]))
+    ),
+    "dmarc_scan": lambda rng, ids: Request(
+        "get", "/virtual-domains/{}/dmarc-scan".format(_pick(rng, ids["domains"]))
+    ),
+    "spf_scan": lambda rng, ids: Request(
+        "get", "/virtual-domains/{}/spf-scan".format(_pick(rng, ids["domains"]))
+    ),
+}
+
+
+def sample_ids(rng):
+    """Sample the objects used by the scenarios.
+
+    Args:
+        rng (random.Random): random generator.
+
+    Returns:
+        dict: primary keys of domains and users, and words to search.
+    """
+    domains = list(VirtualDomain.objects.values_list("pk", flat=True)[:SAMPLE_SIZE])
+    users = list(VirtualUser.objects.values_list("pk", flat=True)[:SAMPLE_SIZE])
+    sources = VirtualAlias.objects.values_list("source", flat=True)[:SAMPLE_SIZE]
+    words = [source.split("@")[0][:4] for source in sources]
+    rng.shuffle(words)
+    return {"domains": domains, "users": users, "words": words}
+
+
+def _coroutine_function(method):
+    async def call(*args, **kwargs):
+        return await method(*args, **kwargs)
+
+    return call
+
+
+class InProcessTarget:
+    """Send requests to the application running in this process.
+
+    Queries made by the application are counted, as requests are handled in the calling thread.
+    Requests are sent to the testserver host, which must be allowed.
+
+    Args:
+        user (User): user sending the requests.
+        asgi (bool): use the ASGI handler instead of the WSGI one.
+    """
+
+    counts_queries = True
+
+    def __init__(self, user, asgi=False):
+        self.user = user
+        self.asgi = asgi
+        api_key, _ = ApiKey.objects.get_or_create(user=user)
+        self.api_authorization = "ApiKey {}:{}".format(user.username, api_key.key)
+
+    def client(self):
+        """Return a function sending requests, for a worker.
+
+        Returns:
+            function: function sending a Request and returning the status code.
+        """
+        client = AsyncClient() if self.asgi else Client()
+        client.force_login(self.user)
+
+        def send(request):
+            kwargs = {}
+            data = request.data
+            if request.api:
+                # The async client takes raw header names
+                header = "authorization" if self.asgi else "HTTP_AUTHORIZATION"
+                kwargs[header] = self.api_authorization
+                if data is not None:
+                    data = json.dumps(data)
+                    kwargs["content_type"] = "application/json"
+            elif data is not None:
+                data = urllib.parse.urlencode(data)
+                kwargs["content_type"] = "application/x-www-form-urlencoded"
+            method = getattr(client, request.method)
+            if self.asgi:
+                method = async_to_sync(_coroutine_function(method))
+            if data is None:
+                return method(request.path, **kwargs).status_code
+            return method(request.path, data, **kwargs).status_code
+
+        return send
+
+
+class HttpTarget:
+    """Send requests to a running instance.
+
+    Args:
+        url (string): base URL of the instance.
+        username (string): username to log in with.
+        password (string): password of the user.
+        timeout (float): timeout of a request in seconds.
+    """
+
+    counts_queries = False
+
+    def __init__(self, url, username, password, timeout=30):
+        self.url = url.rstrip("/")
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        credentials = base64.b64encode(
+            "{}:{}".format(username, password).encode("utf-8")
+        ).decode("ascii")
+        request = urllib.request.Request(
+            self.url + "/api/apikey/?format=json",
+            headers={"Authorization": "Basic {}".format(credentials)},
+        )
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            api_key = json.load(response)["objects"][0]["key"]
+        self.api_authorization = "ApiKey {}:{}".format(username, api_key)
+
+    def _csrf_token(self, cookies):
+        for cookie in cookies:
+            if cookie.name == "csrftoken":
+                return cookie.value
+        return ""
+
+    def client(self):
+        """Return a function sending requests, for a worker.
+
+        The worker logs in with its own session.
+
+        Returns:
+            function: function sending a Request and returning the status code.
+        """
+        cookies = http.cookiejar.CookieJar()
+        opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(cookies)
+        )
+        opener.open(self.url + "/login", timeout=self.timeout).read()
+        login = urllib.parse.urlencode(
+            {
+                "username": self.username,
+                "password": self.password,
+                "csrfmiddlewaretoken": self._csrf_token(cookies),
+            }
+        ).encode("utf-8")
+        opener.open(
+            urllib.request.Request(
+                self.url + "/login", login, headers={"Referer": self.url + "/login"}
+            ),
+            timeout=self.timeout,
+        ).read()
+
+        def send(request):
+            headers = {"Referer": self.url + request.path}
+            body = None
+            if request.api:
+                headers["Authorization"] = self.api_authorization
+                if request.data is not None:
+                    body = json.dumps(request.data).encode("utf-8")
+                    headers["Content-Type"] = "application/json"
+            elif request.data is not None:
+                data = dict(request.data, csrfmiddlewaretoken=self._csrf_token(cookies))
+                body = urllib.parse.urlencode(data).encode("utf-8")
+            http_request = urllib.request.Request(
+                self.url + request.path,
+                body,
+                headers=headers,
+                method=request.method.upper(),
+            )
+            try:
+                with opener.open(http_request, timeout=self.timeout) as response:
+                    response.read()
+                    return response.status
+            except urllib.error.HTTPError as e:
+                return e.code
+
+        return send
+
+
+class _Stats:
+    def __init__(self):
+        self.samples = []
+        self.queries = []
+        self.errors = 0
+
+
+def run_load(target, weights, workers=1, requests=1000, duration=None, seed=0):
+    """Send requests to a target from concurrent workers.
+
+    Every worker picks scenarios at random according to their weights. The run stops after
+    the given number of requests or duration. A single worker runs in the calling thread.
+
+    Args:
+        target (InProcessTarget or HttpTarget): where requests are sent.
+        weights (dict): weight of every scenario (see SCENARIOS).
+        workers (int): number of threads sending requests.
+        requests (int): total number of requests, None for no limit.
+        duration (float): maximum duration in seconds, None for no limit.
+        seed (int): random seed.
+
+    Returns:
+        dict: total throughput and, for every scenario, its latencies (see summarize), its number of errors and its average and maximum number of queries.
+    """
+    rng = random.Random(seed)
+    ids = sample_ids(rng)
+    names = [name for name, weight in weights.items() if weight > 0]
+    name_weights = [weights[name] for name in names]
+    counter = itertools.count()
+    lock = threading.Lock()
+    stats = {name: _Stats() for name in names}
+    start = time.perf_counter()
+    deadline = start + duration if duration else None
+
+    def work(index):
+        worker_rng = random.Random("{}-{}".format(seed, index))
+        send = target.client()
+        executed = []
+
+        def count_queries(execute, sql, params, many, context):
+            executed.append(sql)
+            return execute(sql, params, many, context)
+
+        try:
+            with connection.execute_wrapper(count_queries):
+                while requests is None or next(counter) < requests:
+                    if deadline and time.perf_counter() > deadline:
+                        break
+                    name = worker_rng.choices(names, name_weights)[0]
+                    request = SCENARIOS[name](worker_rng, ids)
+                    del executed[:]
+                    request_start = time.perf_counter()
+                    try:
+                        error = send(request) >= 400
+                    except Exception:
+                        error = True
+                    latency = time.perf_counter() - request_start
+                    with lock:
+                        stats[name].samples.append(latency)
+                        stats[name].queries.append(len(executed))
+                        stats[name].errors += error
+        finally:
+            if index:
+                connection.close()
+
+    if workers == 1:
+        work(0)
+    else:
+        threads = [
+            threading.Thread(target=work, args=(index + 1,)) for index in range(workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - start
+
+    scenarios = {}
+    for name, stat in stats.items():
+        if not stat.samples:
+            continue
+        result = summarize(stat.samples, elapsed)
+        result["errors"] = stat.errors
+        if target.counts_queries:
+            result["queries"] = sum(stat.queries) / len(stat.queries)
+            result["max_queries"] = max(stat.queries)
+        else:
+            result["queries"] = result["max_queries"] = None
+        scenarios[name] = result
+    total = sum(result["count"] for result in scenarios.values())
+    return {
+        "workers": workers,
+        "requests": total,
+        "elapsed": elapsed,
+        "throughput": total / elapsed if elapsed else 0,
+        "scenarios": scenarios,
+    }
+
+
+def get_user(username):
+    """Return the user sending in-process requests.
+
+    Args:
+        username (string): username, or None for the first superuser.
+
+    Returns:
+        User: the user, or None if not found.
+    """
+    users = User.objects.filter(is_active=True)
+    if username:
+        return users.filter(username=username).first()
+    return users.filter(is_superuser=True).order_by("pk").first()
@@ -0,0 +1,267 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Compact binary lookup file of the directory, read through mmap.
+
+The file maps every managed domain, mailbox and alias source to flags and, for aliases, the
+final destinations (see core.snapshot.resolve_aliases). Its layout, little endian, is:
+
+* a header: magic (DMLK), version (u16), reserved (u16), number of keys (u64) and offset of
+  the index (u64),
+* the records, sorted by key: key length (u16), flags (u8), value length (u32), key (UTF-8)
+  and value (destinations separated by commas),
+* the index: offset of each record (u64), in the order of the keys.
+
+LookupFile finds a key with a binary search on the index and returns the value as a slice of
+the mapping, without copying it. Processes reading the same file share one copy in the page
+cache, instead of each holding a dict of millions of strings.
+"""
+import array
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from collections import namedtuple
+
+from django.db import transaction
+
+from .models import VirtualDomain, VirtualUser
+from .snapshot import load_aliases, replace_file, resolve_aliases
+
+MAGIC = b"DMLK"
+VERSION = 1
+
+HEADER = struct.Struct("<4sHHQQ")
+RECORD = struct.Struct("<HBI")
+OFFSET = struct.Struct("<Q")
+
+DOMAIN = 1
+MAILBOX = 2
+ALIAS = 4
+
+
+class Entry(namedtuple("Entry", ("flags", "value"))):
+    """Result of a lookup.
+
+    Attributes:
+        flags (int): DOMAIN, MAILBOX and ALIAS bits.
+        value (memoryview): destinations of the alias separated by commas, empty otherwise.
+    """
+
+    __slots__ = ()
+
+    @property
+    def domain(self):
+        """bool: True if the key is a managed domain."""
+        return bool(self.flags & DOMAIN)
+
+    @property
+    def mailbox(self):
+        """bool: True if the key is a mailbox."""
+        return bool(self.flags & MAILBOX)
+
+    @property
+    def alias(self):
+        """bool: True if the key is the source of an alias."""
+        return bool(self.flags & ALIAS)
+
+    def destinations(self):
+        """Return the final destinations of an alias.
+
+        Returns:
+            list: the addresses (copied from the file).
+        """
+        value = bytes(self.value)
+        return value.decode("utf-8").split(",") if value else []
+
+
+class LookupFile:
+    """Reader of a lookup file.
+
+    The values returned by lookup are slices of the mapping: they must be released (or
+    dropped) before the file is closed.
+
+    Args:
+        path (string): the file.
+
+    Raises:
+        ValueError: if the file is not a lookup file.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, _, self.count, self.index = HEADER.unpack_from(self.mmap)
+        except struct.error:
+            magic, version = None, None
+        if magic != MAGIC or version != VERSION:
+            self.mmap.close()
+            raise ValueError("{} is not a lookup file".format(path))
+        self.view = memoryview(self.mmap)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        return self.lookup(key) is not None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Unmap the file."""
+        self.view.release()
+        self.mmap.close()
+
+    def _record(self, position):
+        (offset,) = OFFSET.unpack_from(self.mmap, self.index + OFFSET.size * position)
+        key_length, flags, value_length = RECORD.unpack_from(self.mmap, offset)
+        start = offset + RECORD.size
+        return start, key_length, flags, value_length
+
+    def lookup(self, key):
+        """Find a domain, a mailbox or an alias source.
+
+        Keys are compared exactly, as stored in the database.
+
+        Args:
+            key (string): the domain or address.
+
+        Returns:
+            Entry: flags and value, None if the key is not in the file.
+        """
+        key = key.encode("utf-8")
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            start, key_length, flags, value_length = self._record(middle)
+            candidate = self.mmap[start : start + key_length]
+            if candidate < key:
+                low = middle + 1
+            elif candidate > key:
+                high = middle
+            else:
+                start += key_length
+                return Entry(flags, self.view[start : start + value_length])
+        return None
+
+    def keys(self):
+        """Iterate over the keys, in order.
+
+        Yields:
+            string: the keys.
+        """
+        for position in range(self.count):
+            start, key_length, _, _ = self._record(position)
+            yield self.mmap[start : start + key_length].decode("utf-8")
+
+
+def directory_records(batch_size=10000):
+    """Return the records of the directory, sorted by key.
+
+    Domains being deleted, with their mailboxes and aliases, are left out.
+
+    Args:
+        batch_size (int): rows read from the database at once.
+
+    Returns:
+        list: (key, flags, value) tuples, key and value as bytes.
+    """
+    records = {}
+    with transaction.atomic():
+        for name in (
+            VirtualDomain.objects.filter(deleting=False)
+            .values_list("name", flat=True)
+            .iterator(chunk_size=batch_size)
+        ):
+            records[name] = [DOMAIN, b""]
+        for email in (
+            VirtualUser.objects.filter(domain__deleting=False)
+            .values_list("email", flat=True)
+            .iterator(chunk_size=batch_size)
+        ):
+            records.setdefault(email, [0, b""])[0] |= MAILBOX
+        aliases = load_aliases(batch_size)
+    destinations = {}
+    for source, destination in resolve_aliases(aliases):
+        destinations.setdefault(source, []).append(destination)
+    del aliases
+    for source, addresses in destinations.items():
+        record = records.setdefault(source, [0, b""])
+        record[0] |= ALIAS
+        record[1] = ",".join(addresses).encode("utf-8")
+    result = [
+        (key.encode("utf-8"), flags, value) for key, (flags, value) in records.items()
+    ]
+    result.sort()
+    return result
+
+
+def write_lookup(path, records):
+    """Write a lookup file and replace the file at path with it.
+
+    Args:
+        path (string): the file.
+        records (list): (key, flags, value) tuples sorted by key, key and value as bytes.
+
+    Returns:
+        int: size of the file in bytes.
+    """
+    path = os.path.abspath(path)
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=".lookup")
+    try:
+        offsets = array.array("Q")
+        with os.fdopen(fd, "wb") as f:
+            f.write(bytes(HEADER.size))
+            position = HEADER.size
+            for key, flags, value in records:
+                offsets.append(position)
+                f.write(RECORD.pack(len(key), flags, len(value)))
+                f.write(key)
+                f.write(value)
+                position += RECORD.size + len(key) + len(value)
+            if sys.byteorder != "little":
+                offsets.byteswap()
+            f.write(offsets.tobytes())
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, VERSION, 0, len(offsets), position))
+        replace_file(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return os.path.getsize(path)
+
+
+def export_lookup(path, batch_size=10000):
+    """Export the directory as a lookup file.
+
+    Args:
+        path (string): the file, replaced atomically.
+        batch_size (int): rows read from the database at once.
+
+    Returns:
+        dict: number of keys and size of the file in bytes.
+    """
+    records = directory_records(batch_size)
+    return {"keys": len(records), "size": write_lookup(path, records)}
@@ -0,0 +1,68 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Audit the consistency of the directory.
+"""
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.audit import CHECKS, audit
+
+
+class Command(BaseCommand):
+    help = "Detect (and optionally fix) inconsistent users and aliases, and print a JSON report."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check",
+            action="append",
+            choices=sorted(CHECKS),
+            help="check to run (repeatable, default is all of them)",
+        )
+        parser.add_argument(
+            "--fix",
+            action="append",
+            default=[],
+            choices=sorted(name for name, check in CHECKS.items() if check[2]),
+            help="check whose inconsistencies are fixed (repeatable)",
+        )
+        parser.add_argument(
+            "--limit",
+            type=int,
+            default=100,
+            help="maximum number of rows reported per check",
+        )
+        parser.add_argument("--output", help="file to write the report to")
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            checks = audit(options["check"], options["fix"], options["limit"])
+        except ValueError as e:
+            raise CommandError(e)
+        report = {"elapsed": time.perf_counter() - start, "checks": checks}
+        content = json.dumps(report, indent=2, sort_keys=True)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(content)
+        else:
+            self.stdout.write(content)
+        for name, result in checks.items():
+            self.stderr.write(
+                "{}: {} found, {} fixed".format(name, result["count"], result["fixed"])
+            )
@@ -0,0 +1,102 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Run the micro-benchmarks of DinoMail.
+"""
+import fnmatch
+import json
+import platform
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.benchmark import BENCHMARKS, run_benchmark, seed_directory
+
+
+class Command(BaseCommand):
+    help = "Run the micro-benchmarks (password schemes, records parsing, models)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "patterns",
+            nargs="*",
+            help="only run the benchmarks matching these patterns (password.*, alias.verify, ...)",
+        )
+        parser.add_argument("--output", help="write the results as JSON to this file")
+        parser.add_argument(
+            "--max-rounds", type=int, default=1000, help="maximum calls per benchmark"
+        )
+        parser.add_argument(
+            "--max-time",
+            type=float,
+            default=0.5,
+            help="time budget per benchmark (s)",
+        )
+        parser.add_argument("--seed", type=int, default=0, help="random seed")
+        parser.add_argument(
+            "--users", type=int, default=200, help="number of seeded users"
+        )
+        parser.add_argument(
+            "--aliases", type=int, default=200, help="number of seeded aliases"
+        )
+
+    def handle(self, *args, **options):
+        names = sorted(BENCHMARKS)
+        if options["patterns"]:
+            names = [
+                name
+                for name in names
+                if any(fnmatch.fnmatch(name, p) for p in options["patterns"])
+            ]
+        results = {}
+        self.stdout.write(
+            "{:<30} {:>8} {:>12} {:>12} {:>12}".format(
+                "benchmark", "rounds", "mean us", "p50 us", "p95 us"
+            )
+        )
+        # Seeded data is rolled back once the benchmarks are done
+        with transaction.atomic():
+            data = seed_directory(
+                users=options["users"], aliases=options["aliases"], seed=options["seed"]
+            )
+            for name in names:
+                result = run_benchmark(
+                    BENCHMARKS[name](data), options["max_rounds"], options["max_time"]
+                )
+                results[name] = result
+                self.stdout.write(
+                    "{:<30} {:>8} {:>12.1f} {:>12.1f} {:>12.1f}".format(
+                        name,
+                        result["count"],
+                        1000 * result["mean"],
+                        1000 * result["p50"],
+                        1000 * result["p95"],
+                    )
+                )
+            transaction.set_rollback(True)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(
+                    {
+                        "python": platform.python_version(),
+                        "django": django.get_version(),
+                        "machine": platform.machine(),
+                        "benchmarks": results,
+                    },
+                    f,
+                    indent=2,
+                )
@@ -0,0 +1,72 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Compare two runs of the micro-benchmarks.
+"""
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.benchmark import compare_results
+
+
+class Command(BaseCommand):
+    help = "Compare two benchmark result files and flag the regressions."
+
+    def add_arguments(self, parser):
+        parser.add_argument("reference", help="results of the reference run (JSON)")
+        parser.add_argument("results", help="results of the new run (JSON)")
+        parser.add_argument(
+            "--threshold",
+            type=float,
+            default=10,
+            help="slowdown (percent) above which a benchmark is a regression",
+        )
+        parser.add_argument(
+            "--metric",
+            default="p50",
+            choices=("mean", "p50", "p95", "p99", "max"),
+            help="statistic to compare",
+        )
+
+    def handle(self, *args, **options):
+        runs = []
+        for path in (options["reference"], options["results"]):
+            try:
+                with open(path) as f:
+                    runs.append(json.load(f)["benchmarks"])
+            except (OSError, ValueError, KeyError) as e:
+                raise CommandError("Cannot read {}: {}".format(path, e))
+        rows = compare_results(*runs, options["threshold"], options["metric"])
+        regressions = 0
+        for name, before, after, change, regression in rows:
+            regressions += regression
+            self.stdout.write(
+                "{:<30} {:>12.1f} {:>12.1f} {:>+8.1f} % {}".format(
+                    name,
+                    1000 * before,
+                    1000 * after,
+                    change,
+                    "REGRESSION" if regression else "",
+                )
+            )
+        if regressions:
+            raise CommandError(
+                "{} benchmarks are more than {} % slower.".format(
+                    regressions, options["threshold"]
+                )
+            )
+        self.stdout.write("No regression.")
@@ -0,0 +1,94 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Benchmark the DNS scan of synthetic domains against an in-process fake zone.
+"""
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.benchmark import benchmark_scan, synthetic_zone
+from core.resolver import FakeResolver
+
+
+class Command(BaseCommand):
+    help = "Benchmark DKIM, DMARC and SPF scans of synthetic domains without network."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--domains", type=int, default=10000, help="number of synthetic domains"
+        )
+        parser.add_argument(
+            "--concurrency",
+            default="1,8,32,128",
+            help="comma separated list of thread counts to benchmark",
+        )
+        parser.add_argument(
+            "--latency", type=float, default=0.002, help="latency of each query (s)"
+        )
+        parser.add_argument(
+            "--jitter", type=float, default=0, help="random latency added (s)"
+        )
+        parser.add_argument(
+            "--failure-rate",
+            type=float,
+            default=0,
+            help="probability for a query to time out",
+        )
+        parser.add_argument("--seed", type=int, default=0, help="random seed")
+        parser.add_argument("--output", help="write the results as JSON to this file")
+
+    def handle(self, *args, **options):
+        try:
+            levels = [int(level) for level in options["concurrency"].split(",")]
+        except ValueError:
+            raise CommandError("--concurrency must be a list of integers.")
+        resolver, domains = synthetic_zone(
+            options["domains"],
+            FakeResolver(
+                latency=options["latency"],
+                jitter=options["jitter"],
+                failure_rate=options["failure_rate"],
+                seed=options["seed"],
+            ),
+        )
+        results = []
+        self.stdout.write(
+            "{:>12} {:>12} {:>10} {:>10} {:>10} {:>10}".format(
+                "concurrency", "domains/s", "mean ms", "p50 ms", "p95 ms", "p99 ms"
+            )
+        )
+        for level in levels:
+            result = benchmark_scan(resolver, domains, level)
+            result["concurrency"] = level
+            results.append(result)
+            self.stdout.write(
+                "{concurrency:>12} {throughput:>12.1f} {mean:>10.2f} {p50:>10.2f} "
+                "{p95:>10.2f} {p99:>10.2f}".format(**result)
+            )
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(
+                    {
+                        "domains": options["domains"],
+                        "latency": options["latency"],
+                        "jitter": options["jitter"],
+                        "failure_rate": options["failure_rate"],
+                        "results": results,
+                    },
+                    f,
+                    indent=2,
+                )
@@ -0,0 +1,43 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Build a read-only SQLite snapshot of the directory for MX hosts.
+"""
+from django.core.management.base import BaseCommand
+
+from core.snapshot import build_snapshot
+
+
+class Command(BaseCommand):
+    help = "Compile the domains, mailboxes and resolved aliases into an indexed SQLite file, replaced atomically."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="snapshot file")
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=10000,
+            help="rows read and inserted at once",
+        )
+
+    def handle(self, *args, **options):
+        result = build_snapshot(options["path"], options["batch_size"])
+        self.stdout.write(
+            "{domains} domains, {mailboxes} mailboxes and {aliases} aliases written in {elapsed:.2f}s ({size} bytes).".format(
+                **result
+            )
+        )
+        self.stdout.write("sha256 {}".format(result["sha256"]))
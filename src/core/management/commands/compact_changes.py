@@ -0,0 +1,46 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Compact the change feed.
+"""
+from django.core.management.base import BaseCommand
+
+from core.changes import compact
+
+
+class Command(BaseCommand):
+    help = "Remove the changes superseded by a later change of the same object, and the old deletions."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--retention",
+            type=int,
+            help="days deletions are kept (default is DINOMAIL_CHANGES_RETENTION)",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=10000,
+            help="sequence numbers compacted per transaction",
+        )
+
+    def handle(self, *args, **options):
+        result = compact(options["retention"], options["chunk_size"])
+        self.stdout.write(
+            "{superseded} superseded changes and {deletions} deletions removed, horizon is {horizon}.".format(
+                **result
+            )
+        )
@@ -0,0 +1,38 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Export the directory as a memory mapped lookup file.
+"""
+from django.core.management.base import BaseCommand
+
+from core.lookup import export_lookup
+
+
+class Command(BaseCommand):
+    help = "Export the domains, mailboxes and resolved aliases as a sorted binary lookup file, replaced atomically."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="lookup file")
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=10000,
+            help="rows read from the database at once",
+        )
+
+    def handle(self, *args, **options):
+        result = export_lookup(options["path"], options["batch_size"])
+        self.stdout.write("{keys} keys written ({size} bytes).".format(**result))
@@ -0,0 +1,45 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Export the DKIM keys generated by DinoMail for OpenDKIM.
+"""
+from django.core.management.base import BaseCommand
+
+from core.dkim import export_opendkim
+from core.models import VirtualDomain
+
+
+class Command(BaseCommand):
+    help = "Export DKIM keys as OpenDKIM KeyTable, SigningTable and key files."
+
+    def add_arguments(self, parser):
+        parser.add_argument("directory", help="OpenDKIM configuration directory")
+
+    def handle(self, *args, **options):
+        keys = (
+            VirtualDomain.objects.exclude(dkim_private_key="")
+            .exclude(dkim_key_name="")
+            .values_list("name", "dkim_key_name", "dkim_private_key")
+            .iterator()
+        )
+        result = export_opendkim(options["directory"], keys)
+        self.stdout.write(
+            "{} key files written, {} removed, tables rewritten: {}.".format(
+                result["written"],
+                result["removed"],
+                ", ".join(result["tables"]) or "none",
+            )
+        )
@@ -0,0 +1,68 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Expand SPF records, count their DNS lookups and print flattened records.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import VirtualDomain
+from core.spf import LOOKUP_LIMIT, SpfEvaluator
+
+
+class Command(BaseCommand):
+    help = "Count the DNS lookups of SPF records and print flattened records."
+
+    def add_arguments(self, parser):
+        parser.add_argument("domains", nargs="*", help="domains to evaluate")
+        parser.add_argument(
+            "--all", action="store_true", help="evaluate all the virtual domains"
+        )
+        parser.add_argument(
+            "--over-limit",
+            action="store_true",
+            help="only print the domains needing more than 10 lookups",
+        )
+        parser.add_argument(
+            "--workers", type=int, default=8, help="number of threads for DNS queries"
+        )
+
+    def handle(self, *args, **options):
+        domains = list(options["domains"])
+        if options["all"]:
+            domains += VirtualDomain.objects.values_list("name", flat=True)
+        if not domains:
+            raise CommandError("Give some domains or use --all.")
+        evaluator = SpfEvaluator(max_workers=options["workers"])
+        for domain in domains:
+            result = evaluator.evaluate(domain)
+            if options["over_limit"] and not result.exceeds_limit:
+                continue
+            if result.record is None:
+                self.stdout.write("{}: no SPF record".format(domain))
+                continue
+            self.stdout.write(
+                "{}: {} lookups{}".format(
+                    domain,
+                    result.lookups,
+                    " (over the limit of {})".format(LOOKUP_LIMIT)
+                    if result.exceeds_limit
+                    else "",
+                )
+            )
+            for error in result.errors:
+                self.stdout.write("  warning: {}".format(error))
+            if result.flattenable:
+                self.stdout.write("  {}".format(result.flattened()))
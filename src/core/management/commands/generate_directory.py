@@ -0,0 +1,98 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Generate a synthetic directory for performance tests.
+"""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.generator import generate_directory
+from core.models import VirtualDomain
+
+
+class Command(BaseCommand):
+    help = "Generate synthetic domains, users and aliases."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--domains", type=int, default=100, help="number of domains"
+        )
+        parser.add_argument(
+            "--users", type=int, default=100, help="average number of users per domain"
+        )
+        parser.add_argument(
+            "--aliases", type=int, default=10000, help="total number of aliases"
+        )
+        parser.add_argument("--seed", type=int, default=0, help="random seed")
+        parser.add_argument(
+            "--skew",
+            type=float,
+            default=1.0,
+            help="exponent of the distribution over domains (0 is uniform)",
+        )
+        parser.add_argument(
+            "--chain-rate", type=float, default=0.2, help="share of alias chains"
+        )
+        parser.add_argument(
+            "--exterior-rate",
+            type=float,
+            default=0.2,
+            help="share of exterior aliases",
+        )
+        parser.add_argument(
+            "--dangling-rate",
+            type=float,
+            default=0.05,
+            help="share of aliases to missing addresses",
+        )
+        parser.add_argument(
+            "--suffix", default="generated.test", help="parent domain of the domains"
+        )
+        parser.add_argument(
+            "--password", default="password", help="password of all the users"
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=5000, help="rows per insert"
+        )
+
+    def handle(self, *args, **options):
+        if VirtualDomain.objects.filter(
+            name__endswith=".{}".format(options["suffix"])
+        ).exists():
+            raise CommandError(
+                "Domains under {} already exist.".format(options["suffix"])
+            )
+        start = time.perf_counter()
+        counts = generate_directory(
+            options["domains"],
+            options["users"],
+            options["aliases"],
+            seed=options["seed"],
+            skew=options["skew"],
+            chain_rate=options["chain_rate"],
+            exterior_rate=options["exterior_rate"],
+            dangling_rate=options["dangling_rate"],
+            suffix=options["suffix"],
+            password=options["password"],
+            batch_size=options["batch_size"],
+        )
+        self.stdout.write(
+            "{domains} domains, {users} users and {aliases} aliases created".format(
+                **counts
+            )
+            + " in {:.1f} s.".format(time.perf_counter() - start)
+        )
@@ -0,0 +1,112 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Generate or rotate the DKIM keys of virtual domains.
+"""
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from core.changes import record_many
+from core.dkim import KEY_TYPES, generate_key_pairs, selector_name
+from core.models import DKIM_KEY_FIELDS, Change, VirtualDomain
+from core.registry import changed
+
+
+class Command(BaseCommand):
+    help = "Generate or rotate the DKIM keys of virtual domains."
+
+    def add_arguments(self, parser):
+        parser.add_argument("domains", nargs="*", help="names of the domains")
+        parser.add_argument("--all", action="store_true", help="all the domains")
+        parser.add_argument(
+            "--missing",
+            action="store_true",
+            help="only the domains without a key generated by DinoMail",
+        )
+        parser.add_argument(
+            "--older-than",
+            type=int,
+            metavar="DAYS",
+            help="only the domains whose key is older than DAYS days and without a key "
+            "waiting to be promoted (rotation)",
+        )
+        parser.add_argument("--key-type", choices=KEY_TYPES, default="rsa")
+        parser.add_argument("--bits", type=int, default=2048, help="RSA key size")
+        parser.add_argument(
+            "--processes",
+            type=int,
+            help="number of processes generating keys (default is the number of CPUs)",
+        )
+
+    def handle(self, *args, **options):
+        if options["all"]:
+            queryset = VirtualDomain.objects.all()
+        elif options["domains"]:
+            queryset = VirtualDomain.objects.filter(name__in=options["domains"])
+        else:
+            raise CommandError("Give some domains or use --all.")
+        conditions = Q()
+        if options["missing"]:
+            conditions |= Q(dkim_private_key="", dkim_next_private_key="")
+        if options["older_than"] is not None:
+            limit = timezone.now() - datetime.timedelta(days=options["older_than"])
+            # a key waiting for its record to be published is not replaced, or it would never
+            # be promoted
+            conditions |= Q(dkim_next_key="") & (
+                Q(dkim_key_created__lt=limit) | Q(dkim_key_created__isnull=True)
+            )
+        domains = list(queryset.filter(conditions).order_by("name"))
+        pairs = generate_key_pairs(
+            len(domains), options["key_type"], options["bits"], options["processes"]
+        )
+        now = timezone.now()
+        for domain, (private_key, public_key) in zip(domains, pairs):
+            selector = selector_name(
+                now.date(), {domain.dkim_key_name, domain.dkim_next_key_name}
+            )
+            if domain.dkim_key:
+                # The current key keeps signing until the record of the new one is published,
+                # see promote_dkim_keys
+                domain.dkim_next_key_name = selector
+                domain.dkim_next_key_type = options["key_type"]
+                domain.dkim_next_key = public_key
+                domain.dkim_next_private_key = private_key
+            else:
+                domain.dkim_key_name = selector
+                domain.dkim_key_type = options["key_type"]
+                domain.dkim_key = public_key
+                domain.dkim_private_key = private_key
+                domain.dkim_key_created = now
+        with transaction.atomic():
+            VirtualDomain.objects.bulk_update(domains, DKIM_KEY_FIELDS, batch_size=500)
+            # bulk_update doesn't send the signals recording the changes
+            record_many(domains, Change.UPDATE)
+        changed()
+        for domain in domains:
+            if domain.dkim_next_key:
+                self.stdout.write(
+                    "{} TXT {}".format(
+                        domain.dkim_next_query(), domain.dkim_next_record()
+                    )
+                )
+            else:
+                self.stdout.write(
+                    "{} TXT {}".format(domain.dkim_query(), domain.dkim_record())
+                )
@@ -0,0 +1,170 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Import DMARC aggregate reports from files, directories or maildirs.
+"""
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.dmarc import COUNTERS, find_report_files, parse_file
+from core.models import DmarcAggregate, DmarcReport, VirtualDomain
+
+
+def store_reports(reports, batch_size=1000):
+    """Add parsed reports to the aggregates of the database.
+
+    Reports already imported and reports about domains not managed are ignored.
+
+    Args:
+        reports (list): ParsedReport objects.
+        batch_size (int): number of rows per insert or update query.
+
+    Returns:
+        int: number of reports stored.
+    """
+    domains = dict(
+        VirtualDomain.objects.filter(
+            name__in={report.domain for report in reports}
+        ).values_list("name", "id")
+    )
+    known = set()
+    ids = list({report.report_id for report in reports})
+    for i in range(0, len(ids), batch_size):
+        known.update(
+            DmarcReport.objects.filter(report_id__in=ids[i : i + batch_size])
+            .values_list("org_name", "report_id")
+            .iterator()
+        )
+    new_reports = []
+    aggregates = {}
+    for report in reports:
+        key = (report.org_name, report.report_id)
+        if key in known or report.domain not in domains or report.date is None:
+            continue
+        known.add(key)
+        domain_id = domains[report.domain]
+        new_reports.append(
+            DmarcReport(
+                org_name=report.org_name,
+                report_id=report.report_id,
+                domain_id=domain_id,
+                date=report.date,
+            )
+        )
+        for source_ip, counters in report.rows.items():
+            total = aggregates.setdefault(
+                (domain_id, report.date, source_ip), [0] * len(COUNTERS)
+            )
+            for i, value in enumerate(counters):
+                total[i] += value
+
+    with transaction.atomic():
+        DmarcReport.objects.bulk_create(new_reports, batch_size=batch_size)
+        existing = []
+        keys = list({(domain_id, date) for domain_id, date, _ in aggregates})
+        for i in range(0, len(keys), batch_size):
+            chunk = keys[i : i + batch_size]
+            for aggregate in DmarcAggregate.objects.filter(
+                domain_id__in={domain_id for domain_id, _ in chunk},
+                date__in={date for _, date in chunk},
+            ).iterator():
+                counters = aggregates.pop(
+                    (aggregate.domain_id, aggregate.date, aggregate.source_ip), None
+                )
+                if counters is not None:
+                    for name, value in zip(COUNTERS, counters):
+                        setattr(aggregate, name, getattr(aggregate, name) + value)
+                    existing.append(aggregate)
+        DmarcAggregate.objects.bulk_update(existing, COUNTERS, batch_size=batch_size)
+        DmarcAggregate.objects.bulk_create(
+            [
+                DmarcAggregate(
+                    domain_id=domain_id,
+                    date=date,
+                    source_ip=source_ip,
+                    **dict(zip(COUNTERS, counters))
+                )
+                for (domain_id, date, source_ip), counters in aggregates.items()
+            ],
+            batch_size=batch_size,
+        )
+    return len(new_reports)
+
+
+class Command(BaseCommand):
+    help = "Import DMARC aggregate reports (XML, gzip, zip or emails) from files, directories or maildirs."
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="+", help="files, directories or maildirs")
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=4,
+            help="number of processes parsing the reports (1 to parse in this process)",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="rows per database query and reports per transaction",
+        )
+
+    def store(self, results, batch_size):
+        """Store the parsed reports in batches, as they come in.
+
+        Args:
+            results (iterable): (reports, errors) tuples returned by parse_file.
+            batch_size (int): number of reports per transaction.
+
+        Returns:
+            tuple: number of reports found, of reports stored and of errors.
+        """
+        batch = []
+        found = 0
+        stored = 0
+        errors = 0
+        for file_reports, file_errors in results:
+            found += len(file_reports)
+            batch += file_reports
+            if len(batch) >= batch_size:
+                stored += store_reports(batch, batch_size)
+                batch = []
+            for error in file_errors:
+                errors += 1
+                self.stderr.write(error)
+        if batch:
+            stored += store_reports(batch, batch_size)
+        return found, stored, errors
+
+    def handle(self, *args, **options):
+        files = find_report_files(options["paths"])
+        if options["processes"] > 1:
+            with ProcessPoolExecutor(max_workers=options["processes"]) as executor:
+                found, stored, errors = self.store(
+                    executor.map(parse_file, files, chunksize=16),
+                    options["batch_size"],
+                )
+        else:
+            found, stored, errors = self.store(
+                map(parse_file, files), options["batch_size"]
+            )
+        self.stdout.write(
+            "{} files, {} reports found, {} new reports stored, {} errors.".format(
+                len(files), found, stored, errors
+            )
+        )
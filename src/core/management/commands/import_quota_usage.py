@@ -0,0 +1,51 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Import the quota usage of users from doveadm.
+"""
+import sys
+
+from django.core.management.base import BaseCommand
+
+from core.quota import QuotaBuffer, parse_doveadm_quota
+
+
+class Command(BaseCommand):
+    help = "Import the quota usage of users from the output of doveadm -f tab quota get -A."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "file", nargs="?", help="output of doveadm (default is standard input)"
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=1000, help="users per batch of queries"
+        )
+
+    def handle(self, *args, **options):
+        buffer = QuotaBuffer(batch_size=options["batch_size"], flush_interval=60)
+        if options["file"]:
+            with open(options["file"]) as f:
+                for report in parse_doveadm_quota(f):
+                    buffer.add(*report)
+        else:
+            for report in parse_doveadm_quota(sys.stdin):
+                buffer.add(*report)
+        buffer.flush()
+        self.stdout.write(
+            "{created} created, {updated} updated, {unchanged} unchanged, {unknown} unknown users.".format(
+                **buffer.stats
+            )
+        )
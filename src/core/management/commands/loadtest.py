@@ -0,0 +1,174 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Load test the UI and the API.
+"""
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from core.loadtest import (
+    DEFAULT_WEIGHTS,
+    WRITE_SCENARIOS,
+    HttpTarget,
+    InProcessTarget,
+    get_user,
+    run_load,
+)
+from core.resolver import FakeResolver, use_resolver
+
+
+class Command(BaseCommand):
+    help = "Send weighted scenarios of requests to the UI and the API and measure them."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--url",
+            help="base URL of a running instance (default is to run the application in-process)",
+        )
+        parser.add_argument(
+            "--asgi",
+            action="store_true",
+            help="use the ASGI handler instead of the WSGI one (in-process only)",
+        )
+        parser.add_argument(
+            "--username", help="user sending requests (default is the first superuser)"
+        )
+        parser.add_argument("--password", help="password of the user (with --url)")
+        parser.add_argument(
+            "--workers", type=int, default=1, help="number of concurrent workers"
+        )
+        parser.add_argument(
+            "--requests", type=int, default=1000, help="total number of requests"
+        )
+        parser.add_argument("--duration", type=float, help="maximum duration (s)")
+        parser.add_argument(
+            "--scenario",
+            action="append",
+            default=[],
+            metavar="NAME=WEIGHT",
+            help="weight of a scenario (0 to disable it), can be repeated",
+        )
+        parser.add_argument(
+            "--only",
+            action="store_true",
+            help="only run the scenarios given with --scenario",
+        )
+        parser.add_argument(
+            "--allow-writes",
+            action="store_true",
+            help="allow the scenarios changing data ({})".format(
+                ", ".join(WRITE_SCENARIOS)
+            ),
+        )
+        parser.add_argument(
+            "--fake-dns",
+            type=float,
+            metavar="LATENCY",
+            help="answer DNS queries of scan views from an empty in-process zone with this latency (s)",
+        )
+        parser.add_argument("--seed", type=int, default=0, help="random seed")
+        parser.add_argument("--output", help="write the results as JSON to this file")
+
+    def handle(self, *args, **options):
+        weights = {} if options["only"] else dict(DEFAULT_WEIGHTS)
+        for scenario in options["scenario"]:
+            name, _, weight = scenario.partition("=")
+            if name not in DEFAULT_WEIGHTS:
+                raise CommandError(
+                    "Unknown scenario {}, choose from {}.".format(
+                        name, ", ".join(DEFAULT_WEIGHTS)
+                    )
+                )
+            try:
+                weights[name] = float(weight or 1)
+            except ValueError:
+                raise CommandError("Invalid weight for {}.".format(name))
+        if not any(weight > 0 for weight in weights.values()):
+            raise CommandError("No scenario to run.")
+        writes = [name for name in WRITE_SCENARIOS if weights.get(name, 0) > 0]
+        if writes and not options["allow_writes"]:
+            raise CommandError(
+                "{} change the passwords of users, use --allow-writes to run them.".format(
+                    ", ".join(writes)
+                )
+            )
+
+        if options["url"]:
+            if not options["username"] or not options["password"]:
+                raise CommandError("--username and --password are needed with --url.")
+            target = HttpTarget(
+                options["url"], options["username"], options["password"]
+            )
+        else:
+            user = get_user(options["username"])
+            if user is None:
+                raise CommandError("No user to send requests.")
+            target = InProcessTarget(user, asgi=options["asgi"])
+
+        resolver = None
+        if options["fake_dns"] is not None:
+            resolver = FakeResolver(latency=options["fake_dns"])
+        allowed_hosts = settings.ALLOWED_HOSTS
+        if not options["url"]:
+            # The test clients send requests to the testserver host
+            allowed_hosts = allowed_hosts + ["testserver"]
+        with use_resolver(resolver), override_settings(ALLOWED_HOSTS=allowed_hosts):
+            result = run_load(
+                target,
+                weights,
+                workers=options["workers"],
+                requests=options["requests"],
+                duration=options["duration"],
+                seed=options["seed"],
+            )
+
+        self.stdout.write(
+            "{:<22} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9} {:>8}".format(
+                "scenario",
+                "requests",
+                "errors",
+                "req/s",
+                "p50 ms",
+                "p95 ms",
+                "p99 ms",
+                "queries",
+            )
+        )
+        for name, stat in sorted(result["scenarios"].items()):
+            self.stdout.write(
+                "{:<22} {:>8} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>8}".format(
+                    name,
+                    stat["count"],
+                    stat["errors"],
+                    stat["throughput"],
+                    stat["p50"],
+                    stat["p95"],
+                    stat["p99"],
+                    "-"
+                    if stat["queries"] is None
+                    else "{:.1f}".format(stat["queries"]),
+                )
+            )
+        self.stdout.write(
+            "{requests} requests in {elapsed:.1f} s with {workers} workers: "
+            "{throughput:.1f} requests/s".format(**result)
+        )
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(result, f, indent=2)
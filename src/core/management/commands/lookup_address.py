@@ -0,0 +1,51 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Look addresses up in a lookup file.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from core.lookup import LookupFile
+
+
+class Command(BaseCommand):
+    help = "Look domains and addresses up in a lookup file built by export_lookup."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="lookup file")
+        parser.add_argument("keys", nargs="+", help="domains or addresses")
+
+    def handle(self, *args, **options):
+        try:
+            lookup = LookupFile(options["path"])
+        except (OSError, ValueError) as e:
+            raise CommandError(e)
+        with lookup:
+            for key in options["keys"]:
+                entry = lookup.lookup(key)
+                if entry is None:
+                    self.stdout.write("{}: not found".format(key))
+                    continue
+                kinds = [
+                    kind
+                    for kind in ("domain", "mailbox", "alias")
+                    if getattr(entry, kind)
+                ]
+                line = "{}: {}".format(key, ", ".join(kinds))
+                if entry.alias:
+                    line += " -> {}".format(", ".join(entry.destinations()))
+                entry.value.release()
+                self.stdout.write(line)
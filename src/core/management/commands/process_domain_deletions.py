@@ -0,0 +1,62 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Delete the domains marked as deleting, chunk by chunk.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.deletion import process_deletions
+
+
+class Command(BaseCommand):
+    help = "Delete the users, aliases and DMARC reports of the domains being deleted, by chunks, then the domains."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            help="rows deleted per transaction (default is DINOMAIL_DELETION_CHUNK_SIZE)",
+        )
+        parser.add_argument(
+            "--max-chunks", type=int, help="stop after this number of chunks"
+        )
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="keep running, waiting for new deletions",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=10,
+            help="seconds between two checks for new deletions with --loop",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            result = process_deletions(options["chunk_size"], options["max_chunks"])
+            if result["chunks"] or not options["loop"]:
+                self.stdout.write(
+                    "{rows} rows deleted in {chunks} chunks, {domains} domains deleted.".format(
+                        **result
+                    )
+                )
+            if not options["loop"]:
+                break
+            if not result["chunks"]:
+                time.sleep(options["interval"])
@@ -0,0 +1,51 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Replace the DKIM keys of virtual domains by their rotated keys once published.
+"""
+from django.core.management.base import BaseCommand
+
+from core.models import VirtualDomain
+
+
+class Command(BaseCommand):
+    help = "Replace DKIM keys by the rotated keys whose DNS record is published."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "domains", nargs="*", help="names of the domains (default is all)"
+        )
+
+    def handle(self, *args, **options):
+        queryset = VirtualDomain.objects.exclude(dkim_next_key="").order_by("name")
+        if options["domains"]:
+            queryset = queryset.filter(name__in=options["domains"])
+        promoted = 0
+        waiting = 0
+        for domain in queryset:
+            if domain.promote_dkim_key():
+                promoted += 1
+                self.stdout.write(
+                    "{}: selector {} promoted".format(domain.name, domain.dkim_key_name)
+                )
+            else:
+                waiting += 1
+                self.stdout.write(
+                    "{}: waiting for {} TXT {}".format(
+                        domain.name, domain.dkim_next_query(), domain.dkim_next_record()
+                    )
+                )
+        self.stdout.write("{} keys promoted, {} waiting.".format(promoted, waiting))
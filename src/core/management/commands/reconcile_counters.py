@@ -0,0 +1,48 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Recompute the counters of domains, users, aliases and allocated quota.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from core.counters import reconcile
+
+
+class Command(BaseCommand):
+    help = "Recompute the counters of domains, users, aliases and allocated quota and fix the ones that drifted."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check",
+            action="store_true",
+            help="only report the drifted counters, and exit with an error if there are some",
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            drifts = reconcile(fix=not options["check"])
+        for domain, field, stored, actual in drifts:
+            self.stdout.write(
+                "{} {}: {} -> {}".format(domain or "global", field, stored, actual)
+            )
+        if options["check"] and drifts:
+            raise CommandError("{} counters drifted.".format(len(drifts)))
+        self.stdout.write(
+            "{} counters {}.".format(
+                len(drifts), "drifted" if options["check"] else "fixed"
+            )
+        )
@@ -0,0 +1,99 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Run background jobs with a pool of worker processes.
+"""
+import multiprocessing
+import signal
+import threading
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from core.jobs import run_worker, worker_name
+
+
+def _work(poll_interval, burst):
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: stop.set())
+    run_worker(worker_name(), poll_interval, burst, stop)
+
+
+class Command(BaseCommand):
+    help = "Run the background jobs (domain scans, domain deletions, ...) with worker processes."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=1, help="number of worker processes"
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=1,
+            help="seconds between two checks for new jobs",
+        )
+        parser.add_argument(
+            "--burst",
+            action="store_true",
+            help="exit once no job is pending",
+        )
+
+    def handle(self, *args, **options):
+        if options["workers"] < 1:
+            raise CommandError("--workers must be at least 1.")
+        poll_interval, burst = options["poll_interval"], options["burst"]
+        if options["workers"] == 1:
+            stop = threading.Event()
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, lambda *args: stop.set())
+            count = run_worker(worker_name(), poll_interval, burst, stop)
+            self.stdout.write("{} jobs run.".format(count))
+            return
+
+        # Children must not share the database connections of the parent
+        connections.close_all()
+        context = multiprocessing.get_context("fork")
+        stopping = threading.Event()
+
+        def stop(*args):
+            stopping.set()
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+
+        processes = []
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, stop)
+        for _ in range(options["workers"]):
+            process = context.Process(target=_work, args=(poll_interval, burst))
+            process.start()
+            processes.append(process)
+        while processes:
+            for process in list(processes):
+                process.join(poll_interval)
+                if process.is_alive():
+                    continue
+                processes.remove(process)
+                if process.exitcode and not stopping.is_set() and not burst:
+                    self.stderr.write(
+                        "Worker {} exited with code {}, restarting it.".format(
+                            process.pid, process.exitcode
+                        )
+                    )
+                    process = context.Process(target=_work, args=(poll_interval, burst))
+                    process.start()
+                    processes.append(process)
@@ -0,0 +1,437 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Prometheus metrics of DinoMail.
+
+Metrics are kept in memory by every process. Recording is a dictionary update under a lock, so
+it can be done on the hot path. When the DINOMAIL_METRICS_DIR setting is set, every process
+also dumps its metrics in that directory (at most every DINOMAIL_METRICS_DUMP_INTERVAL seconds)
+and the metrics endpoint merges the dumps of all the processes. The dumps of the processes that
+exited are added to a totals file, so counters never go down.
+"""
+import atexit
+import bisect
+import contextlib
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    return "{{{}}}".format(
+        ",".join('{}="{}"'.format(n, _escape(v)) for n, v in zip(names, values))
+    )
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Metric:
+    """Base class of metrics.
+
+    Args:
+        name (string): name of the metric.
+        documentation (string): help text of the metric.
+        labelnames (tuple): names of the labels.
+        registry (Registry): registry of the metric.
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.registry = registry or REGISTRY
+        self.values = {}
+        self.lock = threading.Lock()
+        self.registry.register(self)
+
+    def merge(self, values, other):
+        """Add the values of another process to values.
+
+        Args:
+            values (dict): values indexed by labels, updated in place.
+            other (dict): values of the other process.
+        """
+        raise NotImplementedError
+
+    def lines(self, values):
+        """Return the lines of the text exposition format.
+
+        Args:
+            values (dict): values indexed by labels.
+
+        Returns:
+            list: the lines.
+        """
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """Counter, a value that only goes up."""
+
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        """Increment the counter.
+
+        Args:
+            labels: values of the labels.
+            amount (float): increment.
+        """
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+        self.registry.maybe_dump()
+
+    def merge(self, values, other):
+        for labels, value in other.items():
+            values[labels] = values.get(labels, 0) + value
+
+    def lines(self, values):
+        return [
+            "{}{} {}".format(
+                self.name, _format_labels(self.labelnames, labels), _format_value(value)
+            )
+            for labels, value in sorted(values.items())
+        ]
+
+
+class Histogram(Metric):
+    """Histogram of observed values (latencies).
+
+    Args:
+        buckets (tuple): upper bounds of the buckets, sorted.
+    """
+
+    type = "histogram"
+
+    def __init__(self, *args, buckets=DEFAULT_BUCKETS, **kwargs):
+        self.buckets = tuple(buckets)
+        super().__init__(*args, **kwargs)
+
+    def observe(self, value, *labels):
+        """Observe a value.
+
+        Args:
+            value (float): the value.
+            labels: values of the labels.
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                # Counts of every bucket (not cumulative), of +Inf, and the sum
+                state = self.values[labels] = [0] * (len(self.buckets) + 2)
+            state[index] += 1
+            state[-1] += value
+        self.registry.maybe_dump()
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        """Context manager observing the time spent inside it.
+
+        Args:
+            labels: values of the labels.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def merge(self, values, other):
+        for labels, state in other.items():
+            current = values.setdefault(labels, [0] * len(state))
+            for i, value in enumerate(state):
+                current[i] += value
+
+    def lines(self, values):
+        lines = []
+        names = self.labelnames + ("le",)
+        for labels, state in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), state):
+                cumulative += count
+                lines.append(
+                    "{}_bucket{} {}".format(
+                        self.name,
+                        _format_labels(names, labels + (_format_value(bound),)),
+                        cumulative,
+                    )
+                )
+            suffix = _format_labels(self.labelnames, labels)
+            lines.append(
+                "{}_sum{} {}".format(self.name, suffix, _format_value(state[-1]))
+            )
+            lines.append("{}_count{} {}".format(self.name, suffix, cumulative))
+        return lines
+
+
+TOTALS_FILE = "totals.json"
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _write(directory, file_name, data):
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, os.path.join(directory, file_name))
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class Registry:
+    """Set of metrics of a process."""
+
+    def __init__(self):
+        self.metrics = {}
+        self.last_dump = 0
+        self.lock = threading.Lock()
+        self.pid = None
+        self.started = None
+
+    @property
+    def file_name(self):
+        """string: name of the dump of this process.
+
+        It is computed from the current pid, since forked processes (gunicorn --preload,
+        run_workers) inherit the registry of their parent.
+        """
+        pid = os.getpid()
+        if pid != self.pid:
+            # the start time tells apart processes reusing the pid of a dead one
+            self.pid = pid
+            self.started = int(time.time() * 1000)
+        return "{}-{}.json".format(self.pid, self.started)
+
+    def forked(self):
+        """Forget the values inherited from the parent process, which dumps them itself."""
+        self.lock = threading.Lock()
+        self.last_dump = 0
+        for metric in self.metrics.values():
+            metric.lock = threading.Lock()
+            metric.values = {}
+
+    def register(self, metric):
+        """Register a metric.
+
+        Args:
+            metric (Metric): the metric.
+        """
+        self.metrics[metric.name] = metric
+
+    def snapshot(self):
+        """Return a copy of the values of the metrics of this process.
+
+        Returns:
+            dict: values indexed by labels, indexed by metric name.
+        """
+        snapshot = {}
+        for name, metric in self.metrics.items():
+            with metric.lock:
+                snapshot[name] = {
+                    labels: list(value) if isinstance(value, list) else value
+                    for labels, value in metric.values.items()
+                }
+        return snapshot
+
+    def directory(self):
+        """Return the directory of the dumps, None if metrics are not shared."""
+        return getattr(settings, "DINOMAIL_METRICS_DIR", None)
+
+    def dump(self):
+        """Write the metrics of this process in the dump directory."""
+        directory = self.directory()
+        if not directory:
+            return
+        self.last_dump = time.monotonic()
+        data = {
+            name: [[list(labels), value] for labels, value in values.items()]
+            for name, values in self.snapshot().items()
+        }
+        os.makedirs(directory, exist_ok=True)
+        _write(directory, self.file_name, data)
+
+    def fold(self, directory):
+        """Add the dumps of the processes that exited to the totals file and remove them.
+
+        Args:
+            directory (string): directory of the dumps.
+        """
+        with open(os.path.join(directory, ".lock"), "w") as lock:
+            # collect may run in several processes at once, a dump must be added only once
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            dead = []
+            for file_name in os.listdir(directory):
+                pid = file_name.split("-", 1)[0]
+                if file_name.endswith(".json") and pid.isdigit() and not _alive(int(pid)):
+                    dead.append(file_name)
+            if not dead:
+                return
+            path = os.path.join(directory, TOTALS_FILE)
+            totals = {name: {} for name in self.metrics}
+            for file_name in [TOTALS_FILE] + dead:
+                self._merge(totals, _read(os.path.join(directory, file_name)) or {})
+            _write(
+                directory,
+                TOTALS_FILE,
+                {
+                    name: [[list(labels), value] for labels, value in values.items()]
+                    for name, values in totals.items()
+                },
+            )
+            for file_name in dead:
+                os.remove(os.path.join(directory, file_name))
+
+    def _merge(self, merged, data):
+        for name, values in data.items():
+            if name in self.metrics:
+                self.metrics[name].merge(
+                    merged[name], {tuple(labels): value for labels, value in values}
+                )
+
+    def maybe_dump(self):
+        """Dump the metrics if the last dump is older than the dump interval."""
+        interval = getattr(settings, "DINOMAIL_METRICS_DUMP_INTERVAL", 1)
+        if time.monotonic() - self.last_dump < interval or not self.directory():
+            return
+        if self.lock.acquire(blocking=False):
+            try:
+                self.dump()
+            finally:
+                self.lock.release()
+
+    def collect(self):
+        """Merge the metrics of all the processes.
+
+        Returns:
+            dict: values indexed by labels, indexed by metric name.
+        """
+        directory = self.directory()
+        if not directory:
+            return self.snapshot()
+        with self.lock:
+            self.dump()
+        self.fold(directory)
+        merged = {name: {} for name in self.metrics}
+        for file_name in sorted(os.listdir(directory)):
+            if not file_name.endswith(".json") or file_name.startswith("."):
+                continue
+            self._merge(merged, _read(os.path.join(directory, file_name)) or {})
+        return merged
+
+    def render(self, gauges=()):
+        """Render the metrics in the Prometheus text exposition format.
+
+        Args:
+            gauges (list): gauges computed at scrape time, as (name, documentation, label names, values indexed by labels) tuples.
+
+        Returns:
+            string: the metrics.
+        """
+        lines = []
+        values = self.collect()
+        for name, metric in sorted(self.metrics.items()):
+            lines.append("# HELP {} {}".format(name, metric.documentation))
+            lines.append("# TYPE {} {}".format(name, metric.type))
+            lines += metric.lines(values[name])
+        for name, documentation, labelnames, gauge_values in gauges:
+            lines.append("# HELP {} {}".format(name, documentation))
+            lines.append("# TYPE {} gauge".format(name))
+            for labels, value in sorted(gauge_values.items()):
+                lines.append(
+                    "{}{} {}".format(
+                        name, _format_labels(labelnames, labels), _format_value(value)
+                    )
+                )
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+atexit.register(REGISTRY.dump)
+os.register_at_fork(after_in_child=REGISTRY.forked)
+
+REQUEST_DURATION = Histogram(
+    "dinomail_request_duration_seconds",
+    "Duration of HTTP requests.",
+    ("view",),
+)
+REQUESTS = Counter(
+    "dinomail_requests_total", "Number of HTTP requests.", ("view", "status")
+)
+DNS_QUERY_DURATION = Histogram(
+    "dinomail_dns_query_duration_seconds",
+    "Duration of DNS queries.",
+    ("rdtype",),
+)
+DNS_QUERIES = Counter(
+    "dinomail_dns_queries_total",
+    "Number of DNS queries by outcome.",
+    ("rdtype", "outcome"),
+)
+PASSWORD_HASH_DURATION = Histogram(
+    "dinomail_password_hash_duration_seconds",
+    "Duration of password hashing.",
+    ("scheme",),
+)
@@ -0,0 +1,373 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Middlewares of DinoMail.
+
+The middlewares support sync and async requests, so that the async views don't hold a thread
+under ASGI. The database queries of async requests run in other threads and are not recorded.
+"""
+import contextlib
+import logging
+import os
+import re
+import time
+
+from asgiref.sync import (
+    async_to_sync,
+    iscoroutinefunction,
+    markcoroutinefunction,
+    sync_to_async,
+)
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse
+
+from .metrics import REQUEST_DURATION, REQUESTS
+from .profiler import RequestProfile
+from .queries import QueryRecorder
+from .routers import PIN_COOKIE, get_pin_time, get_replicas, use_replicas
+from .tracing import trace, trace_queries
+
+logger = logging.getLogger(__name__)
+
+
+class HybridMiddleware:
+    """Base class of the middlewares supporting sync and async requests.
+
+    Subclasses implement __call__ for sync requests and __acall__ for async requests.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+
+class QueryCountMiddleware(HybridMiddleware):
+    """Count the queries and the database time of every request.
+
+    The figures are sent in a Server-Timing header (if DINOMAIL_SERVER_TIMING is True), and
+    requests over the DINOMAIL_SLOW_REQUEST_* thresholds are logged with their view and their
+    most repeated statements. Only the total time is measured for async requests.
+    """
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        recorder = QueryRecorder()
+        start = time.perf_counter()
+        with recorder.record():
+            response = self.get_response(request)
+        return self.report(request, response, start, recorder)
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        return self.report(request, response, start, None)
+
+    def report(self, request, response, start, recorder):
+        """Add the Server-Timing header to a response and log slow requests.
+
+        Args:
+            request (HttpRequest): django request object.
+            response (HttpResponse): django response object.
+            start (float): time.perf_counter() at the start of the request.
+            recorder (QueryRecorder): queries of the request, None if not recorded.
+
+        Returns:
+            HttpResponse: the response.
+        """
+        duration = 1000 * (time.perf_counter() - start)
+        if recorder is None:
+            if getattr(settings, "DINOMAIL_SERVER_TIMING", True):
+                timing = "app;dur={:.1f}".format(duration)
+                if response.has_header("Server-Timing"):
+                    timing = "{}, {}".format(response["Server-Timing"], timing)
+                response["Server-Timing"] = timing
+            if duration > getattr(settings, "DINOMAIL_SLOW_REQUEST_TIME", 1000):
+                match = request.resolver_match
+                logger.warning(
+                    "Slow request {} {} ({}): {:.1f} ms in total".format(
+                        request.method,
+                        request.path,
+                        match.view_name if match else "no view",
+                        duration,
+                    )
+                )
+            return response
+        db_duration = 1000 * recorder.duration
+
+        if getattr(settings, "DINOMAIL_SERVER_TIMING", True):
+            timing = 'db;desc="{} queries";dur={:.1f}, app;dur={:.1f}'.format(
+                recorder.count, db_duration, duration
+            )
+            if response.has_header("Server-Timing"):
+                timing = "{}, {}".format(response["Server-Timing"], timing)
+            response["Server-Timing"] = timing
+
+        if (
+            recorder.count > getattr(settings, "DINOMAIL_SLOW_REQUEST_QUERIES", 100)
+            or db_duration > getattr(settings, "DINOMAIL_SLOW_REQUEST_DB_TIME", 500)
+            or duration > getattr(settings, "DINOMAIL_SLOW_REQUEST_TIME", 1000)
+        ):
+            match = request.resolver_match
+            lines = [
+                "Slow request {} {} ({}): {} queries, {:.1f} ms in database, "
+                "{:.1f} ms in total".format(
+                    request.method,
+                    request.path,
+                    match.view_name if match else "no view",
+                    recorder.count,
+                    db_duration,
+                    duration,
+                )
+            ]
+            for sql, count in recorder.repeated():
+                lines.append("  {} x {}".format(count, sql))
+            logger.warning("\n".join(lines))
+        return response
+
+
+class MetricsMiddleware(HybridMiddleware):
+    """Record the duration and the status of every request, by view name."""
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        start = time.perf_counter()
+        response = self.get_response(request)
+        return self.observe(request, response, start)
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        return self.observe(request, response, start)
+
+    def observe(self, request, response, start):
+        """Record a request.
+
+        Args:
+            request (HttpRequest): django request object.
+            response (HttpResponse): django response object.
+            start (float): time.perf_counter() at the start of the request.
+
+        Returns:
+            HttpResponse: the response.
+        """
+        match = request.resolver_match
+        view = match.view_name if match else "unmatched"
+        REQUEST_DURATION.observe(time.perf_counter() - start, view)
+        REQUESTS.inc(view, str(response.status_code))
+        return response
+
+
+class ProfilerMiddleware(HybridMiddleware):
+    """Profile a request on demand of a staff user.
+
+    The profile is requested with the profile query parameter or the X-Profile header, set to
+    text (the report is returned instead of the response) or store (the profile is saved in
+    DINOMAIL_PROFILER_DIR and the response is returned with the file name in the X-Profile
+    header). Memory allocations are traced too if the memory query parameter or the
+    X-Profile-Memory header is set. Async requests are profiled from a thread.
+    """
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        mode = request.GET.get("profile") or request.META.get("HTTP_X_PROFILE")
+        if (
+            not mode
+            or not getattr(settings, "DINOMAIL_PROFILER", True)
+            or not request.user.is_staff
+        ):
+            return self.get_response(request)
+        return self.profile(request, self.get_response, mode)
+
+    async def __acall__(self, request):
+        mode = request.GET.get("profile") or request.META.get("HTTP_X_PROFILE")
+        if not mode or not getattr(settings, "DINOMAIL_PROFILER", True):
+            return await self.get_response(request)
+        get_response = async_to_sync(self.get_response)
+
+        def profile():
+            if not request.user.is_staff:
+                return get_response(request)
+            return self.profile(request, get_response, mode)
+
+        return await sync_to_async(profile)()
+
+    def profile(self, request, get_response, mode):
+        """Profile a request.
+
+        Args:
+            request (HttpRequest): django request object.
+            get_response (function): sync function returning the response.
+            mode (string): text or store.
+
+        Returns:
+            HttpResponse: the response, or the report.
+        """
+        memory = bool(
+            request.GET.get("memory") or request.META.get("HTTP_X_PROFILE_MEMORY")
+        )
+        profile = RequestProfile(memory=memory)
+        response = profile.run(get_response, request)
+        report = profile.report(getattr(settings, "DINOMAIL_PROFILER_LIMIT", 50))
+        if mode == "store":
+            directory = getattr(settings, "DINOMAIL_PROFILER_DIR", None)
+            if directory:
+                match = request.resolver_match
+                name = "{}-{}".format(
+                    time.strftime("%Y%m%d-%H%M%S"),
+                    match.view_name if match else "unmatched",
+                )
+                os.makedirs(directory, exist_ok=True)
+                profile.stats.dump_stats(os.path.join(directory, name + ".prof"))
+                with open(os.path.join(directory, name + ".txt"), "w") as f:
+                    f.write(report)
+                response["X-Profile"] = name
+                return response
+        return HttpResponse(report, content_type="text/plain; charset=utf-8")
+
+
+class TracingMiddleware(HybridMiddleware):
+    """Record a trace of every sampled request.
+
+    The root span is named after the view. Queries of sync requests are recorded as spans. A
+    W3C traceparent header sets the trace identifier and the sampling decision.
+    """
+
+    TRACEPARENT = re.compile(r"^[0-9a-f]{2}-([0-9a-f]{32})-[0-9a-f]{16}-([0-9a-f]{2})$")
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        with self.trace(request) as root:
+            if root is None:
+                return self.get_response(request)
+            with contextlib.ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(
+                        connections[alias].execute_wrapper(trace_queries)
+                    )
+                response = self.get_response(request)
+            return self.finish(request, response, root)
+
+    async def __acall__(self, request):
+        with self.trace(request) as root:
+            response = await self.get_response(request)
+            if root is None:
+                return response
+            return self.finish(request, response, root)
+
+    def trace(self, request):
+        """Start the trace of a request.
+
+        Args:
+            request (HttpRequest): django request object.
+
+        Returns:
+            context manager: the root span, None if the request is not sampled.
+        """
+        trace_id = sampled = None
+        match = self.TRACEPARENT.match(request.META.get("HTTP_TRACEPARENT", ""))
+        if match:
+            trace_id = match.group(1)
+            sampled = bool(int(match.group(2), 16) & 1)
+        return trace(
+            request.method,
+            trace_id=trace_id,
+            sampled=sampled,
+            method=request.method,
+            path=request.path,
+        )
+
+    def finish(self, request, response, root):
+        """Name the root span of a request after its view.
+
+        Args:
+            request (HttpRequest): django request object.
+            response (HttpResponse): django response object.
+            root (Span): root span of the trace.
+
+        Returns:
+            HttpResponse: the response.
+        """
+        match = request.resolver_match
+        view = match.view_name if match else "unmatched"
+        root.name = "{} {}".format(request.method, view)
+        root.attributes["view"] = view
+        root.attributes["status"] = response.status_code
+        return response
+
+
+class ReplicaMiddleware(HybridMiddleware):
+    """Allow reads from replicas during read-only requests of browsers not pinned to the primary.
+
+    Requests writing to the database pin the browser to the primary with a cookie.
+    """
+
+    SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+    def replicas_allowed(self, request):
+        """Test if the reads of a request may go to replicas.
+
+        Args:
+            request (HttpRequest): django request object.
+
+        Returns:
+            bool: True for read-only requests of browsers not pinned to the primary.
+        """
+        return (
+            bool(get_replicas())
+            and request.method in self.SAFE_METHODS
+            and PIN_COOKIE not in request.COOKIES
+        )
+
+    def pin(self, request, response, state):
+        """Pin the browser to the primary if the request wrote.
+
+        Args:
+            request (HttpRequest): django request object.
+            response (HttpResponse): django response object.
+            state (ReplicaState): routing state of the request.
+
+        Returns:
+            HttpResponse: the response.
+        """
+        if not get_replicas():
+            return response
+        if state.wrote or request.method not in self.SAFE_METHODS:
+            response.set_cookie(
+                PIN_COOKIE, "1", max_age=get_pin_time(), httponly=True, samesite="Lax"
+            )
+        return response
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        with use_replicas(self.replicas_allowed(request)) as state:
+            response = self.get_response(request)
+        return self.pin(request, response, state)
+
+    async def __acall__(self, request):
+        with use_replicas(self.replicas_allowed(request)) as state:
+            response = await self.get_response(request)
+        return self.pin(request, response, state)
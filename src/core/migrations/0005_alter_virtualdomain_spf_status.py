@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 23:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_auto_20200616_1218'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='virtualdomain',
+            name='spf_status',
+            field=models.IntegerField(choices=[(0, 'No DNS record for SPF'), (1, 'ok'), (2, 'SPF record needs more than 10 DNS lookups')], default=0, verbose_name='spf status'),
+        ),
+    ]
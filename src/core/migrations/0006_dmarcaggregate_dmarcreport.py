@@ -0,0 +1,49 @@
+# Generated by Django 3.2.25 on 2026-10-18 23:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_alter_virtualdomain_spf_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DmarcReport',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('org_name', models.CharField(max_length=255, verbose_name='organization')),
+                ('report_id', models.CharField(max_length=255, verbose_name='report id')),
+                ('date', models.DateField(verbose_name='date')),
+                ('domain', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.virtualdomain', verbose_name='domain')),
+            ],
+            options={
+                'verbose_name': 'DMARC report',
+                'verbose_name_plural': 'DMARC reports',
+                'unique_together': {('org_name', 'report_id')},
+            },
+        ),
+        migrations.CreateModel(
+            name='DmarcAggregate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='date')),
+                ('source_ip', models.GenericIPAddressField(verbose_name='source IP')),
+                ('messages', models.PositiveIntegerField(default=0, verbose_name='messages')),
+                ('dkim_pass', models.PositiveIntegerField(default=0, verbose_name='DKIM pass')),
+                ('spf_pass', models.PositiveIntegerField(default=0, verbose_name='SPF pass')),
+                ('dmarc_pass', models.PositiveIntegerField(default=0, verbose_name='DMARC pass')),
+                ('quarantined', models.PositiveIntegerField(default=0, verbose_name='quarantined')),
+                ('rejected', models.PositiveIntegerField(default=0, verbose_name='rejected')),
+                ('domain', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.virtualdomain', verbose_name='domain')),
+            ],
+            options={
+                'verbose_name': 'DMARC aggregate',
+                'verbose_name_plural': 'DMARC aggregates',
+                'unique_together': {('domain', 'date', 'source_ip')},
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-18 23:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_dmarcaggregate_dmarcreport'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='virtualdomain',
+            name='dkim_key_created',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='dkim key creation date'),
+        ),
+        migrations.AddField(
+            model_name='virtualdomain',
+            name='dkim_key_type',
+            field=models.CharField(choices=[('rsa', 'RSA'), ('ed25519', 'Ed25519')], default='rsa', max_length=10, verbose_name='dkim key type'),
+        ),
+        migrations.AddField(
+            model_name='virtualdomain',
+            name='dkim_private_key',
+            field=models.TextField(blank=True, verbose_name='dkim private key'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-19 00:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_auto_20261018_2339'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuotaUsage',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='quota_usage', serialize=False, to='core.virtualuser', verbose_name='user')),
+                ('storage', models.BigIntegerField(default=0, verbose_name='storage')),
+                ('messages', models.BigIntegerField(default=0, verbose_name='messages')),
+                ('last_update', models.DateTimeField(default=django.utils.timezone.now, verbose_name='last update')),
+            ],
+            options={
+                'verbose_name': 'quota usage',
+                'verbose_name_plural': 'quota usages',
+            },
+        ),
+    ]
@@ -0,0 +1,79 @@
+# Generated by Django 3.2.25 on 2026-10-19 00:07
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+import django.db.models.deletion
+
+
+def create_counters(apps, schema_editor):
+    VirtualDomain = apps.get_model('core', 'VirtualDomain')
+    VirtualUser = apps.get_model('core', 'VirtualUser')
+    VirtualAlias = apps.get_model('core', 'VirtualAlias')
+    DomainCounter = apps.get_model('core', 'DomainCounter')
+    GlobalCounter = apps.get_model('core', 'GlobalCounter')
+    counters = {pk: DomainCounter(domain_id=pk) for pk in VirtualDomain.objects.values_list('pk', flat=True)}
+    for row in VirtualUser.objects.values('domain_id').annotate(users=Count('pk'), quota=Sum('quota')):
+        counters[row['domain_id']].users = row['users']
+        counters[row['domain_id']].quota = row['quota'] or 0
+    for row in VirtualAlias.objects.values('domain_id').annotate(aliases=Count('pk')):
+        counters[row['domain_id']].aliases = row['aliases']
+    DomainCounter.objects.bulk_create(counters.values(), batch_size=1000)
+    GlobalCounter.objects.create(
+        domains=len(counters),
+        users=sum(counter.users for counter in counters.values()),
+        aliases=sum(counter.aliases for counter in counters.values()),
+        quota=sum(counter.quota for counter in counters.values()),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_quotausage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DomainCounter',
+            fields=[
+                ('domain', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='counter', serialize=False, to='core.virtualdomain', verbose_name='domain')),
+                ('users', models.BigIntegerField(default=0, verbose_name='users')),
+                ('aliases', models.BigIntegerField(default=0, verbose_name='aliases')),
+                ('quota', models.BigIntegerField(default=0, verbose_name='allocated quota')),
+            ],
+            options={
+                'verbose_name': 'domain counter',
+                'verbose_name_plural': 'domain counters',
+            },
+        ),
+        migrations.CreateModel(
+            name='GlobalCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('domains', models.BigIntegerField(default=0, verbose_name='domains')),
+                ('users', models.BigIntegerField(default=0, verbose_name='users')),
+                ('aliases', models.BigIntegerField(default=0, verbose_name='aliases')),
+                ('quota', models.BigIntegerField(default=0, verbose_name='allocated quota')),
+            ],
+            options={
+                'verbose_name': 'global counter',
+                'verbose_name_plural': 'global counters',
+            },
+        ),
+        migrations.AddField(
+            model_name='virtualdomain',
+            name='max_aliases',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='maximum number of aliases'),
+        ),
+        migrations.AddField(
+            model_name='virtualdomain',
+            name='max_quota',
+            field=models.BigIntegerField(blank=True, null=True, verbose_name='maximum allocated quota'),
+        ),
+        migrations.AddField(
+            model_name='virtualdomain',
+            name='max_users',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='maximum number of users'),
+        ),
+        migrations.RunPython(create_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-19 00:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_domain_counters'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='virtualalias',
+            name='source',
+            field=models.EmailField(db_index=True, max_length=254, verbose_name='source'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-19 00:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_alias_source_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='virtualdomain',
+            name='deleting',
+            field=models.BooleanField(default=False, verbose_name='deleting'),
+        ),
+        migrations.AddField(
+            model_name='virtualdomain',
+            name='deletion_done',
+            field=models.BigIntegerField(default=0, verbose_name='rows deleted'),
+        ),
+        migrations.AddField(
+            model_name='virtualdomain',
+            name='deletion_total',
+            field=models.BigIntegerField(default=0, verbose_name='rows to delete'),
+        ),
+    ]
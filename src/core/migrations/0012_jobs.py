@@ -0,0 +1,46 @@
+# Generated by Django 3.2.25 on 2026-10-19 00:18
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0011_domain_deletion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=64, verbose_name='kind')),
+                ('arguments', models.JSONField(default=dict, verbose_name='arguments')),
+                ('state', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=16, verbose_name='state')),
+                ('progress', models.PositiveSmallIntegerField(default=0, verbose_name='progress')),
+                ('message', models.CharField(blank=True, max_length=255, verbose_name='message')),
+                ('result', models.JSONField(blank=True, null=True, verbose_name='result')),
+                ('error', models.TextField(blank=True, verbose_name='error')),
+                ('worker', models.CharField(blank=True, max_length=255, verbose_name='worker')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='attempts')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, verbose_name='created')),
+                ('started', models.DateTimeField(blank=True, null=True, verbose_name='started')),
+                ('finished', models.DateTimeField(blank=True, null=True, verbose_name='finished')),
+                ('heartbeat', models.DateTimeField(blank=True, null=True, verbose_name='heartbeat')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='user')),
+            ],
+            options={
+                'verbose_name': 'job',
+                'verbose_name_plural': 'jobs',
+                'ordering': ('-created', '-pk'),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['state', 'created'], name='core_job_state_9677e5_idx'),
+        ),
+    ]
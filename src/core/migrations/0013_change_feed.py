@@ -0,0 +1,46 @@
+# Generated by Django 3.2.25 on 2026-10-19 00:36
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Change',
+            fields=[
+                ('sequence', models.BigIntegerField(primary_key=True, serialize=False, verbose_name='sequence')),
+                ('kind', models.CharField(max_length=32, verbose_name='kind')),
+                ('object_id', models.BigIntegerField(verbose_name='object id')),
+                ('action', models.CharField(choices=[('create', 'Create'), ('update', 'Update'), ('delete', 'Delete')], max_length=8, verbose_name='action')),
+                ('data', models.JSONField(default=dict, verbose_name='data')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, verbose_name='created')),
+            ],
+            options={
+                'verbose_name': 'change',
+                'verbose_name_plural': 'changes',
+                'ordering': ('sequence',),
+            },
+        ),
+        migrations.CreateModel(
+            name='ChangeFeed',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sequence', models.BigIntegerField(default=0, verbose_name='sequence')),
+                ('horizon', models.BigIntegerField(default=0, verbose_name='horizon')),
+            ],
+            options={
+                'verbose_name': 'change feed',
+                'verbose_name_plural': 'change feeds',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='change',
+            index=models.Index(fields=['kind', 'object_id', 'sequence'], name='core_change_kind_195a24_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.2.25 on 2026-10-19 01:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_change_feed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='virtualdomain',
+            name='dkim_next_key',
+            field=models.TextField(blank=True, verbose_name='next dkim key'),
+        ),
+        migrations.AddField(
+            model_name='virtualdomain',
+            name='dkim_next_key_name',
+            field=models.CharField(blank=True, max_length=200, verbose_name='next dkim key name'),
+        ),
+        migrations.AddField(
+            model_name='virtualdomain',
+            name='dkim_next_key_type',
+            field=models.CharField(blank=True, choices=[('rsa', 'RSA'), ('ed25519', 'Ed25519')], max_length=10, verbose_name='next dkim key type'),
+        ),
+        migrations.AddField(
+            model_name='virtualdomain',
+            name='dkim_next_private_key',
+            field=models.TextField(blank=True, verbose_name='next dkim private key'),
+        ),
+    ]
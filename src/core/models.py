@@ -14,12 +14,16 @@
 # You should have received a copy of the GNU General Public License
 # along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
+import contextvars
+import datetime
 import re
 
-import dns.resolver
+from asgiref.sync import sync_to_async
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Sum
 from django.db.models import signals
 from django.db.models.signals import post_save
 from django.dispatch import receiver
@@ -27,11 +31,87 @@ from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from tastypie.models import create_api_key
 
+from .records import is_spf_record, parse_dkim, parse_dmarc, txt_value
+from .registry import get_domain, get_domain_by_name
+from .resolver import aresolve, resolve
+from .spf import SpfEvaluator
+from .tracing import traced
 from .utils import make_password, random_password
 
 # Automatically create api key for user
 signals.post_save.connect(create_api_key, sender=User)
 
+# Primary keys of the domains being deleted by VirtualDomain.delete. The counters of their users
+# and aliases are not updated row by row (see core.signals).
+DELETING_DOMAINS = contextvars.ContextVar("deleting_domains", default=frozenset())
+
+# Fields of the DKIM keys of a domain, written by key generation and rotation
+DKIM_KEY_FIELDS = (
+    "dkim_key_name",
+    "dkim_key_type",
+    "dkim_key",
+    "dkim_private_key",
+    "dkim_key_created",
+    "dkim_next_key_name",
+    "dkim_next_key_type",
+    "dkim_next_key",
+    "dkim_next_private_key",
+)
+
+
+def readable_size(value):
+    """Return a readable value for a size.
+
+    Args:
+        value (int): size in bytes.
+
+    Returns:
+        string: human (readable) value (B, kB, MB, GB)
+    """
+    if value < 1000:
+        return "{} B".format(value)
+    elif value < 1000000:
+        return "{} kB".format(int(value / 1000))
+    elif value < 1000000000:
+        return "{} MB".format(int(value / 1000000))
+    else:
+        return "{} GB".format(int(value / 1000000000))
+
+
+def related_domain(instance):
+    """Return the domain of a user or an alias, from the domain registry if not loaded yet.
+
+    Args:
+        instance (VirtualUser or VirtualAlias): the user or the alias.
+
+    Returns:
+        VirtualDomain: the domain.
+    """
+    field = instance._meta.get_field("domain")
+    if not field.is_cached(instance) and instance.domain_id is not None:
+        domain = get_domain(instance.domain_id)
+        if domain is not None:
+            field.set_cached_value(instance, domain)
+    return instance.domain
+
+
+def locked_counter(domain):
+    """Return the counters of a domain, to check its limits.
+
+    In a transaction (as in the saves of users and aliases), the row stays locked until the
+    commit, so concurrent saves can't both pass the check of the same last free slot.
+
+    Args:
+        domain (VirtualDomain): the domain.
+
+    Returns:
+        DomainCounter: the counters, None if missing.
+    """
+    counters = DomainCounter.objects.filter(domain=domain)
+    if transaction.get_connection().in_atomic_block:
+        counters = counters.select_for_update()
+    return counters.first()
+
 
 class VirtualDomain(models.Model):
     """Model to store virtual domains.
@@ -42,6 +122,14 @@ class VirtualDomain(models.Model):
         name (string): name of the domain (example.org by instance). This is the only required field.
         dkim_key_name (string): name of the dkim key (as in the dns record name).
         dkim_key (string): the value of the dkim public key.
+        dkim_key_type (string): type of the dkim key (picked from DkimKeyType).
+        dkim_private_key (string): the dkim private key (PEM), if generated by DinoMail.
+        dkim_key_created (date): date the dkim key was generated by DinoMail.
+        dkim_next_key_name (string): selector of the key replacing the current one once its DNS
+            record is published (see promote_dkim_key).
+        dkim_next_key (string): public key replacing the current one.
+        dkim_next_key_type (string): type of the key replacing the current one.
+        dkim_next_private_key (string): private key (PEM) replacing the current one.
         dkim_status (int): stored value of the dkim status (picked form DkimStatus).
         dkim_last_update (date): last time the dkim_status attribute was updated.
         display_name (string): display name for te xml autconfiguration file.
@@ -49,6 +137,12 @@ class VirtualDomain(models.Model):
         imap_address (string): imap address for the xml autoconfiguration file. If not set, imap.(name of domain) is used.
         pop_address (string): pop address for the xml autoconfiguration file. If not set, the pop section is ignored.
         smtp_address (string): smtp address for the xml autoconfiguration file. If not set, smtp.(name of domain) is used.
+        max_users (int): maximum number of users of the domain, unlimited if not set.
+        max_aliases (int): maximum number of aliases of the domain, unlimited if not set.
+        max_quota (int): maximum sum of the quotas of the users of the domain, in bytes, unlimited if not set.
+        deleting (bool): True if the domain is being deleted in background (see core.deletion).
+        deletion_total (int): number of rows to delete with the domain.
+        deletion_done (int): number of rows already deleted.
         """
 
     class Meta:
@@ -73,18 +167,49 @@ class VirtualDomain(models.Model):
         WRONGENTRY = 1, _("DNS record does not contain v=DMARC1")
         OK = 2, _("ok")
 
+    class DkimKeyType(models.TextChoices):
+        """Choices for DKIM key types
+        """
+
+        RSA = "rsa", _("RSA")
+        ED25519 = "ed25519", _("Ed25519")
+
     class SpfStatus(models.IntegerChoices):
         """Choices for SPF
         """
 
         NOTSET = 0, _("No DNS record for SPF")
         OK = 1, _("ok")
+        TOOMANYLOOKUPS = 2, _("SPF record needs more than 10 DNS lookups")
 
     name = models.CharField(max_length=50, unique=True, verbose_name=_("name"))
     dkim_key_name = models.CharField(
         max_length=200, blank=True, verbose_name=_("dkim key name")
     )
     dkim_key = models.TextField(blank=True, verbose_name=_("dkim key"))
+    dkim_key_type = models.CharField(
+        max_length=10,
+        choices=DkimKeyType.choices,
+        default=DkimKeyType.RSA,
+        verbose_name=_("dkim key type"),
+    )
+    dkim_private_key = models.TextField(blank=True, verbose_name=_("dkim private key"))
+    dkim_key_created = models.DateTimeField(
+        null=True, blank=True, verbose_name=_("dkim key creation date")
+    )
+    dkim_next_key_name = models.CharField(
+        max_length=200, blank=True, verbose_name=_("next dkim key name")
+    )
+    dkim_next_key = models.TextField(blank=True, verbose_name=_("next dkim key"))
+    dkim_next_key_type = models.CharField(
+        max_length=10,
+        choices=DkimKeyType.choices,
+        blank=True,
+        verbose_name=_("next dkim key type"),
+    )
+    dkim_next_private_key = models.TextField(
+        blank=True, verbose_name=_("next dkim private key")
+    )
     dkim_status = models.IntegerField(
         choices=DkimStatus.choices,
         verbose_name=_("dkim status"),
@@ -124,14 +249,57 @@ class VirtualDomain(models.Model):
     spf_last_update = models.DateTimeField(
         auto_now_add=True, verbose_name=_("spf status last update")
     )
+    max_users = models.PositiveIntegerField(
+        null=True, blank=True, verbose_name=_("maximum number of users")
+    )
+    max_aliases = models.PositiveIntegerField(
+        null=True, blank=True, verbose_name=_("maximum number of aliases")
+    )
+    max_quota = models.BigIntegerField(
+        null=True, blank=True, verbose_name=_("maximum allocated quota")
+    )
+    deleting = models.BooleanField(default=False, verbose_name=_("deleting"))
+    deletion_total = models.BigIntegerField(
+        default=0, verbose_name=_("rows to delete")
+    )
+    deletion_done = models.BigIntegerField(default=0, verbose_name=_("rows deleted"))
+
+    def deletion_progress(self):
+        """Return the progress of the deletion of the domain.
+
+        Returns:
+            int: percentage of the rows deleted
+        """
+        if not self.deletion_total:
+            return 0
+        return min(int(100 * self.deletion_done / self.deletion_total), 100)
+
+    def readable_max_quota(self):
+        """Return a readable value for the maximum allocated quota.
 
+        Returns:
+            string: readable value for the maximum allocated quota
+        """
+        return readable_size(self.max_quota)
+
+    def delete(self, *args, **kwargs):
+        """Override delete method to update the counters once for the whole domain.
+        """
+        token = DELETING_DOMAINS.set(DELETING_DOMAINS.get() | {self.pk})
+        try:
+            with transaction.atomic():
+                return super(VirtualDomain, self).delete(*args, **kwargs)
+        finally:
+            DELETING_DOMAINS.reset(token)
+
+    @traced
     def verify_dkim(self):
         """Verify the DKIM key.
 
         1. Verify if dkim_key_name and dkim_key are set
         2. Try to get the TXT record corresponding to the key
-        3. Try to extract a key from the record
-        4. Check the extracted key against the saved key
+        3. Try to extract a key from the record (the strings of the record are joined)
+        4. Check the extracted key against the saved key (whitespaces are ignored)
 
         1. If dkim_key_name or dkim_key is not set, it returns DkimStatus.NOTSET
         2. If no DNS record is found, it returns DkimStatus.NOTFOUND
@@ -144,32 +312,149 @@ class VirtualDomain(models.Model):
         """
         if self.dkim_key_name and self.dkim_key:
             try:
-                dns_answer = dns.resolver.query(
-                    "{key_name}._domainkey.{domain}".format(
-                        key_name=self.dkim_key_name, domain=self.name
-                    ),
-                    "TXT",
-                )
+                dns_answer = resolve(self.dkim_query(), "TXT")
+            except:
+                return self.DkimStatus.NOTFOUND
+            return self._dkim_status(dns_answer)
+        return self.DkimStatus.NOTSET
+
+    @traced
+    async def averify_dkim(self):
+        """Verify the DKIM key without blocking the event loop (see verify_dkim).
+
+        Returns:
+            int: dkim status
+        """
+        if self.dkim_key_name and self.dkim_key:
+            try:
+                dns_answer = await aresolve(self.dkim_query(), "TXT")
+            except:
+                return self.DkimStatus.NOTFOUND
+            return self._dkim_status(dns_answer)
+        return self.DkimStatus.NOTSET
+
+    def dkim_query(self):
+        """Return the name of the DKIM record of the domain.
+
+        Returns:
+            string: the name of the TXT record.
+        """
+        return "{key_name}._domainkey.{domain}".format(
+            key_name=self.dkim_key_name, domain=self.name
+        )
+
+    def dkim_status_of(self, dns_answer):
+        """Return the DKIM status given by the DNS answer of the DKIM record of the domain.
+
+        Args:
+            dns_answer (list): TXT records of dkim_query, empty if the query failed.
+
+        Returns:
+            int: dkim status (see verify_dkim)
+        """
+        if not (self.dkim_key_name and self.dkim_key):
+            return self.DkimStatus.NOTSET
+        if not dns_answer:
+            return self.DkimStatus.NOTFOUND
+        return self._dkim_status(dns_answer)
+
+    def _dkim_status(self, dns_answer, dkim_key=None):
+        key = parse_dkim(txt_value(dns_answer[0]))
+        if key is None:
+            return self.DkimStatus.NODNSKEY
+        if key != "".join((self.dkim_key if dkim_key is None else dkim_key).split()):
+            return self.DkimStatus.NOMATCH
+        return self.DkimStatus.OK
+
+    def dkim_record(self):
+        """Return the DKIM DNS record to publish for the key.
+
+        Returns:
+            string: the value of the TXT record, or None if no key is set.
+        """
+        if not self.dkim_key:
+            return None
+        return "v=DKIM1; k={}; p={}".format(self.dkim_key_type, self.dkim_key)
+
+    def dkim_next_query(self):
+        """Return the name of the DKIM record of the key replacing the current one.
+
+        Returns:
+            string: the name of the TXT record.
+        """
+        return "{key_name}._domainkey.{domain}".format(
+            key_name=self.dkim_next_key_name, domain=self.name
+        )
+
+    def dkim_next_record(self):
+        """Return the DKIM DNS record to publish for the key replacing the current one.
+
+        Returns:
+            string: the value of the TXT record, or None if no key is waiting.
+        """
+        if not self.dkim_next_key:
+            return None
+        return "v=DKIM1; k={}; p={}".format(
+            self.dkim_next_key_type, self.dkim_next_key
+        )
+
+    @traced
+    def verify_dkim_next(self):
+        """Verify the DKIM record of the key replacing the current one (see verify_dkim).
+
+        Returns:
+            int: dkim status of the next key.
+        """
+        if self.dkim_next_key_name and self.dkim_next_key:
+            try:
+                dns_answer = resolve(self.dkim_next_query(), "TXT")
             except:
                 return self.DkimStatus.NOTFOUND
-            text = dns_answer[0].to_text()
-            match = re.match('^"(.*;\s?)*p=([^;"]*).*$', text)
-            if not match:
-                return self.DkimStatus.NODNSKEY
-            if match.groups()[-1] != self.dkim_key:
-                return self.DkimStatus.NOMATCH
-            return self.DkimStatus.OK
+            return self._dkim_status(dns_answer, self.dkim_next_key)
         return self.DkimStatus.NOTSET
 
-    def update_dkim_status(self):
+    def promote_dkim_key(self):
+        """Replace the current DKIM key by the next one if its DNS record is published.
+
+        Rotated keys get a new selector and wait in the dkim_next_* fields, so the current key
+        keeps signing until receivers can verify the signatures of the new one.
+
+        Returns:
+            bool: True if the key was replaced.
+        """
+        if self.verify_dkim_next() != self.DkimStatus.OK:
+            return False
+        self.dkim_key_name = self.dkim_next_key_name
+        self.dkim_key = self.dkim_next_key
+        self.dkim_key_type = self.dkim_next_key_type
+        self.dkim_private_key = self.dkim_next_private_key
+        self.dkim_key_created = timezone.now()
+        self.dkim_next_key_name = ""
+        self.dkim_next_key = ""
+        self.dkim_next_key_type = ""
+        self.dkim_next_private_key = ""
+        self.dkim_status = self.DkimStatus.OK
+        self.dkim_last_update = timezone.now()
+        self.save(update_fields=DKIM_KEY_FIELDS + ("dkim_status", "dkim_last_update"))
+        return True
+
+    def update_dkim_status(self, dns_answer=None):
         """Update the dkim status and update the date.
 
         TODO : Auto update after model save.
+
+        Args:
+            dns_answer (list): TXT records of dkim_query if already queried (empty if the query
+                failed), to avoid querying the DNS again.
         """
-        self.dkim_status = self.verify_dkim()
+        if dns_answer is None:
+            self.dkim_status = self.verify_dkim()
+        else:
+            self.dkim_status = self.dkim_status_of(dns_answer)
         self.dkim_last_update = timezone.now()
-        self.save()
+        self.save(update_fields=["dkim_status", "dkim_last_update"])
 
+    @traced
     def verify_dmarc(self):
         """Verify the DMARC entry.
 
@@ -182,18 +467,30 @@ class VirtualDomain(models.Model):
             int: dmarc status
         """
         try:
-            dns_answer = dns.resolver.query(
+            dns_answer = resolve("_dmarc.{domain}".format(domain=self.name), "TXT")
+        except:
+            return self.DmarcStatus.NOTSET
+        return self._dmarc_status(dns_answer)
+
+    @traced
+    async def averify_dmarc(self):
+        """Verify the DMARC entry without blocking the event loop (see verify_dmarc).
+
+        Returns:
+            int: dmarc status
+        """
+        try:
+            dns_answer = await aresolve(
                 "_dmarc.{domain}".format(domain=self.name), "TXT"
             )
         except:
             return self.DmarcStatus.NOTSET
-        text = dns_answer[0].to_text()
-        if "v=DMARC1" not in text:
+        return self._dmarc_status(dns_answer)
+
+    def _dmarc_status(self, dns_answer):
+        tags = parse_dmarc(txt_value(dns_answer[0]))
+        if tags is None or "p" not in tags:
             return self.DmarcStatus.WRONGENTRY
-        else:
-            match = re.match('^"(.*;\s?)*p=([^;"]*).*$', text)
-            if not match:
-                return self.DmarcStatus.WRONGENTRY
         return self.DmarcStatus.OK
 
     def update_dmarc_status(self):
@@ -201,34 +498,83 @@ class VirtualDomain(models.Model):
         """
         self.dmarc_status = self.verify_dmarc()
         self.dmarc_last_update = timezone.now()
-        self.save()
+        self.save(update_fields=["dmarc_status", "dmarc_last_update"])
 
+    @traced
     def verify_spf(self):
         """Verify the SPF entry.
 
         1. Get all DNS TXT entries.
-        2. Check if one of them has the tag v=spf1.
-        3. If yes, return SpfStatus.OK
-        4. If not, return SpfStatus,NOTSET
+        2. Check if one of them starts with the version term v=spf1.
+        3. If yes, expand its includes and redirects and count the DNS lookups.
+        4. If there are more than 10 lookups, return SpfStatus.TOOMANYLOOKUPS
+        5. If not, return SpfStatus.OK
+        6. If no SPF record is found, return SpfStatus.NOTSET
 
         Returns:
             int: spf status
         """
         try:
-            dns_answer = dns.resolver.query("{domain}".format(domain=self.name), "TXT")
+            dns_answer = resolve("{domain}".format(domain=self.name), "TXT")
         except:
-            return self.DmarcStatus.NOTSET
+            return self.SpfStatus.NOTSET
         for answer in dns_answer:
-            if "v=spf1" in answer.to_text():
-                return self.SpfStatus.OK
+            value = txt_value(answer)
+            if is_spf_record(value):
+                return self.spf_status_of(
+                    SpfEvaluator().evaluate(self.name, flatten=False, record=value)
+                )
         return self.SpfStatus.NOTSET
 
-    def update_spf_status(self):
-        """Update the dmarc status and update the date.
+    @traced
+    async def averify_spf(self):
+        """Verify the SPF entry without blocking the event loop (see verify_spf).
+
+        Returns:
+            int: spf status
+        """
+        try:
+            dns_answer = await aresolve("{domain}".format(domain=self.name), "TXT")
+        except:
+            return self.SpfStatus.NOTSET
+        for answer in dns_answer:
+            value = txt_value(answer)
+            if is_spf_record(value):
+                return self.spf_status_of(
+                    await SpfEvaluator().aevaluate(
+                        self.name, flatten=False, record=value
+                    )
+                )
+        return self.SpfStatus.NOTSET
+
+    def spf_status_of(self, result):
+        """Return the SPF status given by the expansion of the SPF record of the domain.
+
+        Args:
+            result (SpfResult): the expansion.
+
+        Returns:
+            int: spf status
         """
-        self.spf_status = self.verify_spf()
+        if result.record is None:
+            return self.SpfStatus.NOTSET
+        if result.exceeds_limit:
+            return self.SpfStatus.TOOMANYLOOKUPS
+        return self.SpfStatus.OK
+
+    def update_spf_status(self, result=None):
+        """Update the spf status and update the date.
+
+        Args:
+            result (SpfResult): expansion of the SPF record of the domain if already made, to
+                avoid querying the DNS again.
+        """
+        if result is None:
+            self.spf_status = self.verify_spf()
+        else:
+            self.spf_status = self.spf_status_of(result)
         self.spf_last_update = timezone.now()
-        self.save()
+        self.save(update_fields=["spf_status", "spf_last_update"])
 
     def update_status(self):
         """Update the dkim status, dmarc status and spf status.
@@ -237,6 +583,56 @@ class VirtualDomain(models.Model):
         self.update_dmarc_status()
         self.update_spf_status()
 
+    async def aupdate_status(self, checks=("dkim", "dmarc", "spf")):
+        """Update statuses from a coroutine.
+
+        The checks run concurrently and the domain is saved once, in a thread.
+
+        Args:
+            checks (tuple): statuses to update, among dkim, dmarc and spf.
+        """
+        statuses = await asyncio.gather(
+            *(getattr(self, "averify_{}".format(check))() for check in checks)
+        )
+        now = timezone.now()
+        fields = []
+        for check, status in zip(checks, statuses):
+            setattr(self, "{}_status".format(check), status)
+            setattr(self, "{}_last_update".format(check), now)
+            fields += ["{}_status".format(check), "{}_last_update".format(check)]
+        await sync_to_async(self.save)(update_fields=fields)
+
+    def dmarc_statistics(self, days=30):
+        """Compute statistics from the DMARC aggregate reports of the domain.
+
+        Args:
+            days (int): number of days to consider.
+
+        Returns:
+            dict: number of messages, rates (in percent, None without messages) and the 10 main source IPs.
+        """
+        since = timezone.now().date() - datetime.timedelta(days=days)
+        aggregates = self.dmarcaggregate_set.filter(date__gte=since)
+        counters = ("dkim_pass", "spf_pass", "dmarc_pass", "quarantined", "rejected")
+        totals = aggregates.aggregate(
+            messages=Sum("messages"), **{name: Sum(name) for name in counters}
+        )
+        messages = totals["messages"] or 0
+        sources = (
+            aggregates.values("source_ip")
+            .annotate(messages=Sum("messages"), dmarc_pass=Sum("dmarc_pass"))
+            .order_by("-messages")[:10]
+        )
+        return {
+            "days": days,
+            "messages": messages,
+            "rates": {
+                name: 100 * (totals[name] or 0) / messages if messages else None
+                for name in counters
+            },
+            "sources": list(sources),
+        }
+
     def __str__(self):
         """str method for virtual domains.
 
@@ -298,15 +694,31 @@ class VirtualUser(models.Model):
         Returns:
             string: readable value for the quota
         """
-        value = self.quota
-        if value < 1000:
-            return "{} B".format(value)
-        elif value < 1000000:
-            return "{} kB".format(int(value / 1000))
-        elif value < 1000000000:
-            return "{} MB".format(int(value / 1000000))
-        else:
-            return "{} GB".format(int(value / 1000000000))
+        return readable_size(self.quota)
+
+    def readable_usage(self):
+        """Return a readable value for the storage used by the user.
+
+        Usage is known once imported from dovecot (see QuotaUsage).
+
+        Returns:
+            string: readable value for the storage used, "-" if unknown
+        """
+        usage = getattr(self, "quota_usage", None)
+        if usage is None:
+            return "-"
+        return readable_size(usage.storage)
+
+    def usage_percent(self):
+        """Return the share of the quota used by the user.
+
+        Returns:
+            int: percentage of the quota used, None if the usage or the quota is unknown
+        """
+        usage = getattr(self, "quota_usage", None)
+        if usage is None or not self.quota:
+            return None
+        return int(100 * usage.storage / self.quota)
 
     def clean(self):
         """Clean method for the model.
@@ -314,26 +726,73 @@ class VirtualUser(models.Model):
         It should not be possible to create a user with an email that does not correspond to one of the managed domains.
 
         Raises:
-            ValidationError: if the email domain and domain don't match.
+            ValidationError: if the email domain and domain don't match, or if the domain is being deleted.
         """
         match = re.match("^[^@]*@(.*)$", self.email)
         domain = None
         if match:
             domain = match.groups()[0]
+        related_domain(self)
         if domain != self.domain.name:
             raise ValidationError(
                 _(
                     "The domain of {email} ({email_domain}) is not the same as the domain {domain}"
                 ).format(email=self.email, email_domain=domain, domain=self.domain.name)
             )
+        if self.domain.deleting:
+            raise ValidationError(
+                _("The domain {domain} is being deleted").format(domain=self.domain.name)
+            )
+        self.check_limits()
+
+    def check_limits(self):
+        """Check the limits of the domain of the user.
+
+        Limits are checked against the counters of the domain, whatever its size. The counters
+        are locked by the transaction of save (see locked_counter).
+
+        Raises:
+            ValidationError: if the domain has too many users or too much allocated quota.
+        """
+        domain = self.domain
+        if domain.max_users is None and domain.max_quota is None:
+            return
+        counter = locked_counter(domain)
+        if counter is None:
+            return
+        previous = (
+            VirtualUser.objects.filter(pk=self.pk).values("domain_id", "quota").first()
+            if self.pk
+            else None
+        )
+        moved = previous is None or previous["domain_id"] != domain.pk
+        if domain.max_users is not None and moved:
+            if counter.users >= domain.max_users:
+                raise ValidationError(
+                    _("The domain {domain} can't have more than {count} users").format(
+                        domain=domain.name, count=domain.max_users
+                    )
+                )
+        if domain.max_quota is not None:
+            quota = counter.quota + (self.quota or 0)
+            if not moved:
+                quota -= previous["quota"] or 0
+            if quota > domain.max_quota:
+                raise ValidationError(
+                    _(
+                        "The quotas of the users of {domain} can't exceed {quota}"
+                    ).format(domain=domain.name, quota=readable_size(domain.max_quota))
+                )
 
     def save(self, *args, **kwargs):
         """Override save method to call full clean before saving.
 
-        Note that full clean itself calls clean.
+        Note that full clean itself calls clean. The counters are updated in the same
+        transaction (see core.signals).
         """
-        self.full_clean()
-        return super(VirtualUser, self).save(*args, **kwargs)
+        with transaction.atomic():
+            self.full_clean()
+            return super(VirtualUser, self).save(*args, **kwargs)
 
 
 class VirtualAlias(models.Model):
@@ -352,7 +811,7 @@ class VirtualAlias(models.Model):
     domain = models.ForeignKey(
         VirtualDomain, on_delete=models.CASCADE, verbose_name=_("domain")
     )
-    source = models.EmailField(verbose_name=_("source"))
+    source = models.EmailField(db_index=True, verbose_name=_("source"))
     destination = models.EmailField(verbose_name=_("destination"))
 
     def __str__(self):
@@ -362,15 +821,16 @@ class VirtualAlias(models.Model):
         """Tets if an alias is considered as exterior.
 
         An alias is considered as exterior if the domain of the destination is not one of the managed domains.
+        Managed domains are looked up in the domain registry (see core.registry).
 
         Returns:
             bool: True if the destination domain is not managed by the system and False otherwise
         """
+        if hasattr(self, "_exterior"):
+            return self._exterior
         match = re.match("^[^@]*@(.*)$", self.destination)
         if match:
-            destination_domain = match.group(1)
-            domains = VirtualDomain.objects.filter(name=destination_domain)
-            if domains:
+            if get_domain_by_name(match.group(1)) is not None:
                 return False
         return True
 
@@ -382,6 +842,8 @@ class VirtualAlias(models.Model):
         Returns:
             bool: True if the destination email exists or is an exterior alias
         """
+        if hasattr(self, "_verified"):
+            return self._verified
         if not self.exterior():
             emails = VirtualUser.objects.filter(email=self.destination)
             aliases = VirtualAlias.objects.filter(source=self.destination)
@@ -389,16 +851,61 @@ class VirtualAlias(models.Model):
                 return False
         return True
 
+    @classmethod
+    def prefetch_status(cls, aliases, batch_size=500):
+        """Compute exterior and verify for a list of aliases.
+
+        The results are computed with a few queries per batch of aliases instead of several
+        queries per alias, and returned by exterior and verify afterwards.
+
+        Args:
+            aliases (iterable): the aliases.
+            batch_size (int): number of aliases per query.
+
+        Returns:
+            list: the aliases.
+        """
+        aliases = list(aliases)
+        for i in range(0, len(aliases), batch_size):
+            batch = aliases[i : i + batch_size]
+            destinations = {alias.destination for alias in batch}
+            domains = set()
+            for destination in destinations:
+                match = re.match("^[^@]*@(.*)$", destination)
+                if match:
+                    domains.add(match.group(1))
+            managed = set(
+                VirtualDomain.objects.filter(name__in=domains).values_list(
+                    "name", flat=True
+                )
+            )
+            existing = set(
+                VirtualUser.objects.filter(email__in=destinations).values_list(
+                    "email", flat=True
+                )
+            )
+            existing.update(
+                cls.objects.filter(source__in=destinations).values_list(
+                    "source", flat=True
+                )
+            )
+            for alias in batch:
+                match = re.match("^[^@]*@(.*)$", alias.destination)
+                alias._exterior = not match or match.group(1) not in managed
+                alias._verified = alias._exterior or alias.destination in existing
+        return aliases
+
     def clean(self):
         """Clean method for the model.
 
         It should not be possible to create an alias with a source email that does not correspond to one of the managed domains.
 
         Raises:
-            ValidationError: if the source domain and domain don't match.
+            ValidationError: if the source domain and domain don't match, or if the domain is being deleted.
         """
         match = re.match("^[^@]*@(.*)$", self.source)
         domain = match.groups()[0]
+        related_domain(self)
         if domain != self.domain.name:
             raise ValidationError(
                 _(
@@ -407,11 +914,381 @@ class VirtualAlias(models.Model):
                     email=self.source, email_domain=domain, domain=self.domain.name
                 )
             )
+        if self.domain.deleting:
+            raise ValidationError(
+                _("The domain {domain} is being deleted").format(domain=self.domain.name)
+            )
+        self.check_limits()
+
+    def check_limits(self):
+        """Check the limits of the domain of the alias.
+
+        Raises:
+            ValidationError: if the domain has too many aliases.
+        """
+        domain = self.domain
+        if domain.max_aliases is None:
+            return
+        if self.pk and VirtualAlias.objects.filter(pk=self.pk, domain=domain).exists():
+            return
+        counter = locked_counter(domain)
+        if counter is not None and counter.aliases >= domain.max_aliases:
+            raise ValidationError(
+                _("The domain {domain} can't have more than {count} aliases").format(
+                    domain=domain.name, count=domain.max_aliases
+                )
+            )
 
     def save(self, *args, **kwargs):
         """Override save method to call full clean before saving.
 
-        Note that full clean itself calls clean.
+        Note that full clean itself calls clean. The counters are updated in the same
+        transaction (see core.signals).
         """
-        self.full_clean()
-        return super(VirtualAlias, self).save(*args, **kwargs)
+        with transaction.atomic():
+            self.full_clean()
+            return super(VirtualAlias, self).save(*args, **kwargs)
+
+
+class DmarcReport(models.Model):
+    """Model to store the DMARC aggregate reports already imported.
+
+    It is used to avoid counting a report twice.
+
+    Args:
+        org_name (string): name of the organization sending the report.
+        report_id (string): identifier of the report given by the organization.
+        domain (VirtualDomain): domain the report is about.
+        date (date): day the report starts.
+    """
+
+    class Meta:
+        verbose_name = _("DMARC report")
+        verbose_name_plural = _("DMARC reports")
+        unique_together = ("org_name", "report_id")
+
+    org_name = models.CharField(max_length=255, verbose_name=_("organization"))
+    report_id = models.CharField(max_length=255, verbose_name=_("report id"))
+    domain = models.ForeignKey(
+        VirtualDomain, on_delete=models.CASCADE, verbose_name=_("domain")
+    )
+    date = models.DateField(verbose_name=_("date"))
+
+    def __str__(self):
+        return "{} {}".format(self.org_name, self.report_id)
+
+
+class DmarcAggregate(models.Model):
+    """Model to store DMARC aggregate report results.
+
+    Results are summed per domain, day and source IP.
+
+    Args:
+        domain (VirtualDomain): domain the reports are about.
+        date (date): day of the reports.
+        source_ip (string): IP address sending the messages.
+        messages (int): number of messages.
+        dkim_pass (int): number of messages with an aligned DKIM signature.
+        spf_pass (int): number of messages with an aligned SPF pass.
+        dmarc_pass (int): number of messages passing DMARC (aligned DKIM or SPF).
+        quarantined (int): number of messages quarantined by the receiver.
+        rejected (int): number of messages rejected by the receiver.
+    """
+
+    class Meta:
+        verbose_name = _("DMARC aggregate")
+        verbose_name_plural = _("DMARC aggregates")
+        unique_together = ("domain", "date", "source_ip")
+
+    domain = models.ForeignKey(
+        VirtualDomain, on_delete=models.CASCADE, verbose_name=_("domain")
+    )
+    date = models.DateField(verbose_name=_("date"))
+    source_ip = models.GenericIPAddressField(verbose_name=_("source IP"))
+    messages = models.PositiveIntegerField(default=0, verbose_name=_("messages"))
+    dkim_pass = models.PositiveIntegerField(default=0, verbose_name=_("DKIM pass"))
+    spf_pass = models.PositiveIntegerField(default=0, verbose_name=_("SPF pass"))
+    dmarc_pass = models.PositiveIntegerField(default=0, verbose_name=_("DMARC pass"))
+    quarantined = models.PositiveIntegerField(
+        default=0, verbose_name=_("quarantined")
+    )
+    rejected = models.PositiveIntegerField(default=0, verbose_name=_("rejected"))
+
+    def __str__(self):
+        return "{} {} {}".format(self.domain, self.date, self.source_ip)
+
+
+class QuotaUsage(models.Model):
+    """Model to store the storage and messages used by virtual users.
+
+    Usage is reported by dovecot and written in batches (see core.quota).
+
+    Args:
+        user (VirtualUser): the user.
+        storage (int): storage used, in bytes.
+        messages (int): number of messages.
+        last_update (datetime): date of the last change of the usage.
+    """
+
+    class Meta:
+        verbose_name = _("quota usage")
+        verbose_name_plural = _("quota usages")
+
+    user = models.OneToOneField(
+        VirtualUser,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="quota_usage",
+        verbose_name=_("user"),
+    )
+    storage = models.BigIntegerField(default=0, verbose_name=_("storage"))
+    messages = models.BigIntegerField(default=0, verbose_name=_("messages"))
+    last_update = models.DateTimeField(
+        default=timezone.now, verbose_name=_("last update")
+    )
+
+    def __str__(self):
+        return str(self.user_id)
+
+
+class DomainCounter(models.Model):
+    """Model to store the number of users and aliases and the allocated quota of a domain.
+
+    Counters are updated with the users and aliases (see core.signals), and can be recomputed
+    with the reconcile_counters command.
+
+    Args:
+        domain (VirtualDomain): the domain.
+        users (int): number of users.
+        aliases (int): number of aliases.
+        quota (int): sum of the quotas of the users, in bytes.
+    """
+
+    class Meta:
+        verbose_name = _("domain counter")
+        verbose_name_plural = _("domain counters")
+
+    domain = models.OneToOneField(
+        VirtualDomain,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="counter",
+        verbose_name=_("domain"),
+    )
+    users = models.BigIntegerField(default=0, verbose_name=_("users"))
+    aliases = models.BigIntegerField(default=0, verbose_name=_("aliases"))
+    quota = models.BigIntegerField(default=0, verbose_name=_("allocated quota"))
+
+    def __str__(self):
+        return str(self.domain_id)
+
+    def readable_quota(self):
+        """Return a readable value for the allocated quota.
+
+        Returns:
+            string: readable value for the allocated quota
+        """
+        return readable_size(self.quota)
+
+
+class GlobalCounter(models.Model):
+    """Model to store the total number of domains, users and aliases and the allocated quota.
+
+    The table has a single row, see core.counters.
+
+    Args:
+        domains (int): number of domains.
+        users (int): number of users.
+        aliases (int): number of aliases.
+        quota (int): sum of the quotas of the users, in bytes.
+    """
+
+    class Meta:
+        verbose_name = _("global counter")
+        verbose_name_plural = _("global counters")
+
+    domains = models.BigIntegerField(default=0, verbose_name=_("domains"))
+    users = models.BigIntegerField(default=0, verbose_name=_("users"))
+    aliases = models.BigIntegerField(default=0, verbose_name=_("aliases"))
+    quota = models.BigIntegerField(default=0, verbose_name=_("allocated quota"))
+
+    def __str__(self):
+        return "global"
+
+
+class Job(models.Model):
+    """Model to store background jobs.
+
+    Jobs are enqueued by the views and run by the run_workers command (see core.jobs).
+
+    Args:
+        kind (string): name of the handler running the job.
+        arguments (dict): keyword arguments of the handler.
+        state (string): pending, running, done or failed.
+        progress (int): progress, in percent.
+        message (string): description of the current step.
+        result (object): value returned by the handler.
+        error (string): traceback of the failure.
+        user (User): user who enqueued the job.
+        worker (string): worker running or having run the job.
+        attempts (int): number of times the job was claimed by a worker.
+        created (datetime): date the job was enqueued.
+        started (datetime): date the job was last claimed.
+        finished (datetime): date the job ended.
+        heartbeat (datetime): date of the last sign of life of the worker.
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    STATE_CHOICES = (
+        (PENDING, _("Pending")),
+        (RUNNING, _("Running")),
+        (DONE, _("Done")),
+        (FAILED, _("Failed")),
+    )
+
+    class Meta:
+        verbose_name = _("job")
+        verbose_name_plural = _("jobs")
+        ordering = ("-created", "-pk")
+        indexes = [models.Index(fields=["state", "created"])]
+
+    kind = models.CharField(max_length=64, verbose_name=_("kind"))
+    arguments = models.JSONField(default=dict, verbose_name=_("arguments"))
+    state = models.CharField(
+        max_length=16,
+        choices=STATE_CHOICES,
+        default=PENDING,
+        verbose_name=_("state"),
+    )
+    progress = models.PositiveSmallIntegerField(default=0, verbose_name=_("progress"))
+    message = models.CharField(max_length=255, blank=True, verbose_name=_("message"))
+    result = models.JSONField(null=True, blank=True, verbose_name=_("result"))
+    error = models.TextField(blank=True, verbose_name=_("error"))
+    user = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        verbose_name=_("user"),
+    )
+    worker = models.CharField(max_length=255, blank=True, verbose_name=_("worker"))
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name=_("attempts"))
+    created = models.DateTimeField(default=timezone.now, verbose_name=_("created"))
+    started = models.DateTimeField(null=True, blank=True, verbose_name=_("started"))
+    finished = models.DateTimeField(null=True, blank=True, verbose_name=_("finished"))
+    heartbeat = models.DateTimeField(
+        null=True, blank=True, verbose_name=_("heartbeat")
+    )
+
+    def __str__(self):
+        return "{} #{}".format(self.kind, self.pk)
+
+    def is_active(self):
+        """Test if the job is pending or running.
+
+        Returns:
+            bool: True if the job is not finished.
+        """
+        return self.state in (self.PENDING, self.RUNNING)
+
+    def owned(self):
+        """Return a queryset of the job, empty if it was claimed again since this instance.
+
+        Returns:
+            QuerySet: the job, if it still has the worker and the attempt of this instance.
+        """
+        return Job.objects.filter(pk=self.pk, worker=self.worker, attempts=self.attempts)
+
+    def set_progress(self, progress, message=None):
+        """Record the progress of the job and the heartbeat of its worker.
+
+        The row is only written when the progress or the message change, the heartbeat is
+        also refreshed by a thread of the worker (see core.jobs.run_job).
+
+        Args:
+            progress (float): progress, in percent.
+            message (string): description of the current step, unchanged if None.
+        """
+        progress = max(0, min(int(progress), 100))
+        if message is None:
+            message = self.message
+        if progress == self.progress and message == self.message:
+            return
+        self.progress = progress
+        self.message = message[:255]
+        self.heartbeat = timezone.now()
+        self.owned().update(
+            progress=self.progress, message=self.message, heartbeat=self.heartbeat
+        )
+
+
+class ChangeFeed(models.Model):
+    """Model to store the state of the change feed.
+
+    The table has a single row, see core.changes.
+
+    Args:
+        sequence (int): sequence number of the last change.
+        horizon (int): sequence number of the last deletion removed by compaction. Consumers
+            that are behind must download everything again.
+    """
+
+    class Meta:
+        verbose_name = _("change feed")
+        verbose_name_plural = _("change feeds")
+
+    sequence = models.BigIntegerField(default=0, verbose_name=_("sequence"))
+    horizon = models.BigIntegerField(default=0, verbose_name=_("horizon"))
+
+    def __str__(self):
+        return "changes"
+
+
+class Change(models.Model):
+    """Model to store the changes of domains, users and aliases.
+
+    Changes are appended by signal receivers (see core.signals) with increasing sequence
+    numbers, in the order their transactions commit.
+
+    Args:
+        sequence (int): sequence number of the change.
+        kind (string): model name of the changed object (virtualdomain, virtualuser or virtualalias).
+        object_id (int): primary key of the changed object.
+        action (string): create, update or delete.
+        data (dict): fields of the object after the change (before its deletion).
+        created (datetime): date of the change.
+    """
+
+    CREATE = "create"
+    UPDATE = "update"
+    DELETE = "delete"
+
+    ACTION_CHOICES = (
+        (CREATE, _("Create")),
+        (UPDATE, _("Update")),
+        (DELETE, _("Delete")),
+    )
+
+    class Meta:
+        verbose_name = _("change")
+        verbose_name_plural = _("changes")
+        ordering = ("sequence",)
+        indexes = [models.Index(fields=["kind", "object_id", "sequence"])]
+
+    sequence = models.BigIntegerField(primary_key=True, verbose_name=_("sequence"))
+    kind = models.CharField(max_length=32, verbose_name=_("kind"))
+    object_id = models.BigIntegerField(verbose_name=_("object id"))
+    action = models.CharField(
+        max_length=8, choices=ACTION_CHOICES, verbose_name=_("action")
+    )
+    data = models.JSONField(default=dict, verbose_name=_("data"))
+    created = models.DateTimeField(default=timezone.now, verbose_name=_("created"))
+
+    def __str__(self):
+        return "#{} {} {} {}".format(
+            self.sequence, self.action, self.kind, self.object_id
+        )
@@ -0,0 +1,155 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Profiling of single requests.
+
+The time of a request is split into view, template rendering and database time. Queries made
+while a template is rendered (lazy querysets) are counted as database time, not template time.
+"""
+import cProfile
+import io
+import pstats
+import sys
+import time
+import tracemalloc
+
+from django.template.base import Template
+
+from .queries import QueryRecorder
+
+TEMPLATE_RENDER = Template.render.__code__
+
+
+class TemplateAwareRecorder(QueryRecorder):
+    """Query recorder telling apart the queries made while rendering a template.
+
+    Attributes:
+        template_duration (float): time of the queries made inside templates, in seconds.
+    """
+
+    def __init__(self, using=None):
+        super().__init__(using)
+        self.template_duration = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        count = len(self.queries)
+        try:
+            return super().__call__(execute, sql, params, many, context)
+        finally:
+            frame = sys._getframe(1)
+            while frame is not None:
+                if frame.f_code is TEMPLATE_RENDER:
+                    self.template_duration += self.queries[count][1]
+                    break
+                frame = frame.f_back
+
+
+class RequestProfile:
+    """Profile of a request.
+
+    Args:
+        memory (bool): also trace memory allocations with tracemalloc.
+
+    Attributes:
+        stats (pstats.Stats): statistics of the profile.
+        split (dict): total, view, template and db times in milliseconds, and number of queries.
+        memory_stats (list): top allocation sites, if memory is traced.
+        peak_memory (int): peak of traced memory in bytes, if memory is traced.
+    """
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.stats = None
+        self.split = {}
+        self.memory_stats = []
+        self.peak_memory = 0
+
+    def run(self, function, *args):
+        """Call a function under the profiler.
+
+        Args:
+            function (function): the function.
+            args: arguments of the function.
+
+        Returns:
+            object: the value returned by the function.
+        """
+        profiler = cProfile.Profile()
+        recorder = TemplateAwareRecorder()
+        started_tracing = False
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            started_tracing = True
+        start = time.perf_counter()
+        try:
+            with recorder.record():
+                profiler.enable()
+                try:
+                    return function(*args)
+                finally:
+                    profiler.disable()
+        finally:
+            total = time.perf_counter() - start
+            if self.memory:
+                snapshot = tracemalloc.take_snapshot()
+                self.peak_memory = tracemalloc.get_traced_memory()[1]
+                self.memory_stats = snapshot.statistics("lineno")[:20]
+                if started_tracing:
+                    tracemalloc.stop()
+            self.stats = pstats.Stats(profiler)
+            self._split(total, recorder)
+
+    def _split(self, total, recorder):
+        template = 0
+        for (filename, line, _), row in self.stats.stats.items():
+            if (
+                line == TEMPLATE_RENDER.co_firstlineno
+                and filename == TEMPLATE_RENDER.co_filename
+            ):
+                template = row[3]
+        db = recorder.duration
+        template = max(template - recorder.template_duration, 0)
+        self.split = {
+            "total": 1000 * total,
+            "view": 1000 * max(total - template - db, 0),
+            "template": 1000 * template,
+            "db": 1000 * db,
+            "queries": recorder.count,
+        }
+
+    def report(self, limit=50, sort="cumulative"):
+        """Return a text report of the profile.
+
+        Args:
+            limit (int): number of functions listed.
+            sort (string): sort key of the functions (see pstats).
+
+        Returns:
+            string: the report.
+        """
+        out = io.StringIO()
+        out.write(
+            "total {total:.1f} ms: view {view:.1f} ms, template {template:.1f} ms, "
+            "database {db:.1f} ms ({queries} queries)\n\n".format(**self.split)
+        )
+        if self.memory:
+            out.write("peak traced memory {:.1f} kB\n".format(self.peak_memory / 1024))
+            for statistic in self.memory_stats:
+                out.write("{}\n".format(statistic))
+            out.write("\n")
+        self.stats.stream = out
+        self.stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
@@ -0,0 +1,174 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Mail client provisioning documents: Thunderbird autoconfig, Outlook autodiscover and Apple
+configuration profiles.
+
+Documents are rendered once per domain and kept in the django cache with their ETag. The cache
+entries of a domain are deleted when the domain changes (see core.signals), so the cache should
+be shared by all the processes (memcached or redis) when several processes serve DinoMail.
+"""
+import hashlib
+import re
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.template import loader
+
+from .models import VirtualDomain
+
+# Documents indexed by kind: template and content type
+DOCUMENTS = {
+    "autoconfig": ("autoconfig.xml", "application/xml"),
+    "autodiscover": ("autodiscover.xml", "application/xml"),
+    "mobileconfig": ("mobileconfig.xml", "application/x-apple-aspen-config"),
+}
+
+# Cached value of domains that are not managed
+MISSING = "missing"
+
+# Fields of the domains used by the documents
+DOCUMENT_FIELDS = frozenset(
+    (
+        "name",
+        "display_name",
+        "short_display_name",
+        "imap_address",
+        "pop_address",
+        "smtp_address",
+    )
+)
+
+DOMAIN_RE = re.compile(r"[a-z0-9]([a-z0-9.-]{0,251}[a-z0-9])?")
+
+EMAIL_ADDRESS_RE = re.compile(rb"<(?:\w+:)?EMailAddress>([^<]{1,320})</", re.IGNORECASE)
+
+# Maximum size of autodiscover requests read
+MAX_REQUEST_SIZE = 10000
+
+
+def cache_key(kind, name):
+    """Return the cache key of a document.
+
+    Args:
+        kind (string): kind of document (see DOCUMENTS).
+        name (string): domain name.
+
+    Returns:
+        string: the cache key.
+    """
+    return "dinomail:provisioning:{}:{}".format(kind, name.lower())
+
+
+def domain_from_email(email):
+    """Return the domain of an email address.
+
+    Args:
+        email (string): the email address.
+
+    Returns:
+        string: the lowercase domain, None if the address has no valid domain.
+    """
+    _, separator, domain = (email or "").rpartition("@")
+    domain = domain.strip().lower().rstrip(".")
+    if not separator or not DOMAIN_RE.fullmatch(domain):
+        return None
+    return domain
+
+
+def email_from_autodiscover(body):
+    """Extract the email address of an Outlook autodiscover request.
+
+    The request is not parsed as XML, only its beginning is searched for the address.
+
+    Args:
+        body (bytes): body of the request.
+
+    Returns:
+        string: the email address, None if not found.
+    """
+    match = EMAIL_ADDRESS_RE.search(body[:MAX_REQUEST_SIZE])
+    if match is None:
+        return None
+    return match.group(1).decode("utf-8", errors="replace").strip()
+
+
+def document_context(domain):
+    """Build the template context of the documents of a domain.
+
+    Identifiers of Apple profiles are derived from the domain name, so that installing a new
+    profile replaces the previous one.
+
+    Args:
+        domain (VirtualDomain): the domain.
+
+    Returns:
+        dict: the context.
+    """
+    return {
+        "domain": domain,
+        "identifier": ".".join(reversed(domain.name.split("."))),
+        "profile_uuid": uuid.uuid5(uuid.NAMESPACE_DNS, domain.name),
+        "account_uuid": uuid.uuid5(uuid.NAMESPACE_DNS, "email." + domain.name),
+    }
+
+
+def get_document(kind, name):
+    """Return a provisioning document of a domain, from the cache if possible.
+
+    Unknown domains are cached too (for a shorter time), so that requests for them don't reach
+    the database either.
+
+    Args:
+        kind (string): kind of document (see DOCUMENTS).
+        name (string): domain name.
+
+    Returns:
+        tuple: content, content type and ETag of the document, None if the domain is not managed.
+    """
+    key = cache_key(kind, name)
+    document = cache.get(key)
+    if document is None:
+        domain = VirtualDomain.objects.filter(name=name, deleting=False).first()
+        if domain is None:
+            cache.set(
+                key,
+                MISSING,
+                getattr(settings, "DINOMAIL_PROVISIONING_MISSING_TIMEOUT", 60),
+            )
+            return None
+        template_name, content_type = DOCUMENTS[kind]
+        content = loader.get_template(template_name).render(document_context(domain))
+        etag = '"{}"'.format(hashlib.sha256(content.encode("utf-8")).hexdigest()[:32])
+        document = (content, content_type, etag)
+        cache.set(
+            key, document, getattr(settings, "DINOMAIL_PROVISIONING_TIMEOUT", 86400)
+        )
+    if document == MISSING:
+        return None
+    return document
+
+
+def invalidate(*names):
+    """Delete the cached documents of domains.
+
+    Args:
+        names (string): domain names.
+    """
+    cache.delete_many(
+        [cache_key(kind, name) for kind in DOCUMENTS for name in names if name]
+    )
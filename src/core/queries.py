@@ -0,0 +1,75 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Recording of the SQL queries made by DinoMail.
+"""
+import collections
+import contextlib
+import time
+
+from django.db import connections
+
+
+class QueryRecorder:
+    """Record the queries made on database connections of the current thread.
+
+    Args:
+        using (list): aliases of the databases to watch, all of them by default.
+
+    Attributes:
+        queries (list): (sql, duration in seconds) tuples. The SQL has placeholders instead of parameters.
+    """
+
+    def __init__(self, using=None):
+        self.using = using
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, time.perf_counter() - start))
+
+    @contextlib.contextmanager
+    def record(self):
+        """Context manager recording the queries made inside it."""
+        with contextlib.ExitStack() as stack:
+            for alias in self.using or connections:
+                stack.enter_context(connections[alias].execute_wrapper(self))
+            yield self
+
+    @property
+    def count(self):
+        """int: number of queries."""
+        return len(self.queries)
+
+    @property
+    def duration(self):
+        """float: total time spent in queries, in seconds."""
+        return sum(duration for _, duration in self.queries)
+
+    def repeated(self, limit=5):
+        """Return the statements run more than once, the most repeated first.
+
+        Args:
+            limit (int): maximum number of statements.
+
+        Returns:
+            list: (sql, count) tuples.
+        """
+        counter = collections.Counter(sql for sql, _ in self.queries)
+        return [(sql, count) for sql, count in counter.most_common(limit) if count > 1]
@@ -0,0 +1,172 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Ingestion of the quota usage reported by dovecot.
+
+Reports are coalesced in memory, per user, and written in batches: a batch costs a few queries
+whatever the number of reports, and users whose usage did not change are not written at all.
+"""
+import threading
+import time
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import QuotaUsage, VirtualUser
+
+# Fields of QuotaUsage set from the reports
+FIELDS = ("storage", "messages")
+
+# doveadm quota types
+DOVEADM_TYPES = {"STORAGE": "storage", "MESSAGE": "messages"}
+
+
+class QuotaBuffer:
+    """Buffer coalescing quota usage reports and writing them as batched upserts.
+
+    Only the last report of a user is kept until the buffer is flushed. The buffer can be used
+    by several threads.
+
+    Args:
+        batch_size (int): number of users per batch of queries, and number of pending users
+            triggering a flush in add.
+        flush_interval (float): time, in seconds, after which add flushes the pending reports.
+
+    Attributes:
+        stats (dict): number of users created, updated, unchanged and unknown since the creation
+            of the buffer.
+    """
+
+    def __init__(self, batch_size=1000, flush_interval=60):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.last_flush = time.monotonic()
+        self.stats = {"created": 0, "updated": 0, "unchanged": 0, "unknown": 0}
+
+    def add(self, email, storage=None, messages=None):
+        """Add a report.
+
+        Values that are not given keep their previous value.
+
+        Args:
+            email (string): email of the user.
+            storage (int): storage used, in bytes.
+            messages (int): number of messages.
+        """
+        with self.lock:
+            values = self.pending.setdefault(email, {})
+            if storage is not None:
+                values["storage"] = storage
+            if messages is not None:
+                values["messages"] = messages
+            due = (
+                len(self.pending) >= self.batch_size
+                or time.monotonic() - self.last_flush >= self.flush_interval
+            )
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Write the pending reports.
+
+        Returns:
+            dict: number of users created, updated, unchanged and unknown by this flush.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time.monotonic()
+        stats = {"created": 0, "updated": 0, "unchanged": 0, "unknown": 0}
+        emails = list(pending)
+        for i in range(0, len(emails), self.batch_size):
+            chunk = {email: pending[email] for email in emails[i : i + self.batch_size]}
+            for key, value in self._write(chunk).items():
+                stats[key] += value
+        for key, value in stats.items():
+            self.stats[key] += value
+        return stats
+
+    def _write(self, reports):
+        users = dict(
+            VirtualUser.objects.filter(email__in=reports).values_list("email", "id")
+        )
+        by_user = {
+            users[email]: values for email, values in reports.items() if email in users
+        }
+        now = timezone.now()
+        changed = []
+        unchanged = 0
+        with transaction.atomic():
+            for usage in QuotaUsage.objects.filter(
+                user_id__in=by_user
+            ).select_for_update():
+                values = by_user.pop(usage.user_id)
+                if all(
+                    getattr(usage, name) == values.get(name, getattr(usage, name))
+                    for name in FIELDS
+                ):
+                    unchanged += 1
+                    continue
+                for name, value in values.items():
+                    setattr(usage, name, value)
+                usage.last_update = now
+                changed.append(usage)
+            QuotaUsage.objects.bulk_update(changed, FIELDS + ("last_update",))
+            QuotaUsage.objects.bulk_create(
+                [
+                    QuotaUsage(user_id=user_id, last_update=now, **values)
+                    for user_id, values in by_user.items()
+                ]
+            )
+        return {
+            "created": len(by_user),
+            "updated": len(changed),
+            "unchanged": unchanged,
+            "unknown": len(reports) - len(users),
+        }
+
+
+def parse_doveadm_quota(lines):
+    """Parse the output of doveadm -f tab quota get -A.
+
+    Storage is reported by doveadm in kibibytes. When a user has several quota roots, the
+    largest value is kept.
+
+    Args:
+        lines (iterable): lines of the output.
+
+    Yields:
+        tuple: email, storage in bytes (or None) and number of messages (or None).
+    """
+    current = None
+    values = {}
+    for line in lines:
+        columns = line.rstrip("\r\n").split("\t")
+        if len(columns) < 4 or columns[0] == "Username":
+            continue
+        email, _, kind, value = columns[:4]
+        name = DOVEADM_TYPES.get(kind.upper())
+        if name is None or not value.isdigit():
+            continue
+        value = int(value) * 1024 if name == "storage" else int(value)
+        if email != current:
+            if current is not None:
+                yield current, values.get("storage"), values.get("messages")
+            current, values = email, {}
+        values[name] = max(value, values.get(name, 0))
+    if current is not None:
+        yield current, values.get("storage"), values.get("messages")
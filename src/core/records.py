@@ -0,0 +1,128 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Parsing of DKIM, DMARC and SPF TXT records.
+
+All the functions run in linear time in the size of the record.
+"""
+
+
+def txt_value(rdata):
+    """Return the value of a TXT record.
+
+    A TXT record is made of one or several strings of at most 255 bytes (long DKIM keys are split).
+    The value is the concatenation of these strings.
+
+    Args:
+        rdata (dns.rdtypes.ANY.TXT.TXT): the TXT record.
+
+    Returns:
+        string: the value of the record.
+    """
+    return b"".join(rdata.strings).decode("utf-8", errors="replace")
+
+
+def parse_tag_list(value):
+    """Parse a tag list, as defined in RFC 6376 section 3.2 (used by DKIM and DMARC).
+
+    A tag list is a list of tag=value separated by semicolons. Spaces around tags and values
+    are ignored, as well as malformed items.
+
+    Args:
+        value (string): the tag list.
+
+    Raises:
+        ValueError: if a tag appears several times, which makes the tag list invalid.
+
+    Returns:
+        dict: the values indexed by tag.
+    """
+    tags = {}
+    for item in value.split(";"):
+        tag, separator, tag_value = item.partition("=")
+        tag = tag.strip()
+        if separator and tag:
+            if tag in tags:
+                raise ValueError("Duplicate tag {}".format(tag))
+            tags[tag] = tag_value.strip()
+    return tags
+
+
+def parse_dkim(value):
+    """Extract the public key of a DKIM record.
+
+    Whitespaces inside the key are removed.
+
+    Args:
+        value (string): the value of the DKIM record.
+
+    Returns:
+        string: the public key (empty if revoked) or None if the record has no p tag or is not a
+        valid tag list.
+    """
+    try:
+        key = parse_tag_list(value).get("p")
+    except ValueError:
+        return None
+    if key is None:
+        return None
+    return "".join(key.split())
+
+
+def parse_dmarc(value):
+    """Parse a DMARC record.
+
+    Args:
+        value (string): the value of the DMARC record.
+
+    Returns:
+        dict: the tags of the record, or None if the record does not contain v=DMARC1 or is not
+        a valid tag list.
+    """
+    try:
+        tags = parse_tag_list(value)
+    except ValueError:
+        return None
+    if tags.get("v") != "DMARC1":
+        return None
+    return tags
+
+
+def is_spf_record(value):
+    """Test if a TXT record is an SPF record.
+
+    Args:
+        value (string): the value of the TXT record.
+
+    Returns:
+        bool: True if the record starts with the v=spf1 version term.
+    """
+    terms = value.split(None, 1)
+    return bool(terms) and terms[0].lower() == "v=spf1"
+
+
+def parse_spf(value):
+    """Split an SPF record into terms.
+
+    Args:
+        value (string): the value of the SPF record.
+
+    Returns:
+        list: the terms of the record, without the version term, or None if the record is not an SPF record.
+    """
+    if not is_spf_record(value):
+        return None
+    return value.split()[1:]
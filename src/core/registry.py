@@ -0,0 +1,314 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Cached registry of the virtual domains.
+
+Domains rarely change, but they are read on every save of a user or an alias and for every alias
+destination. They are cached in two tiers: a small LRU in each process, in front of the django
+cache shared by the processes. Domains are indexed by primary key and by name, and names that
+are not managed are cached too.
+
+The entries of both tiers are tagged with a generation number kept in the django cache. Any
+change of a domain increments the generation (see core.signals), which invalidates all the
+entries at once. Saves of the status fields only (DNS scans) don't, so cached domains may have
+stale statuses. Processes read the generation again at most every
+DINOMAIL_DOMAIN_CACHE_CHECK_INTERVAL seconds, so another process may see a stale domain for
+that long. Nothing is cached by a transaction that changed domains until it is committed or
+rolled back, and the generation is incremented again at that time.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+GENERATION_KEY = "dinomail:domains:generation"
+
+# Cached value of names and primary keys that are not managed
+MISSING = "missing"
+
+# Fields updated by the DNS scans, which don't invalidate the registry: the users of cached
+# domains don't read them
+STATUS_FIELDS = frozenset(
+    (
+        "dkim_status",
+        "dkim_last_update",
+        "dmarc_status",
+        "dmarc_last_update",
+        "spf_status",
+        "spf_last_update",
+    )
+)
+
+
+def get_size():
+    """Return the number of entries of the in-process cache.
+
+    Returns:
+        int: DINOMAIL_DOMAIN_CACHE_SIZE, 1000 by default.
+    """
+    return getattr(settings, "DINOMAIL_DOMAIN_CACHE_SIZE", 1000)
+
+
+def get_timeout():
+    """Return the time domains are kept in the django cache.
+
+    Returns:
+        int: DINOMAIL_DOMAIN_CACHE_TIMEOUT in seconds, 3600 by default.
+    """
+    return getattr(settings, "DINOMAIL_DOMAIN_CACHE_TIMEOUT", 3600)
+
+
+def get_check_interval():
+    """Return the time between two reads of the generation in the django cache.
+
+    Returns:
+        float: DINOMAIL_DOMAIN_CACHE_CHECK_INTERVAL in seconds, 1 by default.
+    """
+    return getattr(settings, "DINOMAIL_DOMAIN_CACHE_CHECK_INTERVAL", 1)
+
+
+class LRUCache:
+    """Thread safe cache dropping the least recently used entries.
+
+    Args:
+        size (int): maximum number of entries.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Return an entry and mark it as recently used.
+
+        Args:
+            key (hashable): key of the entry.
+
+        Returns:
+            object: the value, None if the key is not cached.
+        """
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Add or replace an entry, dropping the least recently used ones above the size.
+
+        Args:
+            key (hashable): key of the entry.
+            value (object): the value, not None.
+        """
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """Drop all the entries."""
+        with self.lock:
+            self.entries.clear()
+
+
+class DomainRegistry:
+    """Two tier cache of the virtual domains.
+
+    Domains are returned as copies, so callers may modify them. Cache misses read the primary
+    database, so that replication lag is never cached.
+
+    Args:
+        size (int): number of entries of the in-process cache, default is get_size().
+    """
+
+    def __init__(self, size=None):
+        self.local = LRUCache(size or get_size())
+        self.lock = threading.Lock()
+        self.generation = None
+        self.checked = 0
+        # Savepoints of the transaction that changed domains, per thread
+        self.written = threading.local()
+
+    def current_generation(self):
+        """Return the generation, read from the django cache at most every check interval.
+
+        The in-process cache is cleared when the generation changes.
+
+        Returns:
+            int: the generation.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.generation is None or now - self.checked >= get_check_interval():
+                generation = cache.get(GENERATION_KEY)
+                if generation is None:
+                    # Start from the clock, so that entries of an evicted generation are not reused
+                    cache.add(GENERATION_KEY, time.time_ns(), None)
+                    generation = cache.get(GENERATION_KEY)
+                if generation != self.generation:
+                    self.local.clear()
+                    self.generation = generation
+                self.checked = now
+            return self.generation
+
+    def invalidate(self):
+        """Invalidate the cached domains of every process."""
+        try:
+            generation = cache.incr(GENERATION_KEY)
+        except ValueError:
+            generation = time.time_ns()
+            cache.set(GENERATION_KEY, generation, None)
+        with self.lock:
+            self.local.clear()
+            self.generation = generation
+            self.checked = time.monotonic()
+
+    def changed(self):
+        """Invalidate the cached domains after a change of a domain.
+
+        If the change is part of a transaction, the domains are not cached by this thread until
+        the transaction ends, and are invalidated again when it is committed.
+        """
+        connection = connections[DEFAULT_DB_ALIAS]
+        if connection.in_atomic_block:
+            self.written.savepoints = list(connection.savepoint_ids)
+            transaction.on_commit(self.invalidate)
+        self.invalidate()
+
+    def in_changed_transaction(self):
+        """Test if the current transaction changed domains.
+
+        The domains are invalidated once the transaction is over, as a rollback is not signaled.
+
+        Returns:
+            bool: True if the transaction (or savepoint) that changed domains is still open.
+        """
+        savepoints = getattr(self.written, "savepoints", None)
+        if savepoints is None:
+            return False
+        connection = connections[DEFAULT_DB_ALIAS]
+        if (
+            connection.in_atomic_block
+            and connection.savepoint_ids[: len(savepoints)] == savepoints
+        ):
+            return True
+        self.written.savepoints = None
+        self.invalidate()
+        return False
+
+    def _lookup(self, field, value):
+        if self.in_changed_transaction():
+            model = apps.get_model("core", "VirtualDomain")
+            return (
+                model.objects.using(DEFAULT_DB_ALIAS).filter(**{field: value}).first()
+            )
+        generation = self.current_generation()
+        domain = self.local.get((field, value))
+        if domain is None:
+            key = "dinomail:domains:{}:{}:{}".format(generation, field, value)
+            domain = cache.get(key)
+            if domain is None:
+                model = apps.get_model("core", "VirtualDomain")
+                domain = (
+                    model.objects.using(DEFAULT_DB_ALIAS)
+                    .filter(**{field: value})
+                    .first()
+                )
+                if domain is None:
+                    cache.set(key, MISSING, get_timeout())
+                else:
+                    cache.set_many(
+                        {
+                            "dinomail:domains:{}:pk:{}".format(
+                                generation, domain.pk
+                            ): domain,
+                            "dinomail:domains:{}:name:{}".format(
+                                generation, domain.name
+                            ): domain,
+                        },
+                        get_timeout(),
+                    )
+                    self.local.set(("pk", domain.pk), domain)
+                    self.local.set(("name", domain.name), domain)
+                    return copy.copy(domain)
+            self.local.set((field, value), domain)
+        if domain == MISSING:
+            return None
+        return copy.copy(domain)
+
+    def get(self, pk):
+        """Return a domain by primary key.
+
+        Args:
+            pk (int): primary key of the domain.
+
+        Returns:
+            VirtualDomain: the domain, None if it does not exist.
+        """
+        return self._lookup("pk", pk)
+
+    def get_by_name(self, name):
+        """Return a domain by name.
+
+        Args:
+            name (string): name of the domain.
+
+        Returns:
+            VirtualDomain: the domain, None if the domain is not managed.
+        """
+        return self._lookup("name", name)
+
+
+REGISTRY = DomainRegistry()
+
+
+def get_domain(pk):
+    """Return a domain by primary key, from the cache if possible.
+
+    Args:
+        pk (int): primary key of the domain.
+
+    Returns:
+        VirtualDomain: the domain, None if it does not exist.
+    """
+    return REGISTRY.get(pk)
+
+
+def get_domain_by_name(name):
+    """Return a domain by name, from the cache if possible.
+
+    Args:
+        name (string): name of the domain.
+
+    Returns:
+        VirtualDomain: the domain, None if the domain is not managed.
+    """
+    return REGISTRY.get_by_name(name)
+
+
+def changed():
+    """Invalidate the cached domains after a change of a domain (see DomainRegistry.changed)."""
+    REGISTRY.changed()
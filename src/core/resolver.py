@@ -0,0 +1,333 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Pluggable DNS resolvers for DinoMail.
+
+The resolver used by the DKIM, DMARC and SPF checks is chosen with the
+DINOMAIL_DNS_RESOLVER setting (dotted path to a class). A resolver only needs a
+resolve(qname, rdtype) method returning a list of dnspython rdata objects and
+raising dns.exception.DNSException subclasses on failure. It may also have an
+aresolve coroutine method, used by the async views. Otherwise, its resolve method
+is run in a thread.
+"""
+import asyncio
+import importlib
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import dns.asyncresolver
+import dns.exception
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
+import dns.resolver
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .metrics import DNS_QUERIES, DNS_QUERY_DURATION
+from .tracing import span
+
+DEFAULT_RESOLVER = "core.resolver.DnsPythonResolver"
+
+_resolver = None
+
+
+class DnsPythonResolver:
+    """Resolver using dnspython and the system configuration.
+
+    The DINOMAIL_DNS_TIMEOUT setting, if set, is used as the total lifetime of a query.
+    """
+
+    def __init__(self):
+        self.resolver = dns.resolver.Resolver()
+        self.async_resolver = dns.asyncresolver.Resolver()
+        timeout = getattr(settings, "DINOMAIL_DNS_TIMEOUT", None)
+        if timeout:
+            self.resolver.lifetime = timeout
+            self.async_resolver.lifetime = timeout
+
+    def resolve(self, qname, rdtype):
+        """Resolve a query.
+
+        Args:
+            qname (string): name to query.
+            rdtype (string): record type (TXT, A, ...).
+
+        Returns:
+            list: rdata objects of the answer.
+        """
+        return list(self.resolver.resolve(qname, rdtype))
+
+    async def aresolve(self, qname, rdtype):
+        """Resolve a query without blocking the event loop.
+
+        Args:
+            qname (string): name to query.
+            rdtype (string): record type (TXT, A, ...).
+
+        Returns:
+            list: rdata objects of the answer.
+        """
+        return list(await self.async_resolver.resolve(qname, rdtype))
+
+
+class FakeResolver:
+    """In-process authoritative zone.
+
+    It answers from records added with the add method and never touches the network,
+    which makes it suitable for tests and benchmarks. Latency and failures can be injected.
+
+    Args:
+        latency (float): seconds to wait before each answer.
+        jitter (float): maximum random seconds added to the latency.
+        failure_rate (float): probability (between 0 and 1) for a query to time out.
+        seed (int): seed of the random generator used for jitter and failures.
+    """
+
+    def __init__(self, latency=0, jitter=0, failure_rate=0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.records = {}
+        self.names = set()
+        self.failures = {}
+        self.queries = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(qname, rdtype):
+        return str(qname).lower().rstrip("."), dns.rdatatype.from_text(rdtype)
+
+    def add(self, qname, rdtype, *texts):
+        """Add records to the zone.
+
+        Args:
+            qname (string): name of the records.
+            rdtype (string): record type (TXT, A, ...).
+            texts (string): records in zone file format (quoted for TXT records).
+        """
+        key = self._key(qname, rdtype)
+        rdatas = self.records.setdefault(key, [])
+        self.names.add(key[0])
+        for text in texts:
+            rdatas.append(dns.rdata.from_text(dns.rdataclass.IN, key[1], text))
+
+    def add_txt(self, qname, *values):
+        """Add TXT records from their unquoted values.
+
+        Values longer than 255 bytes are split into several strings, as a DNS server would.
+
+        Args:
+            qname (string): name of the records.
+            values (string): unquoted values of the records.
+        """
+        texts = []
+        for value in values:
+            chunks = [value[i : i + 255] for i in range(0, len(value), 255)] or [""]
+            texts.append(
+                " ".join(
+                    '"{}"'.format(chunk.replace("\\", "\\\\").replace('"', '\\"'))
+                    for chunk in chunks
+                )
+            )
+        self.add(qname, "TXT", *texts)
+
+    def fail(self, qname, rdtype="TXT", exception=dns.exception.Timeout):
+        """Make every query for a name and type raise an exception.
+
+        Args:
+            qname (string): name of the query.
+            rdtype (string): record type of the query.
+            exception (class): exception to raise.
+        """
+        self.failures[self._key(qname, rdtype)] = exception
+
+    def resolve(self, qname, rdtype):
+        """Resolve a query from the zone.
+
+        Args:
+            qname (string): name to query.
+            rdtype (string): record type (TXT, A, ...).
+
+        Raises:
+            dns.exception.Timeout: on injected failures.
+            dns.resolver.NXDOMAIN: if the name is not in the zone.
+            dns.resolver.NoAnswer: if the name exists but has no record of this type.
+
+        Returns:
+            list: rdata objects of the answer.
+        """
+        delay, failed = self._draw()
+        if delay:
+            time.sleep(delay)
+        return self._answer(qname, rdtype, failed)
+
+    async def aresolve(self, qname, rdtype):
+        """Resolve a query from the zone, waiting the latency without blocking the event loop.
+
+        Args:
+            qname (string): name to query.
+            rdtype (string): record type (TXT, A, ...).
+
+        Returns:
+            list: rdata objects of the answer.
+        """
+        delay, failed = self._draw()
+        if delay:
+            await asyncio.sleep(delay)
+        return self._answer(qname, rdtype, failed)
+
+    def _draw(self):
+        with self._lock:
+            self.queries += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            failed = self._random.random() < self.failure_rate
+        return delay, failed
+
+    def _answer(self, qname, rdtype, failed):
+        key = self._key(qname, rdtype)
+        if key in self.failures:
+            raise self.failures[key]()
+        if failed:
+            raise dns.exception.Timeout()
+        if key in self.records:
+            return list(self.records[key])
+        if key[0] in self.names:
+            raise dns.resolver.NoAnswer()
+        raise dns.resolver.NXDOMAIN()
+
+
+def get_resolver():
+    """Return the resolver instance used by DinoMail.
+
+    The class is taken from the DINOMAIL_DNS_RESOLVER setting and instantiated once.
+
+    Returns:
+        object: the resolver.
+    """
+    global _resolver
+    if _resolver is None:
+        class_string = getattr(settings, "DINOMAIL_DNS_RESOLVER", DEFAULT_RESOLVER)
+        mod_name, class_name = class_string.rsplit(".", 1)
+        mod = importlib.import_module(mod_name)
+        _resolver = getattr(mod, class_name)()
+    return _resolver
+
+
+def set_resolver(resolver):
+    """Replace the resolver instance used by DinoMail.
+
+    Args:
+        resolver (object): the new resolver, or None to go back to the configured one.
+    """
+    global _resolver
+    _resolver = resolver
+
+
+@contextmanager
+def use_resolver(resolver):
+    """Context manager using a resolver instance and restoring the previous one on exit.
+
+    Args:
+        resolver (object): the resolver to use.
+    """
+    global _resolver
+    previous = _resolver
+    _resolver = resolver
+    try:
+        yield resolver
+    finally:
+        _resolver = previous
+
+
+def _outcome(exception):
+    if isinstance(exception, dns.resolver.NXDOMAIN):
+        return "nxdomain"
+    if isinstance(exception, dns.resolver.NoAnswer):
+        return "noanswer"
+    if isinstance(exception, dns.exception.Timeout):
+        return "timeout"
+    return "error"
+
+
+def resolve(qname, rdtype):
+    """Resolve a query with the configured resolver.
+
+    Args:
+        qname (string): name to query.
+        rdtype (string): record type (TXT, A, ...).
+
+    Returns:
+        list: rdata objects of the answer.
+    """
+    outcome = "error"
+    start = time.perf_counter()
+    try:
+        with span("dns", qname=str(qname), rdtype=rdtype):
+            answers = get_resolver().resolve(qname, rdtype)
+        outcome = "ok"
+        return answers
+    except Exception as e:
+        outcome = _outcome(e)
+        raise
+    finally:
+        DNS_QUERY_DURATION.observe(time.perf_counter() - start, rdtype)
+        DNS_QUERIES.inc(rdtype, outcome)
+
+
+async def aresolve(qname, rdtype):
+    """Resolve a query with the configured resolver, from a coroutine.
+
+    Resolvers without an aresolve method are run in a thread.
+
+    Args:
+        qname (string): name to query.
+        rdtype (string): record type (TXT, A, ...).
+
+    Returns:
+        list: rdata objects of the answer.
+    """
+    resolver = get_resolver()
+    outcome = "error"
+    start = time.perf_counter()
+    try:
+        with span("dns", qname=str(qname), rdtype=rdtype):
+            if hasattr(resolver, "aresolve"):
+                answers = await resolver.aresolve(qname, rdtype)
+            else:
+                answers = await sync_to_async(resolver.resolve, thread_sensitive=False)(
+                    qname, rdtype
+                )
+        outcome = "ok"
+        return answers
+    except Exception as e:
+        outcome = _outcome(e)
+        raise
+    finally:
+        DNS_QUERY_DURATION.observe(time.perf_counter() - start, rdtype)
+        DNS_QUERIES.inc(rdtype, outcome)
+
+
+@receiver(setting_changed)
+def reset_resolver(setting, **kwargs):
+    """Forget the resolver instance when the resolver settings change (in tests)."""
+    if setting in ("DINOMAIL_DNS_RESOLVER", "DINOMAIL_DNS_TIMEOUT"):
+        set_resolver(None)
@@ -0,0 +1,116 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Database router sending reads to replicas.
+
+Reads go to one of the DINOMAIL_READ_REPLICAS databases only during read-only requests (GET,
+HEAD and OPTIONS, see core.middleware.ReplicaMiddleware) and outside transactions. Everything else (writes,
+other requests, commands and workers) uses the primary (default) database. A browser that wrote
+is pinned to the primary for DINOMAIL_READ_REPLICA_PIN_TIME seconds, so it reads its own
+writes despite the replication lag. Sessions are always read from the primary, so that a new
+session is never missing.
+"""
+import contextvars
+import random
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+PIN_COOKIE = "dinomail_primary"
+
+# Applications whose models are always read from the primary
+PRIMARY_APPS = ("sessions",)
+
+_state = contextvars.ContextVar("dinomail_replica_state", default=None)
+
+
+class ReplicaState:
+    """Routing state of a request.
+
+    Attributes:
+        replicas (bool): True if reads may go to replicas.
+        wrote (bool): True once a write was routed.
+    """
+
+    def __init__(self, replicas):
+        self.replicas = replicas
+        self.wrote = False
+
+
+def get_replicas():
+    """Return the aliases of the read replicas.
+
+    Returns:
+        list: DINOMAIL_READ_REPLICAS, empty by default.
+    """
+    return list(getattr(settings, "DINOMAIL_READ_REPLICAS", []))
+
+
+def get_pin_time():
+    """Return the time a browser reads from the primary after a write.
+
+    Returns:
+        int: DINOMAIL_READ_REPLICA_PIN_TIME in seconds, 10 by default.
+    """
+    return getattr(settings, "DINOMAIL_READ_REPLICA_PIN_TIME", 10)
+
+
+@contextmanager
+def use_replicas(replicas=True):
+    """Context manager allowing (or forbidding) reads from replicas.
+
+    Args:
+        replicas (bool): True to send reads to replicas.
+
+    Yields:
+        ReplicaState: the routing state.
+    """
+    state = ReplicaState(replicas)
+    token = _state.set(state)
+    try:
+        yield state
+    finally:
+        _state.reset(token)
+
+
+class ReplicaRouter:
+    """Router sending reads to replicas when allowed (see use_replicas)."""
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or not state.replicas or state.wrote:
+            return None
+        if model._meta.app_label in PRIMARY_APPS:
+            return None
+        replicas = get_replicas()
+        if not replicas or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in get_replicas():
+            return False
+        return None
@@ -0,0 +1,163 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Signal receivers of core app.
+"""
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from .changes import record
+from .counters import count_domain, is_paused, update_counters
+from .models import (
+    DELETING_DOMAINS,
+    Change,
+    DomainCounter,
+    VirtualAlias,
+    VirtualDomain,
+    VirtualUser,
+)
+from .provisioning import DOCUMENT_FIELDS, invalidate
+from .registry import STATUS_FIELDS, changed
+
+
+@receiver(pre_save, sender=VirtualDomain)
+def invalidate_renamed_domain(sender, instance, update_fields=None, **kwargs):
+    """Delete the cached documents of the previous name of a renamed domain."""
+    if instance.pk and (update_fields is None or "name" in update_fields):
+        previous = (
+            VirtualDomain.objects.filter(pk=instance.pk)
+            .values_list("name", flat=True)
+            .first()
+        )
+        if previous != instance.name:
+            invalidate(previous)
+
+
+@receiver(post_save, sender=VirtualDomain)
+@receiver(post_delete, sender=VirtualDomain)
+def invalidate_domain(sender, instance, update_fields=None, **kwargs):
+    """Delete the cached documents of a domain when it changes."""
+    if update_fields is None or DOCUMENT_FIELDS & set(update_fields):
+        invalidate(instance.name)
+
+
+@receiver(post_save, sender=VirtualDomain)
+@receiver(post_delete, sender=VirtualDomain)
+def invalidate_cached_domains(sender, instance, update_fields=None, **kwargs):
+    """Invalidate the domain registry when a domain changes."""
+    if update_fields is None or not set(update_fields) <= STATUS_FIELDS:
+        changed()
+
+
+@receiver(post_save, sender=VirtualDomain)
+def count_created_domain(sender, instance, created, **kwargs):
+    """Create the counters of a new domain."""
+    if created and not is_paused():
+        DomainCounter.objects.create(domain=instance)
+        update_counters(domains=1)
+
+
+@receiver(pre_delete, sender=VirtualDomain)
+def uncount_deleted_domain_content(sender, instance, **kwargs):
+    """Remove the users and aliases of a deleted domain from the global counters at once."""
+    if instance.pk in DELETING_DOMAINS.get() and not is_paused():
+        counter = DomainCounter.objects.filter(domain=instance).values().first()
+        values = counter or count_domain(instance.pk)
+        update_counters(
+            users=-values["users"], aliases=-values["aliases"], quota=-values["quota"]
+        )
+
+
+@receiver(post_delete, sender=VirtualDomain)
+def uncount_deleted_domain(sender, instance, **kwargs):
+    """Remove a deleted domain from the global counters."""
+    if not is_paused():
+        update_counters(domains=-1)
+
+
+@receiver(pre_save, sender=VirtualUser)
+@receiver(pre_save, sender=VirtualAlias)
+def remember_counted_values(sender, instance, **kwargs):
+    """Remember the domain (and quota) of a user or alias before it is saved."""
+    if is_paused():
+        return
+    fields = ("domain_id", "quota") if sender is VirtualUser else ("domain_id",)
+    instance._counted = (
+        sender.objects.filter(pk=instance.pk).values(*fields).first()
+        if instance.pk
+        else None
+    )
+
+
+@receiver(post_save, sender=VirtualUser)
+def count_saved_user(sender, instance, **kwargs):
+    """Update the counters when a user is created or changed."""
+    previous = instance.__dict__.pop("_counted", None)
+    if is_paused():
+        return
+    quota = instance.quota or 0
+    if previous is None:
+        update_counters(instance.domain_id, users=1, quota=quota)
+    elif previous["domain_id"] != instance.domain_id:
+        update_counters(
+            previous["domain_id"], users=-1, quota=-(previous["quota"] or 0)
+        )
+        update_counters(instance.domain_id, users=1, quota=quota)
+    elif quota != (previous["quota"] or 0):
+        update_counters(instance.domain_id, quota=quota - (previous["quota"] or 0))
+
+
+@receiver(post_save, sender=VirtualAlias)
+def count_saved_alias(sender, instance, **kwargs):
+    """Update the counters when an alias is created or moved to another domain."""
+    previous = instance.__dict__.pop("_counted", None)
+    if is_paused():
+        return
+    if previous is None:
+        update_counters(instance.domain_id, aliases=1)
+    elif previous["domain_id"] != instance.domain_id:
+        update_counters(previous["domain_id"], aliases=-1)
+        update_counters(instance.domain_id, aliases=1)
+
+
+@receiver(post_delete, sender=VirtualUser)
+def uncount_deleted_user(sender, instance, **kwargs):
+    """Update the counters when a user is deleted."""
+    if instance.domain_id not in DELETING_DOMAINS.get() and not is_paused():
+        update_counters(instance.domain_id, users=-1, quota=-(instance.quota or 0))
+
+
+@receiver(post_delete, sender=VirtualAlias)
+def uncount_deleted_alias(sender, instance, **kwargs):
+    """Update the counters when an alias is deleted."""
+    if instance.domain_id not in DELETING_DOMAINS.get() and not is_paused():
+        update_counters(instance.domain_id, aliases=-1)
+
+
+@receiver(post_save, sender=VirtualDomain)
+@receiver(post_save, sender=VirtualUser)
+@receiver(post_save, sender=VirtualAlias)
+def record_saved(sender, instance, created, update_fields=None, **kwargs):
+    """Append the creation or the change of a domain, user or alias to the change feed."""
+    record(instance, Change.CREATE if created else Change.UPDATE, update_fields)
+
+
+@receiver(post_delete, sender=VirtualDomain)
+@receiver(post_delete, sender=VirtualUser)
+@receiver(post_delete, sender=VirtualAlias)
+def record_deleted(sender, instance, **kwargs):
+    """Append the deletion of a domain, user or alias to the change feed."""
+    record(instance, Change.DELETE)
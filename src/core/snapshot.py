@@ -0,0 +1,253 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Read-only SQLite snapshot of the directory, for MX hosts.
+
+The snapshot contains the managed domains, the mailboxes and the aliases, resolved to their
+final destinations, in indexed tables that postfix queries with its sqlite maps:
+
+* domains (name),
+* mailboxes (email, domain, quota),
+* aliases (source, destination), one row per final destination,
+* meta (key, value): build date, counts and sequence number of the change feed (see
+  core.changes) at build time.
+
+The snapshot is written by streaming sorted rows into a temporary file next to the target,
+then renamed over the target, so readers always see a complete file. A sha256sum file is
+written next to it to check copies (rsync).
+"""
+import hashlib
+import os
+import sqlite3
+import tempfile
+import time
+
+from django.db import transaction
+from django.utils import timezone
+
+from .changes import get_feed
+from .models import VirtualAlias, VirtualDomain, VirtualUser
+
+SCHEMA = (
+    "CREATE TABLE domains (name TEXT PRIMARY KEY) WITHOUT ROWID",
+    "CREATE TABLE mailboxes (email TEXT PRIMARY KEY, domain TEXT NOT NULL, quota INTEGER) WITHOUT ROWID",
+    "CREATE TABLE aliases (source TEXT NOT NULL, destination TEXT NOT NULL, PRIMARY KEY (source, destination)) WITHOUT ROWID",
+    "CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID",
+)
+
+# Maximum number of aliases followed to resolve an alias, as postfix
+MAX_DEPTH = 100
+
+
+def resolve_aliases(aliases, max_depth=MAX_DEPTH):
+    """Resolve aliases to their final destinations.
+
+    A destination that is the source of another alias is replaced by the destinations of that
+    alias. Destinations closing a loop (an alias to itself to keep a copy in the mailbox for
+    instance) or beyond max_depth are kept as is.
+
+    Args:
+        aliases (dict): destinations (list) indexed by source.
+        max_depth (int): maximum number of aliases followed.
+
+    Yields:
+        tuple: source and final destination, by source.
+    """
+    resolved = {}
+
+    def expand(source, stack):
+        if source in resolved:
+            return resolved[source], False
+        destinations = []
+        cut = False
+        for destination in aliases[source]:
+            if destination not in aliases:
+                destinations.append(destination)
+            elif destination in stack or len(stack) >= max_depth:
+                destinations.append(destination)
+                cut = True
+            else:
+                expanded, expanded_cut = expand(destination, stack | {destination})
+                destinations += expanded
+                cut = cut or expanded_cut
+        destinations = list(dict.fromkeys(destinations))
+        # Expansions cut by the current stack depend on it, they are not reused
+        if not cut:
+            resolved[source] = destinations
+        return destinations, cut
+
+    for source in aliases:
+        for destination in expand(source, frozenset((source,)))[0]:
+            yield source, destination
+
+
+def load_aliases(batch_size=10000):
+    """Load the aliases of the domains that are not being deleted.
+
+    Args:
+        batch_size (int): rows read from the database at once.
+
+    Returns:
+        dict: destinations (list) indexed by source, sorted by source.
+    """
+    aliases = {}
+    for source, destination in (
+        VirtualAlias.objects.filter(domain__deleting=False)
+        .order_by("source", "destination")
+        .values_list("source", "destination")
+        .iterator(chunk_size=batch_size)
+    ):
+        aliases.setdefault(source, []).append(destination)
+    return aliases
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """Compute the sha256 of a file, by chunks.
+
+    Args:
+        path (string): the file.
+        chunk_size (int): bytes read at once.
+
+    Returns:
+        string: the hexadecimal digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def replace_file(tmp, path, mode=0o644):
+    """Flush a temporary file to disk and rename it over a file.
+
+    Args:
+        tmp (string): the temporary file, in the directory of path.
+        path (string): the replaced file.
+        mode (int): permissions of the file.
+    """
+    os.chmod(tmp, mode)
+    with open(tmp, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _insert(db, table, rows, batch_size):
+    """Insert rows by batches and return their number."""
+    count = 0
+    batch = []
+    columns = None
+    for row in rows:
+        if columns is None:
+            columns = ", ".join("?" * len(row))
+        batch.append(row)
+        if len(batch) >= batch_size:
+            db.executemany(
+                "INSERT OR IGNORE INTO {} VALUES ({})".format(table, columns), batch
+            )
+            count += len(batch)
+            batch = []
+    if batch:
+        db.executemany(
+            "INSERT OR IGNORE INTO {} VALUES ({})".format(table, columns), batch
+        )
+        count += len(batch)
+    return count
+
+
+def build_snapshot(path, batch_size=10000):
+    """Build a snapshot of the directory and replace the file at path with it.
+
+    Domains being deleted, with their mailboxes and aliases, are left out.
+
+    Args:
+        path (string): the snapshot file.
+        batch_size (int): rows read from the database and inserted at once.
+
+    Returns:
+        dict: number of domains, mailboxes and resolved aliases, size in bytes, sha256 and
+            time spent in seconds.
+    """
+    start = time.perf_counter()
+    path = os.path.abspath(path)
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=".sqlite3")
+    os.close(fd)
+    try:
+        db = sqlite3.connect(tmp, isolation_level=None)
+        try:
+            db.execute("PRAGMA journal_mode = OFF")
+            db.execute("PRAGMA synchronous = OFF")
+            db.execute("BEGIN")
+            for statement in SCHEMA:
+                db.execute(statement)
+            with transaction.atomic():
+                sequence = get_feed().sequence
+                domains = _insert(
+                    db,
+                    "domains",
+                    VirtualDomain.objects.filter(deleting=False)
+                    .order_by("name")
+                    .values_list("name")
+                    .iterator(chunk_size=batch_size),
+                    batch_size,
+                )
+                mailboxes = _insert(
+                    db,
+                    "mailboxes",
+                    VirtualUser.objects.filter(domain__deleting=False)
+                    .order_by("email")
+                    .values_list("email", "domain__name", "quota")
+                    .iterator(chunk_size=batch_size),
+                    batch_size,
+                )
+                aliases = load_aliases(batch_size)
+            alias_count = _insert(db, "aliases", resolve_aliases(aliases), batch_size)
+            del aliases
+            meta = {
+                "built": timezone.now().isoformat(),
+                "sequence": sequence,
+                "domains": domains,
+                "mailboxes": mailboxes,
+                "aliases": alias_count,
+            }
+            db.executemany(
+                "INSERT INTO meta VALUES (?, ?)",
+                [(key, str(value)) for key, value in meta.items()],
+            )
+            db.execute("COMMIT")
+            db.execute("ANALYZE")
+        finally:
+            db.close()
+        digest = file_digest(tmp)
+        replace_file(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=".sha256")
+    with os.fdopen(fd, "w") as f:
+        f.write("{}  {}\n".format(digest, os.path.basename(path)))
+    replace_file(tmp, path + ".sha256")
+    return {
+        "domains": domains,
+        "mailboxes": mailboxes,
+        "aliases": alias_count,
+        "size": os.path.getsize(path),
+        "sha256": digest,
+        "elapsed": time.perf_counter() - start,
+    }
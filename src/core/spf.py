@@ -0,0 +1,480 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Expansion and flattening of SPF records.
+
+RFC 7208 limits the number of mechanisms and modifiers doing DNS lookups (include, a, mx, ptr,
+exists and redirect) to 10 per SPF evaluation. Receivers fail the check above that limit.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import dns.resolver
+
+from .records import parse_spf, txt_value
+from .resolver import aresolve, resolve
+from .tracing import propagate
+
+LOOKUP_LIMIT = 10
+
+LOOKUP_MECHANISMS = ("include", "a", "mx", "ptr", "exists")
+
+MECHANISMS = ("all", "include", "a", "mx", "ptr", "ip4", "ip6", "exists")
+
+QUALIFIERS = "+-~?"
+
+MAX_DEPTH = 10
+
+# answers meaning that the name has no record of the type, other errors (timeouts, SERVFAIL) are
+# transient and make the expansion incomplete
+NO_RECORD = (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer)
+
+
+def split_term(term):
+    """Split an SPF term into qualifier, name and value.
+
+    Args:
+        term (string): the term (-all, include:example.com, redirect=example.com, ...).
+
+    Returns:
+        tuple: qualifier (empty for modifiers), lowercase name and value (None if absent).
+    """
+    if "=" in term.split(":", 1)[0]:
+        name, value = term.split("=", 1)
+        return "", name.lower(), value
+    qualifier = "+"
+    if term[:1] in QUALIFIERS:
+        qualifier, term = term[0], term[1:]
+    for separator in (":", "/"):
+        name, found, value = term.partition(separator)
+        if found:
+            if separator == "/":
+                value = "/" + value
+            return qualifier, name.lower(), value
+    return qualifier, term.lower(), None
+
+
+def split_cidr(value):
+    """Split the domain spec and the CIDR lengths of an a or mx mechanism value.
+
+    Args:
+        value (string): value of the mechanism (example.com/24//64, /24, ...), may be None.
+
+    Returns:
+        tuple: domain spec (None if absent), IPv4 and IPv6 prefix suffixes ("" or "/24").
+    """
+    if not value:
+        return None, "", ""
+    value, _, ip6_cidr = value.partition("//")
+    domain, _, ip4_cidr = value.partition("/")
+    return (
+        domain or None,
+        "/" + ip4_cidr if ip4_cidr else "",
+        "/" + ip6_cidr if ip6_cidr else "",
+    )
+
+
+class SpfResult:
+    """Result of the expansion of an SPF record.
+
+    Args:
+        domain (string): the evaluated domain.
+
+    Attributes:
+        record (string): SPF record of the domain, None if not found.
+        lookups (int): number of DNS querying mechanisms and modifiers of the evaluation.
+        errors (list): problems found during the evaluation (loops, missing records, ...).
+        ip4 (list): IPv4 networks allowed by the record.
+        ip6 (list): IPv6 networks allowed by the record.
+        others (list): terms that cannot be flattened (ptr, exists, macros, non-pass mechanisms),
+            kept verbatim.
+        terms (list): terms of the flattened record, in evaluation order.
+        all (string): the all mechanism ending the record, None if absent.
+        flattenable (bool): False if flattening would change the result of the evaluation.
+    """
+
+    def __init__(self, domain):
+        self.domain = domain
+        self.record = None
+        self.lookups = 0
+        self.errors = []
+        self.ip4 = []
+        self.ip6 = []
+        self.others = []
+        self.terms = []
+        self.all = None
+        self.flattenable = True
+
+    @property
+    def exceeds_limit(self):
+        """bool: True if the record needs more DNS lookups than allowed by RFC 7208."""
+        return self.lookups > LOOKUP_LIMIT
+
+    def refuse(self, error):
+        """Mark the record as not flattenable.
+
+        Args:
+            error (string): the reason.
+        """
+        self.flattenable = False
+        if error not in self.errors:
+            self.errors.append(error)
+
+    def flattened(self):
+        """Return an equivalent record with the includes and redirects expanded.
+
+        The a and mx mechanisms are replaced by the addresses they resolve to, so the record only
+        needs the lookups of the terms that cannot be flattened. The order of the terms is kept,
+        since the first matching mechanism gives the result.
+
+        Returns:
+            string: the flattened record, None if the record cannot be flattened (a non-pass
+            include, a non-pass mechanism before a pass one, a failed DNS query, a missing
+            record, ...).
+        """
+        if not self.flattenable:
+            return None
+        terms = ["v=spf1"] + self.terms
+        if self.all:
+            terms.append(self.all)
+        return " ".join(terms)
+
+
+class SpfEvaluator:
+    """Evaluator expanding SPF records.
+
+    Records and addresses are fetched concurrently, level by level, and memoized so that an
+    include used several times is only queried once. The queries are made by a pool of threads
+    (evaluate) or by asyncio tasks (aevaluate).
+
+    Args:
+        max_workers (int): number of concurrent DNS queries.
+    """
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self.records = {}
+        self.addresses = {}
+
+    @staticmethod
+    def _record(domain, answers):
+        if answers is None:
+            return None, "no SPF record found for {}".format(domain)
+        records = [txt_value(answer) for answer in answers]
+        records = [terms for terms in map(parse_spf, records) if terms is not None]
+        if not records:
+            return None, "no SPF record found for {}".format(domain)
+        if len(records) > 1:
+            return None, "several SPF records found for {}".format(domain)
+        return records[0], None
+
+    @staticmethod
+    def _addresses(rdtype, answers):
+        if rdtype == "MX":
+            return [str(answer.exchange).rstrip(".") for answer in answers]
+        return [answer.to_text() for answer in answers]
+
+    @staticmethod
+    def _failed(name, rdtype, exception):
+        return "DNS query for {} {} failed ({})".format(
+            name, rdtype, type(exception).__name__
+        )
+
+    def _fetch_record(self, domain):
+        try:
+            answers = resolve(domain, "TXT")
+        except NO_RECORD:
+            answers = None
+        except Exception as e:
+            return None, self._failed(domain, "TXT", e)
+        return self._record(domain, answers)
+
+    def _fetch_addresses(self, query):
+        """Return the addresses (or MX hosts) of a name, None if the query failed."""
+        name, rdtype = query
+        try:
+            answers = resolve(name, rdtype)
+        except NO_RECORD:
+            return []
+        except Exception:
+            return None
+        return self._addresses(rdtype, answers)
+
+    async def _afetch_record(self, domain):
+        try:
+            answers = await aresolve(domain, "TXT")
+        except NO_RECORD:
+            answers = None
+        except Exception as e:
+            return None, self._failed(domain, "TXT", e)
+        return self._record(domain, answers)
+
+    async def _afetch_addresses(self, query):
+        name, rdtype = query
+        try:
+            answers = await aresolve(name, rdtype)
+        except NO_RECORD:
+            return []
+        except Exception:
+            return None
+        return self._addresses(rdtype, answers)
+
+    def _fetch(self, executor, function, memo, keys):
+        keys = [key for key in dict.fromkeys(keys) if key not in memo]
+        for key, value in zip(keys, executor.map(propagate(function), keys)):
+            memo[key] = value
+
+    async def _afetch(self, semaphore, function, memo, keys):
+        keys = [key for key in dict.fromkeys(keys) if key not in memo]
+
+        async def fetch(key):
+            async with semaphore:
+                return await function(key)
+
+        values = await asyncio.gather(*(fetch(key) for key in keys))
+        for key, value in zip(keys, values):
+            memo[key] = value
+
+    def _load_records(self, domain):
+        """Yield the names whose records are needed, level by level, to fetch them."""
+        frontier = [domain]
+        for _ in range(MAX_DEPTH + 1):
+            yield self.records, frontier
+            next_frontier = []
+            for name in frontier:
+                terms, _ = self.records[name]
+                for term in terms or []:
+                    _, mechanism, value = split_term(term)
+                    if mechanism in ("include", "redirect") and value:
+                        if "%" not in value and value.lower() not in self.records:
+                            next_frontier.append(value.lower())
+            if not next_frontier:
+                break
+            frontier = next_frontier
+
+    def _walk(self, domain, result, stack, hosts, top, blocker=None):
+        """Walk the terms of a record in order, appending them to the result.
+
+        Args:
+            blocker (string): non-pass term evaluated before this record, a pass term after it
+                cannot be flattened.
+        """
+        if len(stack) > MAX_DEPTH:
+            result.refuse("too many nested includes at {}".format(domain))
+            return
+        terms, error = self.records.get(domain, (None, None))
+        if terms is None:
+            # the senders of a missing or unreachable record are unknown
+            result.refuse(error or "no SPF record found for {}".format(domain))
+            return
+        if error:
+            result.errors.append(error)
+        has_all = any(split_term(term)[1] == "all" for term in terms)
+        redirect = None
+        for term in terms:
+            qualifier, mechanism, value = split_term(term)
+            if mechanism in LOOKUP_MECHANISMS:
+                result.lookups += 1
+            if mechanism == "redirect":
+                # redirect is ignored when the record has an all mechanism
+                if not has_all:
+                    result.lookups += 1
+                    redirect = (value or "").lower()
+                    if not redirect or "%" in redirect:
+                        result.refuse("{} cannot be flattened".format(term))
+                        redirect = None
+                continue
+            if not qualifier:
+                continue
+            if mechanism == "all":
+                if top:
+                    result.all = term
+                elif qualifier == "+":
+                    result.refuse("{} in {} cannot be flattened".format(term, domain))
+                break
+            if qualifier != "+":
+                # a non-pass term stops the evaluation of an include, it is kept in order at
+                # the top level and dropped in includes, where it only matters before a pass
+                blocker = blocker or term
+                if mechanism == "include":
+                    result.refuse("{} cannot be flattened".format(term))
+                    self._count(value, result, stack)
+                if top:
+                    if mechanism in ("a", "mx") and not (value and "%" in value):
+                        term = qualifier + self._host_term(mechanism, value, domain)
+                    result.others.append(term)
+                    result.terms.append(term)
+                continue
+            if mechanism == "include" and not (value and "%" in value):
+                value = (value or "").lower()
+                if value in stack:
+                    result.refuse("include loop on {}".format(value))
+                else:
+                    self._walk(value, result, stack + [value], hosts, False, blocker)
+                continue
+            if mechanism not in MECHANISMS:
+                continue
+            if blocker:
+                result.refuse("{} before {} cannot be flattened".format(blocker, term))
+            if value and "%" in value:
+                result.others.append(term)
+                result.terms.append(term)
+                result.errors.append("macro in {} cannot be flattened".format(term))
+            elif mechanism in ("ip4", "ip6") and value:
+                getattr(result, mechanism).append(value)
+                result.terms.append("{}:{}".format(mechanism, value))
+            elif mechanism in ("a", "mx"):
+                name, ip4_cidr, ip6_cidr = split_cidr(value)
+                hosts.append(
+                    (len(result.terms), mechanism, name or domain, ip4_cidr, ip6_cidr)
+                )
+                result.terms.append(self._host_term(mechanism, value, domain))
+            elif mechanism in ("ptr", "exists"):
+                if mechanism == "ptr" and not value:
+                    # ptr checks names in the domain of the record holding it
+                    term = "ptr:{}".format(domain)
+                result.others.append(term)
+                result.terms.append(term)
+        if redirect:
+            if redirect in stack:
+                result.refuse("redirect loop on {}".format(redirect))
+            else:
+                self._walk(redirect, result, stack + [redirect], hosts, top, blocker)
+
+    def _count(self, domain, result, stack):
+        """Count the lookups of an include that is not flattened."""
+        if not domain or "%" in domain:
+            return
+        domain = domain.lower()
+        if domain in stack:
+            result.refuse("include loop on {}".format(domain))
+            return
+        nested = SpfResult(domain)
+        self._walk(domain, nested, stack + [domain], [], False)
+        result.lookups += nested.lookups
+        result.errors += nested.errors
+
+    @staticmethod
+    def _host_term(mechanism, value, domain):
+        name, ip4_cidr, ip6_cidr = split_cidr(value)
+        return "{}:{}{}{}".format(
+            mechanism, name or domain, ip4_cidr, "/" + ip6_cidr if ip6_cidr else ""
+        )
+
+    def _answer(self, result, name, rdtype):
+        addresses = self.addresses[(name, rdtype)]
+        if addresses is None:
+            result.refuse("DNS query for {} {} failed".format(name, rdtype))
+            return []
+        return addresses
+
+    def _resolve_hosts(self, result, hosts):
+        """Replace the a and mx mechanisms by the addresses they resolve to.
+
+        The queries to make are yielded before the addresses are used. A failed query makes the
+        record not flattenable, since the addresses it would have given are unknown.
+        """
+        yield self.addresses, [
+            (name, "MX") for _, mechanism, name, _, _ in hosts if mechanism == "mx"
+        ]
+        targets = []
+        for index, mechanism, name, ip4_cidr, ip6_cidr in hosts:
+            names = [name]
+            if mechanism == "mx":
+                names = self._answer(result, name, "MX")
+            targets += [(index, target, ip4_cidr, ip6_cidr) for target in names]
+        queries = [
+            (name, rdtype) for _, name, _, _ in targets for rdtype in ("A", "AAAA")
+        ]
+        yield self.addresses, queries
+        expansions = {index: [] for index, _, _, _, _ in hosts}
+        for index, name, ip4_cidr, ip6_cidr in targets:
+            ip4 = [a + ip4_cidr for a in self._answer(result, name, "A")]
+            ip6 = [a + ip6_cidr for a in self._answer(result, name, "AAAA")]
+            result.ip4 += ip4
+            result.ip6 += ip6
+            expansions[index] += ["ip4:" + network for network in ip4]
+            expansions[index] += ["ip6:" + network for network in ip6]
+        result.terms = [
+            expanded
+            for index, term in enumerate(result.terms)
+            for expanded in expansions.get(index, [term])
+        ]
+
+    def _expand(self, domain, result, flatten, record):
+        """Expand a record, yielding the (memo, keys) to fetch before going on."""
+        hosts = []
+        if record is not None:
+            terms = parse_spf(record)
+            error = None
+            if terms is None:
+                error = "no SPF record found for {}".format(domain)
+            self.records[domain] = (terms, error)
+        yield from self._load_records(domain)
+        terms, _ = self.records[domain]
+        if terms is not None:
+            result.record = " ".join(["v=spf1"] + terms)
+        self._walk(domain, result, [domain], hosts, True)
+        if flatten:
+            yield from self._resolve_hosts(result, hosts)
+        result.ip4 = list(dict.fromkeys(result.ip4))
+        result.ip6 = list(dict.fromkeys(result.ip6))
+        result.others = list(dict.fromkeys(result.others))
+        result.terms = list(dict.fromkeys(result.terms))
+
+    def evaluate(self, domain, flatten=True, record=None):
+        """Expand the SPF record of a domain.
+
+        Args:
+            domain (string): the domain.
+            flatten (bool): if True, a and mx mechanisms are resolved to fill ip4 and ip6.
+            record (string): SPF record of the domain if already known ("" if it has none), to
+                avoid querying it again.
+
+        Returns:
+            SpfResult: the result of the expansion.
+        """
+        domain = domain.lower().rstrip(".")
+        result = SpfResult(domain)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for memo, keys in self._expand(domain, result, flatten, record):
+                if memo is self.records:
+                    self._fetch(executor, self._fetch_record, memo, keys)
+                else:
+                    self._fetch(executor, self._fetch_addresses, memo, keys)
+        return result
+
+    async def aevaluate(self, domain, flatten=True, record=None):
+        """Expand the SPF record of a domain, from a coroutine.
+
+        Args:
+            domain (string): the domain.
+            flatten (bool): if True, a and mx mechanisms are resolved to fill ip4 and ip6.
+            record (string): SPF record of the domain if already known ("" if it has none), to
+                avoid querying it again.
+
+        Returns:
+            SpfResult: the result of the expansion.
+        """
+        domain = domain.lower().rstrip(".")
+        result = SpfResult(domain)
+        semaphore = asyncio.Semaphore(self.max_workers)
+        for memo, keys in self._expand(domain, result, flatten, record):
+            if memo is self.records:
+                await self._afetch(semaphore, self._afetch_record, memo, keys)
+            else:
+                await self._afetch(semaphore, self._afetch_addresses, memo, keys)
+        return result
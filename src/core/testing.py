@@ -0,0 +1,60 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Test helpers for DinoMail.
+"""
+import contextlib
+
+from .queries import QueryRecorder
+
+
+class QueryBudgetMixin:
+    """Mixin for test cases asserting the number of queries of views.
+
+    Unlike assertNumQueries, the budget is a maximum and the failure message lists the most
+    repeated statements, which usually point to an N+1 pattern.
+    """
+
+    @contextlib.contextmanager
+    def assertMaxQueries(self, budget, using=None):
+        """Context manager failing if more than budget queries are made inside it.
+
+        Args:
+            budget (int): maximum number of queries.
+            using (list): aliases of the databases to watch, all of them by default.
+        """
+        recorder = QueryRecorder(using)
+        with recorder.record():
+            yield recorder
+        if recorder.count > budget:
+            lines = ["{} queries made, budget is {}.".format(recorder.count, budget)]
+            for sql, count in recorder.repeated():
+                lines.append("{} x {}".format(count, sql))
+            self.fail("\n".join(lines))
+
+    def assertQueryBudgets(self, client, budgets, **extra):
+        """Request URLs and check their query budgets and their status code.
+
+        Args:
+            client (Client): client sending the requests.
+            budgets (dict): maximum number of queries indexed by URL.
+            extra: extra arguments of the requests (headers, ...).
+        """
+        for url, budget in budgets.items():
+            with self.subTest(url=url):
+                with self.assertMaxQueries(budget):
+                    response = client.get(url, **extra)
+                self.assertEqual(response.status_code, 200)
@@ -0,0 +1,364 @@
+# DinoMail - Hungry dino managing emails
+# Copyright (C) 2020 Yoann Pietri
+
+# DinoMail is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# DinoMail is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
+"""
+Lightweight tracing of requests.
+
+A trace is a tree of timed spans (request, view, queries, DNS queries, password hashing, template
+rendering). The current span is kept in a context variable, so spans nest across function calls
+and asyncio tasks. Outside of a sampled trace, span() does nothing, so instrumentation is cheap
+when tracing is disabled.
+
+Finished traces are sent to the exporter chosen with the DINOMAIL_TRACING_EXPORTER setting
+(dotted path to a class with an export(spans) method).
+"""
+import asyncio
+import contextlib
+import contextvars
+import functools
+import importlib
+import json
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+_current = contextvars.ContextVar("dinomail_span", default=None)
+
+_exporter = None
+
+
+class Span:
+    """Timed operation of a trace.
+
+    Args:
+        name (string): name of the operation.
+        trace (list): spans of the trace, the span is appended to it.
+        trace_id (string): identifier of the trace (32 hex digits).
+        parent (Span): parent span, None for the root span.
+        attributes (dict): attributes of the span.
+    """
+
+    def __init__(self, name, trace, trace_id, parent=None, attributes=None):
+        self.name = name
+        self.trace = trace
+        self.trace_id = trace_id
+        self.span_id = "{:016x}".format(random.getrandbits(64))
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes or {}
+        self.start = time.time_ns()
+        self.end = None
+        self._start = time.perf_counter()
+        self.duration = None
+        trace.append(self)
+
+    def finish(self):
+        """Set the end of the span."""
+        self.duration = time.perf_counter() - self._start
+        self.end = self.start + int(self.duration * 1e9)
+
+    def to_dict(self):
+        """Return the span as a dict.
+
+        Returns:
+            dict: the span, with its duration in milliseconds.
+        """
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start / 1e9,
+            "duration": 1000 * self.duration if self.duration is not None else None,
+            "attributes": self.attributes,
+        }
+
+
+def get_exporter():
+    """Return the exporter of traces.
+
+    The class is taken from the DINOMAIL_TRACING_EXPORTER setting and instantiated once.
+
+    Returns:
+        object: the exporter, None if tracing is disabled.
+    """
+    global _exporter
+    class_string = getattr(settings, "DINOMAIL_TRACING_EXPORTER", None)
+    if _exporter is None and class_string:
+        mod_name, class_name = class_string.rsplit(".", 1)
+        mod = importlib.import_module(mod_name)
+        _exporter = getattr(mod, class_name)()
+    return _exporter
+
+
+@receiver(setting_changed)
+def reset_exporter(setting, **kwargs):
+    """Forget the exporter instance when the tracing settings change (in tests)."""
+    global _exporter
+    if setting.startswith("DINOMAIL_TRACING"):
+        _exporter = None
+
+
+@contextlib.contextmanager
+def trace(name, trace_id=None, sampled=None, **attributes):
+    """Context manager starting a trace with a root span.
+
+    The trace is recorded if tracing is enabled and if it is sampled, and exported on exit.
+
+    Args:
+        name (string): name of the root span.
+        trace_id (string): identifier of the trace, a new one is generated if not given.
+        sampled (bool): force the sampling decision, DINOMAIL_TRACING_SAMPLE_RATE is used if None.
+        attributes: attributes of the root span.
+
+    Yields:
+        Span: the root span, None if the trace is not recorded.
+    """
+    exporter = get_exporter()
+    if sampled is None:
+        rate = getattr(settings, "DINOMAIL_TRACING_SAMPLE_RATE", 1.0)
+        sampled = random.random() < rate
+    if exporter is None or not sampled or _current.get() is not None:
+        yield None
+        return
+    spans = []
+    root = Span(
+        name, spans, trace_id or "{:032x}".format(random.getrandbits(128)), None
+    )
+    root.attributes.update(attributes)
+    token = _current.set(root)
+    try:
+        yield root
+    finally:
+        _current.reset(token)
+        root.finish()
+        exporter.export(spans)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Context manager timing an operation as a child of the current span.
+
+    Args:
+        name (string): name of the operation.
+        attributes: attributes of the span.
+
+    Yields:
+        Span: the span, None outside of a recorded trace.
+    """
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, parent.trace, parent.trace_id, parent, attributes)
+    token = _current.set(child)
+    try:
+        yield child
+    finally:
+        _current.reset(token)
+        child.finish()
+
+
+def traced(function):
+    """Decorator recording every call of a function as a span named after the function.
+
+    Coroutine functions are recorded until the coroutine returns.
+
+    Args:
+        function (function): the function.
+
+    Returns:
+        function: the decorated function.
+    """
+    if asyncio.iscoroutinefunction(function):
+
+        @functools.wraps(function)
+        async def async_wrapper(*args, **kwargs):
+            with span(function.__qualname__):
+                return await function(*args, **kwargs)
+
+        return async_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with span(function.__qualname__):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def propagate(function):
+    """Wrap a function to run it in the current span from another thread.
+
+    Args:
+        function (function): the function, called by a pool of threads for instance.
+
+    Returns:
+        function: the wrapped function.
+    """
+    parent = _current.get()
+    if parent is None:
+        return function
+
+    def run(*args, **kwargs):
+        token = _current.set(parent)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _current.reset(token)
+
+    return run
+
+
+def trace_queries(execute, sql, params, many, context):
+    """Database execute wrapper recording every query as a span."""
+    with span("db", statement=sql):
+        return execute(sql, params, many, context)
+
+
+class JsonlExporter:
+    """Export spans to the DINOMAIL_TRACING_FILE file, one JSON object per line."""
+
+    def __init__(self):
+        self.path = getattr(settings, "DINOMAIL_TRACING_FILE", "dinomail-traces.jsonl")
+        self.lock = threading.Lock()
+
+    def export(self, spans):
+        """Write spans.
+
+        Args:
+            spans (list): the spans of a trace.
+        """
+        lines = "".join(json.dumps(s.to_dict()) + "\n" for s in spans)
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(lines)
+
+
+class OtlpExporter:
+    """Export spans to an OTLP/HTTP collector with the JSON encoding.
+
+    Spans are sent by a background thread, so requests don't wait for the collector. The
+    endpoint is taken from DINOMAIL_TRACING_OTLP_ENDPOINT (default is the local collector).
+    """
+
+    def __init__(self):
+        self.endpoint = getattr(
+            settings,
+            "DINOMAIL_TRACING_OTLP_ENDPOINT",
+            "http://localhost:4318/v1/traces",
+        )
+        self.service_name = getattr(settings, "DINOMAIL_NAME", "DinoMail")
+        self.queue = queue.Queue(maxsize=1000)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def export(self, spans):
+        """Queue spans to be sent. Spans are dropped if the queue is full.
+
+        Args:
+            spans (list): the spans of a trace.
+        """
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        try:
+            self.queue.put_nowait(spans)
+        except queue.Full:
+            pass
+
+    def payload(self, spans):
+        """Build the OTLP JSON payload of spans.
+
+        Args:
+            spans (list): the spans.
+
+        Returns:
+            dict: the payload.
+        """
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": {"stringValue": self.service_name},
+                            },
+                            {
+                                "key": "process.pid",
+                                "value": {"intValue": str(os.getpid())},
+                            },
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "dinomail"},
+                            "spans": [
+                                {
+                                    "traceId": s.trace_id,
+                                    "spanId": s.span_id,
+                                    "parentSpanId": s.parent_id or "",
+                                    "name": s.name,
+                                    "kind": 2 if s.parent_id is None else 1,
+                                    "startTimeUnixNano": str(s.start),
+                                    "endTimeUnixNano": str(s.end or s.start),
+                                    "attributes": [
+                                        {"key": k, "value": {"stringValue": str(v)}}
+                                        for k, v in s.attributes.items()
+                                    ],
+                                }
+                                for s in spans
+                            ],
+                        }
+                    ],
+                }
+            ]
+        }
+
+    def send(self, spans):
+        """Send spans to the collector.
+
+        Args:
+            spans (list): the spans.
+        """
+        request = urllib.request.Request(
+            self.endpoint,
+            json.dumps(self.payload(spans)).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request, timeout=10) as response:
+            response.read()
+
+    def _run(self):
+        while True:
+            spans = list(self.queue.get())
+            while len(spans) < 1000:
+                try:
+                    spans += self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            try:
+                self.send(spans)
+            except Exception:
+                # The collector is not available, the spans are dropped
+                pass
@@ -27,6 +27,7 @@ from . import views
 urlpatterns_virtual_domains = [
     path("", views.virtual_domains_index, name="virtual-domains-index"),
     path("new", views.add_virtual_domain, name="virtual-domains-add"),
+    path("rescan", views.rescan_virtual_domains, name="virtual-domains-rescan"),
     path("<int:pk>/edit", views.edit_virtual_domain, name="virtual-domains-edit"),
     path("<int:pk>/delete", views.delete_virtual_domain, name="virtual-domains-delete"),
     path(
@@ -94,6 +95,13 @@ urlpatterns_virtual_aliases = [
     path("<int:pk>/delete", views.delete_virtual_alias, name="virtual-aliases-delete"),
 ]
 
+# Url patterns for jobs
+
+urlpatterns_jobs = [
+    path("", views.jobs_index, name="jobs-index"),
+    path("<int:pk>", views.job_detail, name="jobs-detail"),
+]
+
 # Url patterns of core app
 
 urlpatterns = [
@@ -104,8 +112,19 @@ urlpatterns = [
     path("logout", auth_views.LogoutView.as_view(), name="logout"),
     path("search", views.search, name="search"),
     path("legals", views.legals, name="legals"),
+    path("metrics", views.metrics, name="metrics"),
+    path(
+        ".well-known/autoconfig/mail/config-v1.1.xml",
+        views.autoconfig,
+        name="autoconfig",
+    ),
+    path("mail/config-v1.1.xml", views.autoconfig),
+    path("autodiscover/autodiscover.xml", views.autodiscover, name="autodiscover"),
+    path("Autodiscover/Autodiscover.xml", views.autodiscover),
+    path("mobileconfig", views.mobileconfig, name="mobileconfig"),
     path("regen-api-key", views.regen_api_key, name="regen-api-key"),
     path("virtual-domains/", include(urlpatterns_virtual_domains)),
     path("virtual-users/", include(urlpatterns_virtual_users)),
     path("virtual-aliases/", include(urlpatterns_virtual_aliases)),
+    path("jobs/", include(urlpatterns_jobs)),
 ]
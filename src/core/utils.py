@@ -26,6 +26,9 @@ import string
 
 from django.conf import settings
 
+from .metrics import PASSWORD_HASH_DURATION
+from .tracing import span
+
 
 def make_password(password):
     """Hash a password using SHA512. Compatible with dovecot.
@@ -45,7 +48,9 @@ def make_password(password):
     mod_name, func_name = function_string.rsplit(".", 1)
     mod = importlib.import_module(mod_name)
     func = getattr(mod, func_name)
-    return func(password)
+    scheme = func_name.replace("make_password_", "")
+    with PASSWORD_HASH_DURATION.time(scheme), span("password_hash", scheme=scheme):
+        return func(password)
 
 
 def make_password_plain(password):
@@ -14,17 +14,24 @@
 # You should have received a copy of the GNU General Public License
 # along with DinoMail. If not, see <https://www.gnu.org/licenses/>.
 
-import re
+import hmac
 
-import dns.resolver
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required, permission_required
-from django.db.models import Q
-from django.http import HttpResponse
+from django.db.models import Count, Q
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseForbidden,
+    HttpResponseNotModified,
+)
 from django.shortcuts import get_object_or_404, redirect, render
-from django.template import loader
 from django.urls import reverse
 from django.utils.translation import gettext_lazy as _
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from tastypie.models import ApiKey, create_api_key
 
 from .forms import (
@@ -34,7 +41,22 @@ from .forms import (
     VirtualDomainForm,
     VirtualUserForm,
 )
-from .models import VirtualAlias, VirtualDomain, VirtualUser
+from .counters import get_global_counter
+from .decorators import async_permission_required
+from .deletion import request_deletion
+from .jobs import enqueue
+from .metrics import REGISTRY
+from .models import Job, VirtualAlias, VirtualDomain, VirtualUser
+from .provisioning import (
+    MAX_REQUEST_SIZE,
+    domain_from_email,
+    email_from_autodiscover,
+    get_document,
+)
+from .records import is_spf_record, parse_dkim, parse_dmarc, txt_value
+from .registry import get_domain_by_name
+from .resolver import aresolve
+from .spf import LOOKUP_LIMIT, SpfEvaluator
 from .utils import make_password
 
 
@@ -42,7 +64,8 @@ from .utils import make_password
 def home(request):
     """Home view.
 
-    This query the total number of virtual domains, users and aliases to display on home page.
+    This reads the total number of virtual domains, users and aliases to display on home page
+    from the global counters.
 
     Args:
         request (HttpRequest): django request object
@@ -50,9 +73,10 @@ def home(request):
     Returns:
         HttpResponse: django response object
     """
-    virtual_domains = VirtualDomain.objects.all().count()
-    virtual_users = VirtualUser.objects.all().count()
-    virtual_aliases = VirtualAlias.objects.all().count()
+    counter = get_global_counter()
+    virtual_domains = counter.domains
+    virtual_users = counter.users
+    virtual_aliases = counter.aliases
     return render(
         request,
         "home.html",
@@ -76,7 +100,7 @@ def virtual_domains_index(request):
     Returns:
         HttpResponse: django response object
     """
-    virtual_domains = VirtualDomain.objects.all()
+    virtual_domains = VirtualDomain.objects.select_related("counter")
     return render(
         request,
         "virtual_domains_index.html",
@@ -152,6 +176,7 @@ def delete_virtual_domain(request, pk):
     """View to delete a virtual domain.
 
     The view first displays a form in which the user have to enter the domain name to confirm the deletion.
+    Large domains are deleted in background (see core.deletion).
 
     Args:
         request (HttpRequest): django request object.
@@ -161,13 +186,23 @@ def delete_virtual_domain(request, pk):
         HttpResponse: django response object.
     """
     virtual_domain = get_object_or_404(VirtualDomain, pk=pk)
+    if virtual_domain.deleting:
+        messages.error(
+            request,
+            _("Domain {} is already being deleted").format(virtual_domain.name),
+        )
+        return redirect(reverse("virtual-domains-index"))
     form = DeleteForm(
         request.POST or None, label=_("Enter domain name to confirm deletion")
     )
     if form.is_valid():
         if form.cleaned_data["verifier"] == virtual_domain.name:
-            message = _("Domain {} was deleted").format(virtual_domain.name)
-            virtual_domain.delete()
+            if request_deletion(virtual_domain, user=request.user):
+                message = _("Domain {} was deleted").format(virtual_domain.name)
+            else:
+                message = _(
+                    "Domain {} is being deleted. Its users and aliases are deleted in background."
+                ).format(virtual_domain.name)
             messages.warning(request, message)
         else:
             messages.error(request, _("Names don't match. Operation cancelled."))
@@ -184,11 +219,12 @@ def delete_virtual_domain(request, pk):
     )
 
 
-@login_required
-@permission_required("core.view_virtualdomain")
-def update_virtual_domain(request, pk):
+@async_permission_required("core.view_virtualdomain")
+async def update_virtual_domain(request, pk):
     """View to update the DKIM and DMARC status.
 
+    The DNS queries are made concurrently without holding a worker thread.
+
     Args:
         request (HttpRequest): django request object.
         pk (int): primary key of the virtual domain to update dkim and dmarc status.
@@ -196,14 +232,31 @@ def update_virtual_domain(request, pk):
     Returns:
         HttpResponse: django response object.
     """
-    virtual_domain = get_object_or_404(VirtualDomain, pk=pk)
-    virtual_domain.update_status()
+    virtual_domain = await sync_to_async(get_object_or_404)(VirtualDomain, pk=pk)
+    await virtual_domain.aupdate_status()
     return redirect(reverse("virtual-domains-index"))
 
 
 @login_required
 @permission_required("core.view_virtualdomain")
-def update_dkim_virtual_domain(request, pk):
+@permission_required("core.add_job")
+@require_POST
+def rescan_virtual_domains(request):
+    """View to update the DKIM, DMARC and SPF status of all the domains in background.
+
+    Args:
+        request (HttpRequest): django request object.
+
+    Returns:
+        HttpResponse: django response object.
+    """
+    job = enqueue("rescan_domains", user=request.user)
+    messages.success(request, _("The domains will be scanned in background."))
+    return redirect(reverse("jobs-detail", args=[job.pk]))
+
+
+@async_permission_required("core.view_virtualdomain")
+async def update_dkim_virtual_domain(request, pk):
     """View to update the DKIM status.
 
     Args:
@@ -213,14 +266,13 @@ def update_dkim_virtual_domain(request, pk):
     Returns:
         HttpResponse: django response object.
     """
-    virtual_domain = get_object_or_404(VirtualDomain, pk=pk)
-    virtual_domain.update_dkim_status()
+    virtual_domain = await sync_to_async(get_object_or_404)(VirtualDomain, pk=pk)
+    await virtual_domain.aupdate_status(checks=("dkim",))
     return redirect(reverse("virtual-domains-index"))
 
 
-@login_required
-@permission_required("core.view_virtualdomain")
-def update_dmarc_virtual_domain(request, pk):
+@async_permission_required("core.view_virtualdomain")
+async def update_dmarc_virtual_domain(request, pk):
     """View to update the DMARC status.
 
     Args:
@@ -230,14 +282,13 @@ def update_dmarc_virtual_domain(request, pk):
     Returns:
         HttpResponse: django response object.
     """
-    virtual_domain = get_object_or_404(VirtualDomain, pk=pk)
-    virtual_domain.update_dmarc_status()
+    virtual_domain = await sync_to_async(get_object_or_404)(VirtualDomain, pk=pk)
+    await virtual_domain.aupdate_status(checks=("dmarc",))
     return redirect(reverse("virtual-domains-index"))
 
 
-@login_required
-@permission_required("core.view_virtualdomain")
-def update_spf_virtual_domain(request, pk):
+@async_permission_required("core.view_virtualdomain")
+async def update_spf_virtual_domain(request, pk):
     """View to update the SPF status.
 
     Args:
@@ -247,14 +298,13 @@ def update_spf_virtual_domain(request, pk):
     Returns:
         HttpResponse: django response object.
     """
-    virtual_domain = get_object_or_404(VirtualDomain, pk=pk)
-    virtual_domain.update_spf_status()
+    virtual_domain = await sync_to_async(get_object_or_404)(VirtualDomain, pk=pk)
+    await virtual_domain.aupdate_status(checks=("spf",))
     return redirect(reverse("virtual-domains-index"))
 
 
-@login_required
-@permission_required("core.view_virtualdomain")
-def dkim_scan_virtual_domain(request, pk):
+@async_permission_required("core.view_virtualdomain")
+async def dkim_scan_virtual_domain(request, pk):
     """View to display DKIM scan information.
 
     Args:
@@ -264,24 +314,20 @@ def dkim_scan_virtual_domain(request, pk):
     Returns:
         HttpResponse: django response object.
     """
-    virtual_domain = get_object_or_404(VirtualDomain, pk=pk)
-    virtual_domain.update_dkim_status()
-    url = "{key_name}._domainkey.{domain}".format(
-        key_name=virtual_domain.dkim_key_name, domain=virtual_domain.name
-    )
+    virtual_domain = await sync_to_async(get_object_or_404)(VirtualDomain, pk=pk)
+    url = virtual_domain.dkim_query()
     try:
-        dns_answer = dns.resolver.query(url, "TXT")[0].to_text()
+        answers = await aresolve(url, "TXT")
     except:
-        dns_answer = None
+        answers = []
+    # The record is queried once, for the status and for the page
+    await sync_to_async(virtual_domain.update_dkim_status)(answers)
+    dns_answer = txt_value(answers[0]) if answers else None
     if dns_answer:
-        match = re.match('^"(.*;\s?)*p=([^;"]*).*$', dns_answer)
-        if not match:
-            key = None
-        else:
-            key = match.groups()[-1]
+        key = parse_dkim(dns_answer)
     else:
         key = None
-    return render(
+    return await sync_to_async(render)(
         request,
         "virtual_domains_dkim_scan.html",
         {
@@ -294,11 +340,12 @@ def dkim_scan_virtual_domain(request, pk):
     )
 
 
-@login_required
-@permission_required("core.view_virtualdomain")
-def dmarc_scan_virtual_domain(request, pk):
+@async_permission_required("core.view_virtualdomain")
+async def dmarc_scan_virtual_domain(request, pk):
     """View to display dmarc scan information.
 
+    Pass and fail rates computed from the imported aggregate reports are also displayed.
+
     Args:
         request (HttpRequest): django request object
         pk (int): primary key of the virtual domain.
@@ -306,28 +353,18 @@ def dmarc_scan_virtual_domain(request, pk):
     Returns:
         HttpResponse: django response object.
     """
-    virtual_domain = get_object_or_404(VirtualDomain, pk=pk)
-    virtual_domain.update_dmarc_status()
+    virtual_domain = await sync_to_async(get_object_or_404)(VirtualDomain, pk=pk)
+    await virtual_domain.aupdate_status(checks=("dmarc",))
     url = "_dmarc.{domain}".format(domain=virtual_domain.name)
     try:
-        dns_answer = dns.resolver.query(url, "TXT")[0].to_text()
+        dns_answer = txt_value((await aresolve(url, "TXT"))[0])
     except:
         dns_answer = None
-        v_found = _("No")
-        p_found = _("No")
-    if dns_answer:
-        if "v=DMARC1" in dns_answer:
-            v_found = _("Yes")
-        else:
-            v_found = _("No")
-        match = re.match('^"(.*;\s?)*p=([^;"]*).*$', dns_answer)
-        if match:
-            p_found = _("Yes")
-        else:
-            p_found = _("No")
-    else:
-        key = None
-    return render(
+    tags = parse_dmarc(dns_answer) if dns_answer else None
+    v_found = _("Yes") if tags is not None else _("No")
+    p_found = _("Yes") if tags and "p" in tags else _("No")
+    statistics = await sync_to_async(virtual_domain.dmarc_statistics)()
+    return await sync_to_async(render)(
         request,
         "virtual_domains_dmarc_scan.html",
         {
@@ -336,16 +373,19 @@ def dmarc_scan_virtual_domain(request, pk):
             "dns_answer": dns_answer,
             "v_found": v_found,
             "p_found": p_found,
+            "statistics": statistics,
             "active": "virtual-domains",
         },
     )
 
 
-@login_required
-@permission_required("core.view_virtualdomain")
-def spf_scan_virtual_domain(request, pk):
+@async_permission_required("core.view_virtualdomain")
+async def spf_scan_virtual_domain(request, pk):
     """View to display spf scan information.
 
+    The includes and redirects of the record are expanded to count the DNS lookups and to build
+    a flattened record.
+
     Args:
         request (HttpRequest): django request object
         pk (int): primary key of the virtual domain.
@@ -353,22 +393,27 @@ def spf_scan_virtual_domain(request, pk):
     Returns:
         HttpResponse: django response object.
     """
-    virtual_domain = get_object_or_404(VirtualDomain, pk=pk)
-    virtual_domain.update_spf_status()
+    virtual_domain = await sync_to_async(get_object_or_404)(VirtualDomain, pk=pk)
     url = "{domain}".format(domain=virtual_domain.name)
     try:
-        dns_answer = dns.resolver.query(url, "TXT")
+        dns_answer = await aresolve(url, "TXT")
     except:
         dns_answer = None
     if dns_answer:
-        dns_answer = [answer.to_text() for answer in dns_answer]
-    return render(
+        dns_answer = [txt_value(answer) for answer in dns_answer]
+    # The record is expanded once, for the status and for the page
+    record = next((value for value in dns_answer or [] if is_spf_record(value)), "")
+    spf = await SpfEvaluator().aevaluate(virtual_domain.name, record=record)
+    await sync_to_async(virtual_domain.update_spf_status)(spf)
+    return await sync_to_async(render)(
         request,
         "virtual_domains_spf_scan.html",
         {
             "domain": virtual_domain,
             "url": url,
             "dns_answer": dns_answer,
+            "spf": spf,
+            "lookup_limit": LOOKUP_LIMIT,
             "active": "virtual-domains",
         },
     )
@@ -387,14 +432,102 @@ def autoconfig_virtual_domain(request, pk):
         HttpResponse: django response object.
     """
     virtual_domain = get_object_or_404(VirtualDomain, pk=pk)
-    t = loader.get_template("autoconfig.xml")
-    response = HttpResponse(
-        t.render({"domain": virtual_domain}), content_type="application/xml"
-    )
+    response = provisioning_response(request, "autoconfig", virtual_domain.name)
     response["Content-Disposition"] = "attachment; filename=autoconfig.xml"
     return response
 
 
+def provisioning_response(request, kind, name):
+    """Serve a cached provisioning document of a domain.
+
+    The response has an ETag and can be cached by clients for DINOMAIL_AUTOCONFIG_MAX_AGE
+    seconds. A request with a matching If-None-Match header gets a 304 response.
+
+    Args:
+        request (HttpRequest): django request object.
+        kind (string): kind of document (see core.provisioning.DOCUMENTS).
+        name (string): domain name.
+
+    Raises:
+        Http404: if the domain is not managed.
+
+    Returns:
+        HttpResponse: django response object.
+    """
+    document = get_document(kind, name) if name else None
+    if document is None:
+        raise Http404
+    content, content_type, etag = document
+    if etag in request.META.get("HTTP_IF_NONE_MATCH", "").split(", "):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content, content_type=content_type)
+    response["ETag"] = etag
+    response["Cache-Control"] = "public, max-age={}".format(
+        getattr(settings, "DINOMAIL_AUTOCONFIG_MAX_AGE", 3600)
+    )
+    return response
+
+
+def autoconfig(request):
+    """Public autoconfig view, as requested by mail clients (Thunderbird, ...).
+
+    The domain is taken from the emailaddress parameter, or else from the host name
+    (autoconfig.example.com).
+
+    Args:
+        request (HttpRequest): django request object.
+
+    Returns:
+        HttpResponse: django response object.
+    """
+    name = None
+    if "emailaddress" in request.GET:
+        name = domain_from_email(request.GET["emailaddress"])
+    else:
+        host = request.get_host().split(":")[0].lower()
+        if host.startswith("autoconfig."):
+            name = domain_from_email("@" + host[len("autoconfig.") :])
+    return provisioning_response(request, "autoconfig", name)
+
+
+@csrf_exempt
+@require_POST
+def autodiscover(request):
+    """Public Outlook autodiscover view.
+
+    The domain is taken from the EMailAddress element of the request.
+
+    Args:
+        request (HttpRequest): django request object.
+
+    Returns:
+        HttpResponse: django response object.
+    """
+    body = request.read(MAX_REQUEST_SIZE)
+    name = domain_from_email(email_from_autodiscover(body))
+    return provisioning_response(request, "autodiscover", name)
+
+
+def mobileconfig(request):
+    """Public view of Apple configuration profiles (iOS and macOS Mail).
+
+    The domain is taken from the emailaddress parameter.
+
+    Args:
+        request (HttpRequest): django request object.
+
+    Returns:
+        HttpResponse: django response object.
+    """
+    name = domain_from_email(request.GET.get("emailaddress"))
+    response = provisioning_response(request, "mobileconfig", name)
+    response["Content-Disposition"] = "attachment; filename={}.mobileconfig".format(
+        name
+    )
+    return response
+
+
 @login_required
 @permission_required("core.view_virtualuser")
 def virtual_users_index(request):
@@ -407,14 +540,15 @@ def virtual_users_index(request):
         HttpResponse: django response object.
     """
     if "domain" in request.GET:
-        try:
-            current_domain = VirtualDomain.objects.get(name=request.GET["domain"])
-        except VirtualDomain.DoesNotExist:
+        current_domain = get_domain_by_name(request.GET["domain"])
+        if current_domain is None:
             return redirect(reverse("virtual-users-index"))
-        virtual_users = VirtualUser.objects.filter(domain=current_domain)
+        virtual_users = VirtualUser.objects.filter(
+            domain=current_domain
+        ).select_related("domain", "quota_usage")
     else:
         current_domain = None
-        virtual_users = VirtualUser.objects.all()
+        virtual_users = VirtualUser.objects.select_related("domain", "quota_usage")
     virtual_domains = VirtualDomain.objects.all()
     return render(
         request,
@@ -572,14 +706,16 @@ def virtual_aliases_index(request):
         HttpResponse: django response object.
     """
     if "domain" in request.GET:
-        try:
-            current_domain = VirtualDomain.objects.get(name=request.GET["domain"])
-        except VirtualDomain.DoesNotExist:
+        current_domain = get_domain_by_name(request.GET["domain"])
+        if current_domain is None:
             return redirect(reverse("virtual-aliases-index"))
-        virtual_aliases = VirtualAlias.objects.filter(domain=current_domain)
+        virtual_aliases = VirtualAlias.objects.filter(
+            domain=current_domain
+        ).select_related("domain")
     else:
         current_domain = None
-        virtual_aliases = VirtualAlias.objects.all()
+        virtual_aliases = VirtualAlias.objects.select_related("domain")
+    virtual_aliases = VirtualAlias.prefetch_status(virtual_aliases)
     virtual_domains = VirtualDomain.objects.all()
     return render(
         request,
@@ -674,6 +810,51 @@ def delete_virtual_alias(request, pk):
     return redirect(reverse("virtual-aliases-index"))
 
 
+@login_required
+@permission_required("core.view_job")
+def jobs_index(request):
+    """List the last background jobs.
+
+    The page refreshes itself while jobs are pending or running.
+
+    Args:
+        request (HttpRequest): django request object
+
+    Returns:
+        HttpResponse: django response object
+    """
+    jobs = list(Job.objects.select_related("user")[:100])
+    return render(
+        request,
+        "jobs_index.html",
+        {
+            "jobs": jobs,
+            "refresh": any(job.is_active() for job in jobs),
+            "active": "jobs",
+        },
+    )
+
+
+@login_required
+@permission_required("core.view_job")
+def job_detail(request, pk):
+    """Display the progress and the result or the error of a background job.
+
+    Args:
+        request (HttpRequest): django request object
+        pk (int): primary key of the job.
+
+    Returns:
+        HttpResponse: django response object
+    """
+    job = get_object_or_404(Job, pk=pk)
+    return render(
+        request,
+        "job_detail.html",
+        {"job": job, "refresh": job.is_active(), "active": "jobs"},
+    )
+
+
 @login_required
 def search(request):
     """Search view.
@@ -691,10 +872,16 @@ def search(request):
     """
     search = request.GET.get("q")
     if search:
-        virtual_domains = VirtualDomain.objects.filter(name__icontains=search)
-        virtual_users = VirtualUser.objects.filter(email__icontains=search)
-        virtual_aliases = VirtualAlias.objects.filter(
-            Q(source__icontains=search) | Q(destination__icontains=search)
+        virtual_domains = VirtualDomain.objects.filter(
+            name__icontains=search
+        ).select_related("counter")
+        virtual_users = VirtualUser.objects.filter(
+            email__icontains=search
+        ).select_related("domain", "quota_usage")
+        virtual_aliases = VirtualAlias.prefetch_status(
+            VirtualAlias.objects.filter(
+                Q(source__icontains=search) | Q(destination__icontains=search)
+            ).select_related("domain")
         )
     else:
         virtual_domains = VirtualDomain.objects.none()
@@ -746,3 +933,60 @@ def regen_api_key(request):
         ApiKey.objects.create(user=request.user)
         messages.success(request, _("Api key was created."))
     return redirect(reverse("home"))
+
+
+def metrics(request):
+    """Prometheus metrics view.
+
+    The view is allowed to the requests with the DINOMAIL_METRICS_TOKEN bearer token, and to the
+    addresses of DINOMAIL_METRICS_ALLOWED_IPS (none by default). The totals are read from the
+    global counters.
+
+    Args:
+        request (HttpRequest): django request object.
+
+    Returns:
+        HttpResponse: django response object.
+    """
+    allowed_ips = getattr(settings, "DINOMAIL_METRICS_ALLOWED_IPS", [])
+    token = getattr(settings, "DINOMAIL_METRICS_TOKEN", None)
+    authorization = request.META.get("HTTP_AUTHORIZATION", "").encode()
+    allowed = request.META.get("REMOTE_ADDR") in allowed_ips or (
+        token and hmac.compare_digest(authorization, "Bearer {}".format(token).encode())
+    )
+    if not allowed:
+        return HttpResponseForbidden()
+    counter = get_global_counter()
+    gauges = [
+        (
+            "dinomail_objects",
+            "Number of domains, users and aliases.",
+            ("model",),
+            {
+                ("domain",): counter.domains,
+                ("user",): counter.users,
+                ("alias",): counter.aliases,
+            },
+        )
+    ]
+    for check, choices in (
+        ("dkim", VirtualDomain.DkimStatus),
+        ("dmarc", VirtualDomain.DmarcStatus),
+        ("spf", VirtualDomain.SpfStatus),
+    ):
+        values = {(choice.name.lower(),): 0 for choice in choices}
+        field = "{}_status".format(check)
+        for row in VirtualDomain.objects.values(field).annotate(count=Count("pk")):
+            values[(choices(row[field]).name.lower(),)] = row["count"]
+        gauges.append(
+            (
+                "dinomail_domain_{}_status".format(check),
+                "Number of domains by {} status.".format(check.upper()),
+                ("status",),
+                values,
+            )
+        )
+    return HttpResponse(
+        REGISTRY.render(gauges),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )
@@ -48,3 +48,4 @@ DINOMAIL_CATCH_LINE = _("Peaceful emails !")
 DINOMAIL_LEGALS = """
 """
 DINOMAIL_PASSWORD_SCHEME = "core.utils.make_password_ssha512"
+DINOMAIL_DNS_RESOLVER = "core.resolver.DnsPythonResolver"
@@ -39,11 +39,16 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "core.middleware.TracingMiddleware",
+    "core.middleware.MetricsMiddleware",
+    "core.middleware.QueryCountMiddleware",
+    "core.middleware.ReplicaMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "core.middleware.ProfilerMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -52,7 +57,7 @@ ROOT_URLCONF = "dinomail.urls"
 
 TEMPLATES = [
     {
-        "BACKEND": "django.template.backends.django.DjangoTemplates",
+        "BACKEND": "core.templating.DjangoTemplates",
         "DIRS": [],
         "APP_DIRS": True,
         "OPTIONS": {
@@ -69,6 +74,10 @@ TEMPLATES = [
 
 WSGI_APPLICATION = "dinomail.wsgi.application"
 
+# Reads of read-only requests go to DINOMAIL_READ_REPLICAS, if any
+
+DATABASE_ROUTERS = ["core.routers.ReplicaRouter"]
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 